@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+from pathlib import Path
+
+from vism import batching
+from vism.batching import (
+    BatchEncoder,
+    _PeakMemory,
+    calibrate_batch_size,
+    choose_batch_size,
+)
+from vism.embeddings import _dinov2_preprocess
+
+
+class LimitedNet(torch.nn.Module):
+    """Pools images to 8 numbers; batches above limit fail to allocate"""
+
+    def __init__(self, limit: int, message: str = "CUDA out of memory") -> None:
+        super().__init__()
+        self.limit = limit
+        self.message = message
+        self.sizes = []
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        self.sizes.append(len(x))
+        if len(x) > self.limit:
+            raise RuntimeError(self.message)
+        return torch.nn.functional.adaptive_avg_pool2d(x, 2)[:, :2].flatten(1) + 1
+
+
+def model(net: torch.nn.Module):
+    return net, _dinov2_preprocess(), "cpu"
+
+
+def test_encoder_halves_batches_that_fail_to_allocate():
+    net = LimitedNet(limit=5)
+    encoder = BatchEncoder(model(net), 16)
+    tensors = [torch.rand(3, 224, 224) for _ in range(10)]
+    embeddings = encoder.encode([Path(f"{i}.png") for i in range(10)], tensors)
+
+    assert [e.path.name for e in embeddings] == [f"{i}.png" for i in range(10)]
+    assert encoder.size == 4
+    assert net.sizes == [10, 8, 4, 4, 2]
+
+
+def test_encoder_reraises_other_errors():
+    encoder = BatchEncoder(model(LimitedNet(limit=1, message="shape mismatch")), 4)
+    with pytest.raises(RuntimeError, match="shape mismatch"):
+        encoder.encode([Path("a.png"), Path("b.png")], [torch.rand(3, 224, 224)] * 2)
+
+
+def test_calibration_stays_below_allocation_failures(monkeypatch):
+    # any throughput counts as an improvement, so only the failure stops growth
+    monkeypatch.setattr(batching, "MIN_SPEEDUP", 0.0)
+    assert calibrate_batch_size(model(LimitedNet(limit=40))) == 32
+    assert calibrate_batch_size(model(LimitedNet(limit=40)), max_size=16) == 16
+
+
+class HungryNet(LimitedNet):
+    """Holds 4 MB per image while running a batch"""
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        scratch = torch.ones(len(x), 2**20)
+        time.sleep(0.02)
+        return super().forward(x) + scratch[:, :1] * 0
+
+
+@pytest.mark.skipif(batching._rss() is None, reason="needs /proc/self/statm")
+def test_peak_memory_sees_transient_cpu_allocations():
+    with _PeakMemory("cpu") as memory:
+        block = np.ones(64 * 2**20, dtype=np.uint8)
+        time.sleep(0.05)
+        del block
+    assert memory.used >= 48 * 2**20
+
+
+@pytest.mark.skipif(batching._rss() is None, reason="needs /proc/self/statm")
+def test_calibration_stays_within_free_cpu_memory(monkeypatch):
+    monkeypatch.setattr(batching, "MIN_SPEEDUP", 0.0)
+    # 100 MB budget: a batch of 16 needs 64 MB, so 32 would need about 128 MB
+    monkeypatch.setattr(batching, "free_memory", lambda device: 200 * 2**20)
+    assert calibrate_batch_size(model(HungryNet(limit=1000))) == 16
+
+
+def test_small_runs_skip_calibration_and_sizes_are_kept(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        batching, "calibrate_batch_size", lambda m: calls.append(m) or 128
+    )
+    m = model(LimitedNet(limit=1000))
+    assert choose_batch_size(m, 10) == batching.DEFAULT_BATCH_SIZE
+    assert choose_batch_size(m, 5000) == choose_batch_size(m, 5000) == 128
+    assert len(calls) == 1
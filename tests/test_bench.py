@@ -0,0 +1,61 @@
+import json
+import pytest
+from pathlib import Path
+
+from vism.bench import (
+    STAGES,
+    StageResult,
+    best_of,
+    compare_results,
+    make_synthetic_library,
+    results_to_dict,
+    run_benchmark,
+    stub_model,
+)
+from vism.images import scan_images
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def test_synthetic_library_cycles_formats(tmp_path: Path):
+    paths = make_synthetic_library(tmp_path, 6, ("jpg", "png", "webp"), (64, 48))
+    assert [p.suffix for p in paths] == [".jpg", ".png", ".webp"] * 2
+    assert [e.path for e in scan_images(tmp_path)] == sorted(paths)
+
+
+@pytest.mark.parametrize("kind", ["stub", "tiny"])
+def test_run_benchmark_times_every_stage(tmp_path: Path, tmp_cache: Path, kind: str):
+    make_synthetic_library(tmp_path / "lib", 20, ("jpg", "png"), (96, 64))
+    results = run_benchmark(tmp_path / "lib", stub_model(kind), batch_size=8, queries=5)
+
+    assert tuple(results) == STAGES
+    assert results["search"].items == 5
+    assert all(results[s].items == 20 for s in ("scan", "decode", "inference"))
+    assert all(r.seconds >= 0 for r in results.values())
+    # the user's cache is left alone
+    assert list(tmp_cache.iterdir()) == []
+    json.dumps(results_to_dict(results))
+
+
+def test_compare_flags_throughput_drops():
+    def report(per_second: float):
+        stage = StageResult(seconds=100 / per_second, items=100)
+        return {"runs": [{"images": 100, "stages": results_to_dict({"decode": stage})}]}
+
+    assert compare_results(report(100), report(90)) == [(100, "decode", 100, 90, False)]
+    assert compare_results(report(100), report(70))[0][-1]
+    assert compare_results(report(100), report(70), tolerance=0.5)[0][-1] is False
+
+
+def test_best_of_keeps_fastest_run_per_stage():
+    runs = [
+        {"a": StageResult(2.0, 10), "b": StageResult(1.0, 10)},
+        {"a": StageResult(1.0, 10), "b": StageResult(3.0, 10)},
+    ]
+    assert best_of(runs) == {"a": StageResult(1.0, 10), "b": StageResult(1.0, 10)}
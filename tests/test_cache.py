@@ -3,13 +3,23 @@ import pytest
 from pathlib import Path
 
 from vism.cache import (
+    CacheSession,
     _compute_cache_key,
     _decode_path,
     _get_cache_dir,
+    _get_cache_db,
+    _get_vectors_path,
     cache_embeddings,
+    cache_keys_for_entries,
+    cache_text_embeddings,
     load_cached_embeddings,
+    load_cached_paths,
+    load_embedding_matrix,
+    load_text_embeddings,
     clear_cache,
     prune_cache,
+    set_cache_content_keys,
+    set_cache_precision,
     stats_cache_global,
     stats_cache_prefix,
 )
@@ -68,6 +78,26 @@ def test_cache_key_different_files(tmp_path: Path):
     assert _compute_cache_key(a) != _compute_cache_key(b)
 
 
+def test_cache_keys_from_scan_match_stat_keys(tmp_path: Path):
+    from vism.images import scan_images
+
+    for name in ("a.jpg", "b.png"):
+        (tmp_path / name).write_bytes(name.encode())
+    keys = cache_keys_for_entries(scan_images(tmp_path))
+    assert keys == {p: _compute_cache_key(p) for p in keys}
+    assert len(keys) == 2
+
+
+def test_precomputed_keys_skip_stat(tmp_path: Path):
+    img = tmp_path / "img.jpg"
+    img.write_bytes(b"x")
+    keys = {img: _compute_cache_key(img)}
+    cache_embeddings([make_embedding(img, [1.0, 2.0])], "test_model", keys)
+    img.unlink()
+    # lookups go through the scan's keys, so the file is never stat'ed
+    assert img in load_cached_embeddings([img], "test_model", keys)
+
+
 # --- _decode_path ---
 
 
@@ -144,6 +174,348 @@ def test_cache_overwrites_existing(
     np.testing.assert_array_almost_equal(result[img].embedding, emb2.embedding)
 
 
+def test_embedding_matrix_is_a_view_of_the_vectors_file(
+    tmp_path: Path,
+):
+    paths = []
+    for i in range(4):
+        p = tmp_path / f"img{i}.jpg"
+        p.write_bytes(f"data{i}".encode())
+        paths.append(p)
+    cache_embeddings(
+        [make_embedding(p, [float(i), 1.0]) for i, p in enumerate(paths)], "test_model"
+    )
+
+    found, matrix = load_embedding_matrix(list(reversed(paths)), "test_model")
+    assert found == paths
+    assert isinstance(matrix.base, np.memmap) or isinstance(matrix, np.memmap)
+    np.testing.assert_array_equal(matrix[:, 0], [0.0, 1.0, 2.0, 3.0])
+
+    found, matrix = load_embedding_matrix([paths[3], paths[0]], "test_model")
+    assert found == [paths[0], paths[3]]
+    np.testing.assert_array_equal(matrix[:, 0], [0.0, 3.0])
+
+
+def test_load_cached_paths(
+    tmp_path: Path,
+):
+    cached = tmp_path / "cached.jpg"
+    uncached = tmp_path / "uncached.jpg"
+    cached.write_bytes(b"c")
+    uncached.write_bytes(b"u")
+    cache_embeddings([make_embedding(cached, [1.0])], "test_model")
+
+    assert load_cached_paths([cached, uncached], "test_model") == {cached}
+
+
+def test_legacy_blob_rows_still_load(
+    tmp_path: Path,
+):
+    import sqlite3
+
+    img = tmp_path / "img.jpg"
+    img.write_bytes(b"x")
+    db_path = _get_cache_db("test_model")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE embeddings (cache_key TEXT PRIMARY KEY, path BLOB NOT NULL, "
+        "embedding BLOB NOT NULL, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    conn.execute(
+        "INSERT INTO embeddings (cache_key, path, embedding) VALUES (?, ?, ?)",
+        (
+            _compute_cache_key(img),
+            str(img).encode(),
+            np.array([0.5, 0.25], dtype=np.float32).tobytes(),
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+    result = load_cached_embeddings([img], "test_model")
+    np.testing.assert_array_equal(result[img].embedding, [0.5, 0.25])
+
+
+# --- content keys ---
+
+
+def test_content_key_ignores_path(tmp_path: Path):
+    from vism.cache import _compute_content_key
+
+    a = tmp_path / "a.jpg"
+    b = tmp_path / "sub" / "b.jpg"
+    b.parent.mkdir()
+    a.write_bytes(b"same bytes")
+    b.write_bytes(b"same bytes")
+    assert _compute_content_key(a) == _compute_content_key(b)
+    b.write_bytes(b"other bytes")
+    assert _compute_content_key(a) != _compute_content_key(b)
+
+
+def test_content_key_samples_large_files(tmp_path: Path):
+    from vism.cache import CONTENT_SAMPLE_SIZE, _compute_content_key
+
+    data = bytearray(10 * CONTENT_SAMPLE_SIZE)
+    a = tmp_path / "a.jpg"
+    a.write_bytes(bytes(data))
+    key = _compute_content_key(a)
+    data[-1] = 1  # inside the tail sample
+    a.write_bytes(bytes(data))
+    assert _compute_content_key(a) != key
+
+
+def test_moved_file_reuses_embedding(tmp_path: Path):
+    old = tmp_path / "old" / "img.jpg"
+    new = tmp_path / "new" / "img.jpg"
+    old.parent.mkdir()
+    new.parent.mkdir()
+    old.write_bytes(b"photo")
+    set_cache_content_keys("test_model", True)
+    cache_embeddings([make_embedding(old, [1.0, 2.0])], "test_model")
+
+    old.rename(new)
+    result = load_cached_embeddings([new], "test_model")
+    np.testing.assert_array_equal(result[new].embedding, [1.0, 2.0])
+    # lookups don't write
+    with CacheSession("test_model", content_keys=False) as session:
+        assert session.load_cached_paths([new]) == set()
+
+    # the hit is recorded under the new path with the next write
+    other = tmp_path / "other.jpg"
+    other.write_bytes(b"other")
+    with CacheSession("test_model") as session:
+        assert session.load_cached_paths([new]) == {new}
+        session.cache_embeddings([make_embedding(other, [0.0, 1.0])])
+    with CacheSession("test_model", content_keys=False) as session:
+        assert session.load_cached_paths([new]) == {new}
+
+
+def test_content_keys_are_opt_in(tmp_path: Path):
+    old = tmp_path / "old.jpg"
+    new = tmp_path / "new.jpg"
+    old.write_bytes(b"photo")
+    cache_embeddings([make_embedding(old, [1.0])], "test_model")
+    old.rename(new)
+    assert load_cached_embeddings([new], "test_model") == {}
+
+    # enabling hashes files cached before, as long as they are unchanged
+    new.rename(old)
+    assert set_cache_content_keys("test_model", True) == 1
+    old.rename(new)
+    np.testing.assert_array_equal(
+        load_cached_embeddings([new], "test_model")[new].embedding, [1.0]
+    )
+
+
+def test_identical_files_share_a_vector_row(tmp_path: Path):
+    a = tmp_path / "a.jpg"
+    copy = tmp_path / "copy.jpg"
+    other = tmp_path / "other.jpg"
+    a.write_bytes(b"photo")
+    copy.write_bytes(b"photo")
+    other.write_bytes(b"different")
+
+    set_cache_content_keys("test_model", True)
+    cache_embeddings(
+        [
+            make_embedding(a, [1.0, 0.0]),
+            make_embedding(copy, [1.0, 0.0]),
+            make_embedding(other, [0.0, 1.0]),
+        ],
+        "test_model",
+    )
+    vectors_path = _get_vectors_path(_get_cache_db("test_model"))
+    assert vectors_path.stat().st_size == 2 * 2 * 4
+
+    # compaction keeps the shared row while any file still uses it
+    a.unlink()
+    assert prune_cache() == 1
+    result = load_cached_embeddings([copy, other], "test_model")
+    np.testing.assert_array_equal(result[copy].embedding, [1.0, 0.0])
+    np.testing.assert_array_equal(result[other].embedding, [0.0, 1.0])
+    assert vectors_path.stat().st_size == 2 * 2 * 4
+
+
+# --- storage precision ---
+
+
+def clustered_unit_vectors(n: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n // 10, dim))
+    vecs = np.repeat(centers, 10, axis=0) + 0.3 * rng.normal(size=(n, dim))
+    return (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype(np.float32)
+
+
+def cache_vectors(tmp_path: Path, vectors: np.ndarray) -> list[Path]:
+    paths = []
+    for i in range(len(vectors)):
+        p = tmp_path / f"img{i}.jpg"
+        p.write_bytes(f"data{i}".encode())
+        paths.append(p)
+    cache_embeddings(
+        [ImageEmbedding(path=p, embedding=v) for p, v in zip(paths, vectors)],
+        "test_model",
+    )
+    return paths
+
+
+@pytest.mark.parametrize(
+    "precision,size_ratio,tolerance",
+    [("float16", 2, 1e-3), ("int8", 4, 1e-2)],
+)
+def test_precision_shrinks_storage_and_preserves_vectors(
+    tmp_path: Path, precision: str, size_ratio: int, tolerance: float
+):
+    vectors = clustered_unit_vectors(200, 64)
+    set_cache_precision("test_model", precision)
+    paths = cache_vectors(tmp_path, vectors)
+
+    vectors_path = _get_vectors_path(_get_cache_db("test_model"))
+    float32_size = vectors.nbytes
+    # int8 rows carry a 4-byte scale
+    assert vectors_path.stat().st_size <= float32_size / size_ratio + 4 * len(vectors)
+
+    found, matrix = load_embedding_matrix(paths, "test_model")
+    assert found == paths
+    assert matrix.dtype == np.float32
+    np.testing.assert_allclose(matrix, vectors, atol=tolerance)
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+def test_precision_keeps_search_ranking_and_dupes(tmp_path: Path, precision: str):
+    from vism.dupes import find_duplicate_clusters
+
+    vectors = clustered_unit_vectors(500, 128)
+    paths = cache_vectors(tmp_path, vectors)
+    assert set_cache_precision("test_model", precision) == len(vectors)
+    _, quantized = load_embedding_matrix(paths, "test_model")
+
+    k = 10
+    exact = np.argsort(-(vectors @ vectors.T), axis=1)[:, :k]
+    approx = np.argsort(-(quantized @ quantized.T), axis=1)[:, :k]
+    overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact, approx)])
+    assert overlap >= 0.95
+
+    # near-duplicates: tight groups of 3 well above the default threshold
+    rng = np.random.default_rng(1)
+    originals = rng.normal(size=(50, 128))
+    dupes = np.repeat(originals, 3, axis=0) + 0.03 * rng.normal(size=(150, 128))
+    dupes = (dupes / np.linalg.norm(dupes, axis=1, keepdims=True)).astype(np.float32)
+    clear_cache()
+    dupe_paths = cache_vectors(tmp_path, dupes)
+    set_cache_precision("test_model", precision)
+    _, quantized_dupes = load_embedding_matrix(dupe_paths, "test_model")
+
+    def cluster_sets(matrix):
+        clusters = find_duplicate_clusters(dupe_paths, matrix, threshold=0.95)
+        return {frozenset(p for p, _ in c) for c in clusters}
+
+    assert len(cluster_sets(dupes)) == 50
+    assert cluster_sets(quantized_dupes) == cluster_sets(dupes)
+
+
+def test_precision_conversion_roundtrips(tmp_path: Path):
+    vectors = clustered_unit_vectors(50, 16)
+    paths = cache_vectors(tmp_path, vectors)
+    set_cache_precision("test_model", "float16")
+    set_cache_precision("test_model", "float32")
+    _, matrix = load_embedding_matrix(paths, "test_model")
+    np.testing.assert_allclose(matrix, vectors, atol=1e-3)
+
+
+def test_failed_precision_change_keeps_vectors_readable(tmp_path: Path, monkeypatch):
+    import vism.cache
+
+    vectors = clustered_unit_vectors(50, 16)
+    paths = cache_vectors(tmp_path, vectors)
+
+    set_meta = vism.cache._set_meta
+
+    def fail_on_precision(conn, key, value):
+        if key == "precision":
+            raise OSError("disk full")
+        set_meta(conn, key, value)
+
+    # fails after the int8 file is written, before the precision is committed
+    with monkeypatch.context() as m:
+        m.setattr(vism.cache, "_set_meta", fail_on_precision)
+        with pytest.raises(OSError):
+            set_cache_precision("test_model", "int8")
+
+    _, matrix = load_embedding_matrix(paths, "test_model")
+    np.testing.assert_array_equal(matrix, vectors)
+    assert set_cache_precision("test_model", "float16") == len(vectors)
+    _, matrix = load_embedding_matrix(paths, "test_model")
+    np.testing.assert_allclose(matrix, vectors, atol=1e-3)
+    assert not _get_vectors_path(_get_cache_db("test_model")).exists()
+
+
+def test_unknown_precision_is_rejected():
+    with pytest.raises(ValueError):
+        set_cache_precision("test_model", "int4")
+
+
+# --- CacheSession ---
+
+
+def test_session_batches_writes_until_commit(tmp_path: Path):
+    paths = []
+    for i in range(3):
+        p = tmp_path / f"img{i}.jpg"
+        p.write_bytes(f"data{i}".encode())
+        paths.append(p)
+
+    with CacheSession("test_model") as session:
+        for i, p in enumerate(paths):
+            session.cache_embeddings([make_embedding(p, [float(i)])])
+        session.mark_failed(tmp_path / "img0.jpg")
+        # the session sees its own writes, other readers only committed ones
+        assert session.load_cached_paths(paths) == set(paths)
+        assert load_cached_embeddings(paths, "test_model") == {}
+
+    assert len(load_cached_embeddings(paths, "test_model")) == 3
+
+
+def test_session_commits_after_commit_rows(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(CacheSession, "COMMIT_ROWS", 2)
+    paths = []
+    for i in range(3):
+        p = tmp_path / f"img{i}.jpg"
+        p.write_bytes(f"data{i}".encode())
+        paths.append(p)
+
+    with CacheSession("test_model") as session:
+        for i, p in enumerate(paths):
+            session.cache_embeddings([make_embedding(p, [float(i)])])
+        assert set(load_cached_embeddings(paths, "test_model")) == set(paths[:2])
+
+
+def test_session_failed_batch_keeps_earlier_batches(tmp_path: Path):
+    a = tmp_path / "a.jpg"
+    b = tmp_path / "b.jpg"
+    a.write_bytes(b"a")
+    b.write_bytes(b"b")
+
+    with CacheSession("test_model") as session:
+        session.cache_embeddings([make_embedding(a, [1.0, 0.0])])
+        # dimension mismatch fails this batch only
+        session.cache_embeddings([make_embedding(b, [1.0, 0.0, 0.0])])
+
+    result = load_cached_embeddings([a, b], "test_model")
+    assert set(result) == {a}
+
+
+def test_cache_db_uses_wal(tmp_path: Path):
+    import sqlite3
+
+    img = tmp_path / "img.jpg"
+    img.write_bytes(b"x")
+    cache_embeddings([make_embedding(img, [1.0])], "test_model")
+    conn = sqlite3.connect(_get_cache_db("test_model"))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    conn.close()
+
+
 # --- clear_cache ---
 
 
@@ -161,6 +533,26 @@ def test_clear_all(
     assert result == {}
 
 
+def test_text_embeddings_roundtrip():
+    vector = np.array([0.6, 0.8], dtype=np.float32)
+    cache_text_embeddings("test_model", {"Red  bicycle": vector})
+
+    # the tokenizer ignores case and extra whitespace, so the cache does too
+    found = load_text_embeddings("test_model", ["red bicycle", "blue car"])
+    assert list(found) == ["red bicycle"]
+    np.testing.assert_array_equal(found["red bicycle"], vector)
+    assert load_text_embeddings("other_model", ["red bicycle"]) == {}
+
+
+def test_many_text_embeddings_roundtrip():
+    # more texts than SQLite takes parameters in one query
+    texts = [f"photo {i}" for i in range(2500)]
+    vectors = np.random.default_rng(0).random((len(texts), 4), dtype=np.float32)
+    cache_text_embeddings("test_model", dict(zip(texts, vectors)))
+    found = load_text_embeddings("test_model", texts)
+    np.testing.assert_array_equal(np.stack([found[t] for t in texts]), vectors)
+
+
 def test_clear_specific_model(
     tmp_path: Path,
 ):
@@ -217,7 +609,44 @@ def test_prune_removes_missing_files(
     pruned = prune_cache()
 
     assert pruned == 1
-    assert existing in load_cached_embeddings([existing], "test_model")
+    result = load_cached_embeddings([existing], "test_model")
+    np.testing.assert_array_equal(result[existing].embedding, [1.0])
+    # compacted into the next generation of the file
+    assert _get_vectors_path(_get_cache_db("test_model"), 1).stat().st_size == 4
+
+
+def test_compaction_switches_files_only_when_committed(tmp_path: Path):
+    from vism.cache import _compact_vectors, _init_db
+
+    paths = [tmp_path / f"{i}.jpg" for i in range(3)]
+    for i, path in enumerate(paths):
+        path.write_bytes(bytes([i]))
+    cache_embeddings(
+        [make_embedding(p, [float(i)]) for i, p in enumerate(paths)], "test_model"
+    )
+    db_path = _get_cache_db("test_model")
+    old_file = _get_vectors_path(db_path)
+
+    conn = _init_db(db_path)
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(
+        "DELETE FROM embeddings WHERE path = ?", (str(paths[0].absolute()).encode(),)
+    )
+    assert _compact_vectors(conn, db_path) == old_file
+    # until the compaction commits, readers get the old rows and file
+    result = load_cached_embeddings(paths, "test_model")
+    assert [result[p].embedding[0] for p in paths] == [0.0, 1.0, 2.0]
+    conn.rollback()
+    conn.close()
+    result = load_cached_embeddings(paths, "test_model")
+    assert [result[p].embedding[0] for p in paths] == [0.0, 1.0, 2.0]
+
+    paths[0].unlink()
+    assert prune_cache() == 1
+    result = load_cached_embeddings(paths[1:], "test_model")
+    assert [result[p].embedding[0] for p in paths[1:]] == [1.0, 2.0]
+    assert not old_file.exists()
+    assert _get_vectors_path(db_path, 1).stat().st_size == 2 * 4
 
 
 def test_prune_keeps_existing_files(
@@ -342,3 +771,41 @@ def test_stats_prefix_excludes_outside_paths(
 
     # outside should not appear
     assert all("outside" not in k for k in counts)
+
+
+# --- inference precision ---
+
+
+def test_inference_precisions_have_separate_caches(tmp_path: Path):
+    from vism.cache import inference_cache_name
+
+    img = tmp_path / "a.jpg"
+    img.write_bytes(b"x")
+    bf16_name = inference_cache_name("test_model", "bfloat16")
+    assert inference_cache_name("test_model") == "test_model"
+
+    cache_embeddings([make_embedding(img, [1.0, 0.0])], bf16_name)
+    assert load_cached_paths([img], "test_model") == set()
+    assert load_cached_paths([img], bf16_name) == {img}
+
+    # clearing a model also clears its other precisions
+    assert clear_cache(model_name="test_model") == 1
+    assert load_cached_paths([img], bf16_name) == set()
+
+
+def test_cache_rejects_embeddings_of_other_precision(tmp_path: Path):
+    import sqlite3
+
+    img = tmp_path / "a.jpg"
+    img.write_bytes(b"x")
+    cache_embeddings([make_embedding(img, [1.0, 0.0])], "test_model")
+    # a db recorded as bfloat16 under the float32 name must not take float32 rows
+    conn = sqlite3.connect(_get_cache_db("test_model"))
+    conn.execute("UPDATE meta SET value = 'bfloat16' WHERE key = 'inference'")
+    conn.commit()
+    conn.close()
+
+    other = tmp_path / "b.jpg"
+    other.write_bytes(b"y")
+    cache_embeddings([make_embedding(other, [0.0, 1.0])], "test_model")
+    assert load_cached_paths([other], "test_model") == set()
@@ -0,0 +1,306 @@
+import threading
+import numpy as np
+import pytest
+import torch
+from pathlib import Path
+from PIL import Image
+from typing import Optional
+
+from vism import core
+from vism.core import (
+    ModelLoader,
+    find_library_duplicates,
+    get_embedding_matrix,
+    get_library_index,
+    run_batch_search_pipeline,
+    run_text_search_pipeline,
+    scan_library,
+    search_queries,
+)
+from vism.embeddings import _dinov2_preprocess
+from vism.search import IndexSpec
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture
+def loads():
+    """Count model loads; the model is a small conv net"""
+    calls = []
+
+    def load():
+        calls.append(threading.current_thread().name)
+        torch.manual_seed(0)
+        net = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 16, stride=16),
+            torch.nn.AdaptiveAvgPool2d(2),
+            torch.nn.Flatten(),
+            torch.nn.Linear(32, 16),
+        ).eval()
+        return net, _dinov2_preprocess(), "cpu"
+
+    return calls, load
+
+
+def make_library(root: Path, n: int = 4) -> None:
+    root.mkdir(exist_ok=True)
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        pixels = rng.integers(0, 255, (240, 320, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(root / f"img{i}.png")
+
+
+def test_loader_loads_once_in_background(loads):
+    calls, load = loads
+    loader = ModelLoader(load)
+    assert not loader.started and calls == []
+
+    loader.prefetch()
+    loader.prefetch()
+    assert loader.get() is loader.get()
+    assert calls == ["vism-model-load"]
+
+
+def test_loader_reraises_load_errors():
+    def fail():
+        raise RuntimeError("no weights")
+
+    loader = ModelLoader(fail)
+    with pytest.raises(RuntimeError, match="no weights"):
+        loader.get()
+
+
+def test_decode_pool_matches_inline_decoding(tmp_path: Path, loads, caplog):
+    _, load = loads
+    make_library(tmp_path / "lib", 6)
+    (tmp_path / "lib" / "img2b.png").write_bytes(b"not an image")
+    cache_keys = scan_library(tmp_path / "lib")
+    image_paths = sorted(cache_keys)
+
+    results = {}
+    for workers in (0, 4):
+        caplog.clear()
+        with caplog.at_level("ERROR", logger="vism.core"):
+            paths, matrix = get_embedding_matrix(
+                image_paths,
+                ModelLoader(load),
+                f"test_model_{workers}",
+                decode_workers=workers,
+                cache_keys=cache_keys,
+                batch_size=2,
+            )
+        errors = [r.getMessage() for r in caplog.records]
+        results[workers] = (paths, matrix, errors)
+
+        # the corrupt file is recorded as failed, so it isn't retried
+        loader = ModelLoader(load)
+        again, _ = get_embedding_matrix(
+            image_paths, loader, f"test_model_{workers}", cache_keys=cache_keys
+        )
+        assert again == paths and not loader.started
+
+    inline, pooled = results[0], results[4]
+    corrupt = tmp_path / "lib" / "img2b.png"
+    assert inline[0] == [p for p in image_paths if p != corrupt]
+    assert pooled[0] == inline[0]
+    np.testing.assert_allclose(pooled[1], inline[1], rtol=1e-6)
+    assert pooled[2] == inline[2]
+    assert len(inline[2]) == 1 and str(corrupt) in inline[2][0]
+
+
+def test_cached_library_does_not_load_model(tmp_path: Path, loads):
+    calls, load = loads
+    make_library(tmp_path / "lib")
+    (tmp_path / "lib" / "broken.png").write_bytes(b"not an image")
+    cache_keys = scan_library(tmp_path / "lib")
+
+    paths, matrix = get_embedding_matrix(
+        list(cache_keys), ModelLoader(load), "test_model", cache_keys=cache_keys
+    )
+    assert matrix.shape == (4, 16) and len(calls) == 1
+
+    loader = ModelLoader(load)
+    again, cached = get_embedding_matrix(
+        list(cache_keys), loader, "test_model", cache_keys=cache_keys
+    )
+    assert not loader.started
+    np.testing.assert_array_equal(cached, matrix)
+
+
+def test_index_loads_model_only_for_new_images(tmp_path: Path, loads):
+    calls, load = loads
+    root = tmp_path / "lib"
+    make_library(root, 3)
+    cache_keys = scan_library(root)
+    get_library_index(
+        root, list(cache_keys), ModelLoader(load), "test_model", cache_keys=cache_keys
+    )
+
+    loader = ModelLoader(load)
+    lib = get_library_index(
+        root, list(cache_keys), loader, "test_model", cache_keys=cache_keys
+    )
+    assert not loader.started and lib.ntotal == 3
+
+    # only searching the query needs the model
+    (result,) = search_queries(lib, [root / "img0.png"], loader, k=1)
+    assert loader.started
+    assert result.results[0].path == root / "img0.png"
+
+    Image.new("RGB", (300, 200), "red").save(root / "new.png")
+    cache_keys = scan_library(root)
+    loader = ModelLoader(load)
+    lib = get_library_index(
+        root, list(cache_keys), loader, "test_model", cache_keys=cache_keys
+    )
+    assert loader.started and lib.ntotal == 4
+
+
+def test_cached_dupes_do_not_load_model(tmp_path: Path, loads):
+    _, load = loads
+    make_library(tmp_path)
+    (tmp_path / "copy.png").write_bytes((tmp_path / "img0.png").read_bytes())
+    cache_keys = scan_library(tmp_path)
+    first, _ = find_library_duplicates(cache_keys, load, "test_model")
+
+    def no_model():
+        raise AssertionError("model loaded")
+
+    clusters, _ = find_library_duplicates(cache_keys, no_model, "test_model")
+    assert first and clusters == first
+
+
+def test_budgeted_search_refines_then_leaves_rest_pending(tmp_path: Path, loads):
+    _, load = loads
+    root = tmp_path / "lib"
+    make_library(root, 2)
+    cache_keys = scan_library(root)
+    get_library_index(
+        root, list(cache_keys), ModelLoader(load), "test_model", cache_keys=cache_keys
+    )
+    for i in range(3):
+        Image.new("RGB", (300, 200), (80 * i, 0, 0)).save(root / f"new{i}.png")
+    query = root / "img0.png"
+
+    rounds = list(
+        run_batch_search_pipeline(
+            root, [query], ModelLoader(load), "test_model", k=10, max_encode=1
+        )
+    )
+    assert [(r.final, r.skipped, len(r.results)) for r in rounds] == [
+        (False, 3, 2),
+        (True, 2, 3),
+    ]
+
+    loader = ModelLoader(load)
+    (result,) = run_batch_search_pipeline(
+        root, [query], loader, "test_model", k=10, max_encode=0
+    )
+    assert result.final and result.skipped == 2 and len(result.results) == 3
+    # only the query needed encoding
+    assert loader.started
+
+
+def test_text_search_encodes_no_images(tmp_path: Path, loads):
+    _, load = loads
+    root = tmp_path / "lib"
+    make_library(root)
+    cache_keys = scan_library(root)
+    get_library_index(
+        root, list(cache_keys), ModelLoader(load), "test_model", cache_keys=cache_keys
+    )
+    Image.new("RGB", (300, 200), (255, 0, 0)).save(root / "new.png")
+
+    text_loads = []
+
+    def load_text_model():
+        # "tokens" are already 16-dim vectors, the encoder passes them through
+        text_loads.append(1)
+        tokenize = lambda texts: torch.stack(
+            [torch.arange(16.0) + len(text) for text in texts]
+        )
+        return torch.nn.Identity(), tokenize, "cpu"
+
+    for _ in range(2):
+        loader = ModelLoader(load)
+        (result,) = run_text_search_pipeline(
+            root, ["red bicycle"], load_text_model, loader, "test_model", k=10
+        )
+        assert result.query == "red bicycle" and result.final
+        assert len(result.results) == 4 and result.skipped == 1
+        assert not loader.started
+    # the text embedding is cached after the first search
+    assert text_loads == [1]
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf-flat"])
+def test_index_is_built_in_bounded_chunks(
+    tmp_path: Path, loads, monkeypatch, index_type
+):
+    _, load = loads
+    root = tmp_path / "lib"
+    make_library(root, 7)
+    cache_keys = scan_library(root)
+    # two images are cached already, the rest is encoded
+    get_embedding_matrix(
+        sorted(cache_keys)[:2], ModelLoader(load), "test_model", cache_keys=cache_keys
+    )
+
+    added = []
+    add_vectors = core.add_vectors_to_library_index
+
+    def record(lib, paths, vectors, ids):
+        added.append(len(paths))
+        add_vectors(lib, paths, vectors, ids)
+
+    monkeypatch.setattr(core, "INDEX_ADD_CHUNK", 2)
+    monkeypatch.setattr(core, "add_vectors_to_library_index", record)
+    lib = get_library_index(
+        root,
+        list(cache_keys),
+        ModelLoader(load),
+        "test_model",
+        index_spec=IndexSpec(index_type=index_type),
+        cache_keys=cache_keys,
+        batch_size=2,
+    )
+    assert lib.ntotal == 7 and lib.spec.index_type == index_type
+    assert sum(added) == 7 and max(added) <= 2
+
+
+def test_small_library_keeps_requested_index_type(tmp_path: Path, loads, caplog):
+    _, load = loads
+    root = tmp_path / "lib"
+    make_library(root, 3)
+    # 4 lists need 4 training vectors
+    spec = IndexSpec(index_type="ivf-flat", nlist=4)
+
+    def update(spec: Optional[IndexSpec]):
+        cache_keys = scan_library(root)
+        return get_library_index(
+            root,
+            list(cache_keys),
+            ModelLoader(load),
+            "test_model",
+            index_spec=spec,
+            cache_keys=cache_keys,
+        )
+
+    assert update(spec).spec == IndexSpec()
+    caplog.clear()
+    with caplog.at_level("INFO", logger="vism.core"):
+        lib = update(spec)
+    assert lib.spec == IndexSpec() and lib.requested_spec == spec
+    assert "rebuilding" not in caplog.text
+
+    # once the library is large enough the requested index is built, also
+    # when it isn't asked for again
+    make_library(root, 5)
+    lib = update(None)
+    assert lib.spec == IndexSpec(index_type="ivf-flat", nlist=4) and lib.ntotal == 5
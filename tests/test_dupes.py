@@ -2,7 +2,14 @@ import numpy as np
 import pytest
 from pathlib import Path
 
-from vism.dupes import _UnionFind, find_duplicates
+from vism.dupes import (
+    _connected_components,
+    duplicate_edges,
+    estimate_dupes_recall,
+    find_duplicate_clusters,
+    find_duplicates,
+)
+from vism.search import IndexSpec
 from vism.types import ImageEmbedding
 
 
@@ -15,47 +22,6 @@ def make_embedding(path: Path, vec: list[float]) -> ImageEmbedding:
     return ImageEmbedding(path=path, embedding=normalized(vec))
 
 
-# --- _UnionFind ---
-
-
-def test_union_find_initially_separate():
-    uf = _UnionFind(3)
-    assert uf.find(0) != uf.find(1)
-    assert uf.find(1) != uf.find(2)
-
-
-def test_union_find_merges():
-    uf = _UnionFind(3)
-    uf.union(0, 1)
-    assert uf.find(0) == uf.find(1)
-    assert uf.find(0) != uf.find(2)
-
-
-def test_union_find_transitivity():
-    uf = _UnionFind(3)
-    uf.union(0, 1)
-    uf.union(1, 2)
-    assert uf.find(0) == uf.find(2)
-
-
-def test_union_find_groups_filters_singletons():
-    uf = _UnionFind(4)
-    uf.union(0, 1)
-    # 2 and 3 are singletons
-    groups = uf.groups()
-    assert len(groups) == 1
-    assert sorted(groups[0]) == [0, 1]
-
-
-def test_union_find_multiple_groups():
-    uf = _UnionFind(6)
-    uf.union(0, 1)
-    uf.union(2, 3)
-    uf.union(3, 4)
-    groups = sorted([sorted(g) for g in uf.groups()])
-    assert groups == [[0, 1], [2, 3, 4]]
-
-
 # --- find_duplicates ---
 
 
@@ -149,3 +115,99 @@ def test_threshold_controls_grouping(tmp_path: Path):
     assert find_duplicates(embs, threshold=0.9999) == []
     # loose threshold - one cluster
     assert len(find_duplicates(embs, threshold=0.5)) == 1
+
+
+def test_large_clusters_are_not_truncated(tmp_path: Path):
+    embs = [make_embedding(tmp_path / f"img{i}.jpg", [1.0, 0.0]) for i in range(200)]
+    clusters = find_duplicates(embs, threshold=0.99)
+    assert len(clusters) == 1
+    assert len(clusters[0]) == 200
+
+
+def test_threshold_is_inclusive(tmp_path: Path):
+    embs = [
+        make_embedding(tmp_path / "a.jpg", [1.0, 0.0]),
+        make_embedding(tmp_path / "b.jpg", [0.6, 0.8]),
+    ]
+    assert len(find_duplicates(embs, threshold=0.6)) == 1
+
+
+def test_connected_components_match_reference():
+    rng = np.random.default_rng(0)
+    n = 300
+    src = rng.integers(0, n, size=250)
+    dst = rng.integers(0, n, size=250)
+
+    parent = list(range(n))
+
+    def find(x: int) -> int:
+        while parent[x] != x:
+            x = parent[x]
+        return x
+
+    for a, b in zip(src, dst):
+        parent[find(int(a))] = find(int(b))
+    groups_by_root: dict[int, set[int]] = {}
+    for i in range(n):
+        groups_by_root.setdefault(find(i), set()).add(i)
+    expected = {frozenset(g) for g in groups_by_root.values() if len(g) > 1}
+
+    labels = _connected_components(n, src, dst)
+    groups: dict[int, set[int]] = {}
+    for i, label in enumerate(labels):
+        groups.setdefault(int(label), set()).add(i)
+    assert {frozenset(g) for g in groups.values() if len(g) > 1} == expected
+    assert all(labels[i] == min(g) for g in groups.values() for i in g)
+
+
+# --- approximate engines ---
+
+
+def near_duplicate_library(n_groups: int = 60, n_single: int = 600, dim: int = 32):
+    """Groups of 3 near-identical vectors plus unrelated singles"""
+    rng = np.random.default_rng(0)
+    originals = rng.normal(size=(n_groups, dim))
+    groups = np.repeat(originals, 3, axis=0) + 0.02 * rng.normal(size=(3 * n_groups, dim))
+    singles = rng.normal(size=(n_single, dim))
+    vecs = np.concatenate([groups, singles])
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    paths = [Path(f"/lib/{i}.jpg") for i in range(len(vecs))]
+    return paths, vecs.astype(np.float32)
+
+
+def cluster_sets(clusters):
+    return {frozenset(p for p, _ in c) for c in clusters}
+
+
+def test_ivf_flat_matches_exact_clusters():
+    paths, vecs = near_duplicate_library()
+    exact = find_duplicate_clusters(paths, vecs, threshold=0.95)
+    approx = find_duplicate_clusters(
+        paths, vecs, threshold=0.95, spec=IndexSpec(index_type="ivf-flat", nlist=8), nprobe=8
+    )
+    assert len(exact) == 60
+    assert cluster_sets(approx) == cluster_sets(exact)
+
+
+def test_ivf_pq_rescores_exactly_and_reports_recall():
+    paths, vecs = near_duplicate_library()
+    src, dst, sims = duplicate_edges(
+        vecs, 0.95, spec=IndexSpec(index_type="ivf-pq", nlist=8, pq_m=8), nprobe=4
+    )
+    np.testing.assert_allclose(sims, np.einsum("ij,ij->i", vecs[src], vecs[dst]), atol=1e-5)
+    assert np.all(sims >= 0.95)
+    assert estimate_dupes_recall(vecs, src, dst, 0.95, sample=len(vecs)) >= 0.9
+
+
+def test_recall_estimate_counts_missed_pairs():
+    _, vecs = near_duplicate_library()
+    empty = np.empty(0, dtype=np.int64)
+    assert estimate_dupes_recall(vecs, empty, empty, 0.95, sample=len(vecs)) == 0.0
+    src, dst, _ = duplicate_edges(vecs, 0.95)
+    assert estimate_dupes_recall(vecs, src, dst, 0.95, sample=100) == 1.0
+
+
+def test_hnsw_is_rejected_for_dupes():
+    _, vecs = near_duplicate_library()
+    with pytest.raises(ValueError):
+        duplicate_edges(vecs, 0.95, spec=IndexSpec(index_type="hnsw"))
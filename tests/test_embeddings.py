@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import torch
+
+from vism.embeddings import (
+    _InferenceWrapper,
+    _compute_embeddings,
+    bf16_supported,
+    get_input_size,
+)
+
+
+def small_vit() -> torch.nn.Module:
+    """Patch-embedding conv plus a transformer layer, like a tiny DINOv2"""
+
+    class TinyViT(torch.nn.Module):
+        def __init__(self) -> None:
+            super().__init__()
+            self.patch = torch.nn.Conv2d(3, 64, 16, stride=16)
+            self.qkv = torch.nn.Linear(64, 192)
+            self.norm = torch.nn.LayerNorm(64)
+            self.mlp = torch.nn.Sequential(
+                torch.nn.Linear(64, 128), torch.nn.GELU(), torch.nn.Linear(128, 64)
+            )
+
+        def forward(self, x: torch.Tensor) -> torch.Tensor:
+            tokens = self.patch(x).flatten(2).transpose(1, 2)
+            q, k, v = self.qkv(tokens).chunk(3, dim=-1)
+            tokens = tokens + torch.nn.functional.scaled_dot_product_attention(q, k, v)
+            tokens = tokens + self.mlp(self.norm(tokens))
+            return tokens.mean(1)
+
+    torch.manual_seed(0)
+    return TinyViT().eval()
+
+
+def test_float32_wrapper_matches_eager():
+    net = small_vit()
+    x = torch.randn(4, 3, 64, 64)
+    expected = _compute_embeddings(x, net)
+    wrapped = _compute_embeddings(x, _InferenceWrapper(net, "cpu", "float32", False))
+    np.testing.assert_allclose(wrapped, expected, atol=1e-5)
+
+
+@pytest.mark.skipif(not bf16_supported("cpu"), reason="no native bfloat16")
+def test_bfloat16_drift_is_small():
+    net = small_vit()
+    x = torch.randn(8, 3, 64, 64)
+    expected = _compute_embeddings(x, net)
+    bf16 = _compute_embeddings(x, _InferenceWrapper(net, "cpu", "bfloat16", False))
+    assert bf16.dtype == np.float32
+    cosine = (expected * bf16).sum(axis=1)
+    assert cosine.min() > 0.99
+
+
+def test_failed_compile_falls_back_to_eager(monkeypatch):
+    net = small_vit()
+    wrapper = _InferenceWrapper(net, "cpu", "float32", False)
+
+    def broken(x):
+        raise RuntimeError("no compiler")
+
+    wrapper._compiled = broken
+    x = torch.randn(2, 3, 64, 64)
+    np.testing.assert_allclose(
+        _compute_embeddings(x, wrapper), _compute_embeddings(x, net), atol=1e-5
+    )
+    assert wrapper._compiled is None
+
+
+def test_input_size_sees_through_wrapper():
+    model = (_InferenceWrapper(small_vit(), "cpu", "bfloat16", False), None, "cpu")
+    assert get_input_size(model) == 224  # type: ignore[arg-type]
@@ -1,7 +1,9 @@
+import numpy as np
 import pytest
 from pathlib import Path
+from PIL import Image, ImageDraw
 
-from vism.images import find_images_recursive
+from vism.images import find_images_recursive, load_image, resolve_queries, scan_images
 
 
 SUPPORTED_EXTENSIONS = ["jpg", "jpeg", "png", "webp", "bmp", "tiff"]
@@ -75,3 +77,149 @@ def test_raises_on_non_directory(tmp_path: Path):
     f.write_bytes(b"x")
     with pytest.raises(NotADirectoryError):
         find_images_recursive(f)
+
+
+# --- scan_images ---
+
+
+def test_scan_returns_stat_results(image_dir: Path):
+    img = touch(image_dir / "a" / "img.jpg")
+    (entry,) = scan_images(image_dir)
+    stat = img.stat()
+    assert entry.path == img
+    assert entry.size == stat.st_size
+    assert entry.mtime_ns == stat.st_mtime_ns
+
+
+@pytest.mark.parametrize("workers", [0, 1, 4])
+def test_scan_serial_and_parallel_agree(image_dir: Path, workers: int):
+    for i in range(3):
+        for j in range(4):
+            touch(image_dir / f"d{i}" / f"sub{j}" / f"img{i}{j}.jpg")
+        touch(image_dir / f"d{i}" / "notes.txt")
+    entries = scan_images(image_dir, workers=workers)
+    assert [e.path for e in entries] == sorted(image_dir.rglob("*.jpg"))
+
+
+def test_scan_does_not_follow_directory_symlinks(image_dir: Path, tmp_path_factory):
+    outside = tmp_path_factory.mktemp("outside")
+    touch(outside / "img.jpg")
+    (image_dir / "link").symlink_to(outside, target_is_directory=True)
+    assert scan_images(image_dir) == []
+
+
+# --- resolve_queries ---
+
+
+def test_resolve_single_image(image_dir: Path):
+    img = touch(image_dir / "q.JPG")
+    assert resolve_queries(img) == [img]
+
+
+def test_resolve_directory(image_dir: Path):
+    touch(image_dir / "q" / "b.png")
+    touch(image_dir / "q" / "a.jpg")
+    touch(image_dir / "q" / "notes.txt")
+    assert resolve_queries(image_dir / "q") == [
+        image_dir / "q" / "a.jpg",
+        image_dir / "q" / "b.png",
+    ]
+
+
+def test_resolve_list_file(image_dir: Path):
+    listing = image_dir / "queries.txt"
+    listing.write_text("# holiday shots\n/photos/a.jpg\n\n  /photos/b c.png  \n")
+    assert resolve_queries(listing) == [Path("/photos/a.jpg"), Path("/photos/b c.png")]
+
+
+def test_resolve_list_file_relative_to_list(image_dir: Path, monkeypatch):
+    listing = image_dir / "lists" / "queries.txt"
+    listing.parent.mkdir()
+    listing.write_text("a.jpg\n../b.png\n")
+    monkeypatch.chdir(image_dir.parent)
+    assert resolve_queries(listing) == [
+        image_dir / "lists" / "a.jpg",
+        image_dir / "lists" / ".." / "b.png",
+    ]
+
+
+# --- load_image reduced decoding ---
+
+
+def make_photo(path: Path, size: tuple[int, int] = (2400, 1600)) -> Path:
+    """Write a smooth synthetic 'photo' with some structure to downscale"""
+    w, h = size
+    x = np.linspace(0, 1, w, dtype=np.float32)
+    y = np.linspace(0, 1, h, dtype=np.float32)[:, None]
+    rgb = np.stack(
+        [
+            np.broadcast_to(x, (h, w)) * 255,
+            np.broadcast_to(y, (h, w)) * 255,
+            (np.sin(x * 12) * np.cos(y * 9) * 0.5 + 0.5) * 255,
+        ],
+        axis=-1,
+    ).astype(np.uint8)
+    img = Image.fromarray(rgb)
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((w // 4, h // 4, w // 2, h // 2), fill=(255, 255, 255))
+    draw.rectangle((w // 2, h // 2, w - w // 8, h - h // 8), fill=(10, 20, 200))
+    img.save(path)
+    return path
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    a = a.ravel().astype(np.float64)
+    b = b.ravel().astype(np.float64)
+    return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def test_full_decode_without_min_size(tmp_path: Path):
+    path = make_photo(tmp_path / "photo.jpg")
+    img = load_image(path).image
+    assert img.size == (2400, 1600)
+    assert img.mode == "RGB"
+
+
+@pytest.mark.parametrize("ext", ["jpg", "png"])
+def test_reduced_decode_keeps_min_size(tmp_path: Path, ext: str):
+    path = make_photo(tmp_path / f"photo.{ext}")
+    img = load_image(path, min_size=224).image
+    assert img.mode == "RGB"
+    assert min(img.size) >= 224
+    assert img.size[0] < 2400
+
+
+def test_reduced_decode_small_image_untouched(tmp_path: Path):
+    path = make_photo(tmp_path / "small.jpg", size=(300, 250))
+    assert load_image(path, min_size=224).image.size == (300, 250)
+
+
+@pytest.mark.parametrize("ext", ["jpg", "png"])
+def test_reduced_decode_matches_full_at_model_input(tmp_path: Path, ext: str):
+    path = make_photo(tmp_path / f"photo.{ext}")
+    full = load_image(path).image.resize((224, 224), Image.Resampling.BILINEAR)
+    fast = load_image(path, min_size=224).image.resize(
+        (224, 224), Image.Resampling.BILINEAR
+    )
+    assert cosine(np.asarray(full), np.asarray(fast)) > 0.999
+
+
+def test_reduced_decode_embedding_within_tolerance(tmp_path: Path):
+    torch = pytest.importorskip("torch")
+    from vism.embeddings import _dinov2_preprocess, encode_images
+
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 16, 7, stride=4),
+        torch.nn.ReLU(),
+        torch.nn.AdaptiveAvgPool2d(4),
+        torch.nn.Flatten(),
+        torch.nn.Linear(256, 64),
+    ).eval()
+    model = (net, _dinov2_preprocess(), "cpu")
+
+    path = make_photo(tmp_path / "photo.jpg")
+    full, fast = encode_images(
+        [load_image(path), load_image(path, min_size=224)], model
+    )
+    assert cosine(full.embedding, fast.embedding) > 0.99
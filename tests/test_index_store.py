@@ -0,0 +1,179 @@
+import os
+import numpy as np
+import pytest
+from pathlib import Path
+
+from vism.index_store import (
+    add_vectors_to_library_index,
+    cache_key_to_id,
+    empty_library_index,
+    load_library_ids,
+    load_library_vectors,
+    remove_from_library_index,
+    save_library_index,
+    search_library_index_batch,
+)
+from vism.search import IndexSpec
+from vism.types import ImageEmbedding
+
+
+def normalized(v: list[float]) -> np.ndarray:
+    a = np.array(v, dtype=np.float32)
+    return a / np.linalg.norm(a)
+
+
+def make_embedding(path: Path, vec: list[float]) -> ImageEmbedding:
+    return ImageEmbedding(path=path, embedding=normalized(vec))
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def add(lib, embs: list[ImageEmbedding], ids: list[int]) -> None:
+    add_vectors_to_library_index(
+        lib, [e.path for e in embs], np.stack([e.embedding for e in embs]), ids
+    )
+
+
+def build(root: Path, vecs: dict[str, list[float]]):
+    lib = empty_library_index(root)
+    embs = [make_embedding(root / name, vec) for name, vec in vecs.items()]
+    add(lib, embs, list(range(1, len(embs) + 1)))
+    return lib
+
+
+def search(lib, query: ImageEmbedding, k: int):
+    return search_library_index_batch(lib, query.embedding.reshape(1, -1), k=k)[0]
+
+
+def reload(root: Path, mmap: bool):
+    lib = load_library_ids("test_model", root)
+    assert lib is not None
+    assert load_library_vectors("test_model", lib, mmap=mmap)
+    return lib
+
+
+def test_cache_key_to_id_is_non_negative_int64():
+    key = "f" * 64
+    assert 0 <= cache_key_to_id(key) < 2**63
+
+
+def test_search_returns_paths(tmp_path: Path):
+    lib = build(tmp_path, {"a.jpg": [1, 0, 0], "b.jpg": [0, 1, 0], "c.jpg": [0, 0, 1]})
+    results = search(lib, make_embedding(tmp_path / "q.jpg", [0, 1, 0]), k=1)
+    assert results[0].path == tmp_path / "b.jpg"
+    assert results[0].score == pytest.approx(1.0, abs=1e-5)
+
+
+def test_missing_index_loads_as_none(tmp_path: Path):
+    assert load_library_ids("test_model", tmp_path) is None
+
+
+@pytest.mark.parametrize("mmap", [True, False])
+def test_save_load_roundtrip(tmp_path: Path, mmap: bool):
+    lib = build(tmp_path, {"a.jpg": [1, 0], "b.jpg": [0, 1]})
+    save_library_index("test_model", lib)
+
+    loaded = reload(tmp_path, mmap=mmap)
+    assert loaded.ntotal == 2
+    assert list(loaded.ids) == [1, 2]
+    results = search(loaded, make_embedding(tmp_path / "q.jpg", [1, 0]), k=2)
+    assert [r.path for r in results] == [tmp_path / "a.jpg", tmp_path / "b.jpg"]
+
+
+def test_indexes_are_keyed_by_root(tmp_path: Path):
+    save_library_index("test_model", build(tmp_path / "one", {"a.jpg": [1, 0]}))
+    assert load_library_ids("test_model", tmp_path / "two") is None
+
+
+def test_remove_and_add_incrementally(tmp_path: Path):
+    lib = build(tmp_path, {"a.jpg": [1, 0, 0], "b.jpg": [0, 1, 0]})
+    save_library_index("test_model", lib)
+
+    lib = reload(tmp_path, mmap=False)
+    remove_from_library_index(lib, np.array([1], dtype=np.int64))
+    add(lib, [make_embedding(tmp_path / "c.jpg", [0, 0, 1])], [3])
+    save_library_index("test_model", lib)
+
+    lib = reload(tmp_path, mmap=True)
+    assert sorted(lib.ids) == [2, 3]
+    results = search(lib, make_embedding(tmp_path / "q.jpg", [1, 0, 0]), k=3)
+    assert {r.path for r in results} == {tmp_path / "b.jpg", tmp_path / "c.jpg"}
+
+
+def test_interrupted_save_never_pairs_new_meta_with_old_data(
+    tmp_path: Path, monkeypatch
+):
+    save_library_index("test_model", build(tmp_path, {"a.jpg": [1, 0]}))
+    lib = empty_library_index(tmp_path, IndexSpec(index_type="hnsw"))
+    embs = [make_embedding(tmp_path / n, [1, i]) for i, n in enumerate("bcd")]
+    add(lib, embs, [2, 3, 4])
+
+    replace = os.replace
+
+    def crash_before_ids(src, dst):
+        if str(dst).endswith(".ids.npy"):
+            raise OSError("crash")
+        replace(src, dst)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", crash_before_ids)
+        with pytest.raises(OSError):
+            save_library_index("test_model", lib)
+
+    # the new meta is already in place, but it no longer matches the old ids
+    assert load_library_ids("test_model", tmp_path) is None
+    save_library_index("test_model", lib)
+    assert reload(tmp_path, mmap=False).spec == IndexSpec(index_type="hnsw")
+
+
+def test_removing_everything_deletes_index(tmp_path: Path):
+    lib = build(tmp_path, {"a.jpg": [1, 0]})
+    save_library_index("test_model", lib)
+    remove_from_library_index(lib, np.array([1], dtype=np.int64))
+    save_library_index("test_model", lib)
+    assert load_library_ids("test_model", tmp_path) is None
+
+
+def test_clear_cache_drops_indexes(tmp_path: Path):
+    from vism.cache import cache_embeddings, clear_cache
+
+    img = tmp_path / "a.jpg"
+    img.write_bytes(b"x")
+    cache_embeddings([make_embedding(img, [1, 0])], "test_model")
+    save_library_index("test_model", build(tmp_path, {"a.jpg": [1, 0]}))
+
+    clear_cache(model_name="test_model")
+    assert load_library_ids("test_model", tmp_path) is None
+
+
+def test_ivf_index_supports_incremental_remove(tmp_path: Path):
+    rng = np.random.default_rng(0)
+    lib = empty_library_index(tmp_path, IndexSpec(index_type="ivf-flat", nlist=4))
+    vecs = rng.normal(size=(400, 8)).astype(np.float32)
+    embs = [
+        ImageEmbedding(path=tmp_path / f"{i}.jpg", embedding=v / np.linalg.norm(v))
+        for i, v in enumerate(vecs)
+    ]
+    add(lib, embs, list(range(400)))
+    assert lib.spec.index_type == "ivf-flat"
+    save_library_index("test_model", lib)
+
+    lib = reload(tmp_path, mmap=False)
+    assert lib.spec == IndexSpec(index_type="ivf-flat", nlist=4)
+    assert remove_from_library_index(lib, np.arange(100, dtype=np.int64))
+    assert lib.ntotal == 300
+
+
+def test_hnsw_index_reports_unsupported_remove(tmp_path: Path):
+    lib = empty_library_index(tmp_path, IndexSpec(index_type="hnsw"))
+    add(
+        lib, [make_embedding(tmp_path / "a.jpg", [1, 0])], [1]
+    )
+    assert not remove_from_library_index(lib, np.array([1], dtype=np.int64))
+    assert lib.ntotal == 1
@@ -0,0 +1,142 @@
+import json
+import sys
+import numpy as np
+import pytest
+import torch
+from pathlib import Path
+from PIL import Image
+
+from vism import embeddings, model_store
+from vism.embeddings import _compute_embeddings, _dinov2_preprocess, load_model
+from vism.model_store import (
+    _artifact_files,
+    load_model_artifact,
+    remove_model_artifacts,
+    save_model_artifact,
+    warm_model,
+)
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """Count model builds; the built model is a small conv net"""
+    names = []
+
+    def build(name: str):
+        names.append(name)
+        torch.manual_seed(0)
+        net = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 8, 16, stride=16),
+            torch.nn.Flatten(),
+            torch.nn.LazyLinear(16),
+        )
+        net(torch.zeros(1, 3, 224, 224))
+        return net, _dinov2_preprocess()
+
+    monkeypatch.setattr(embeddings, "_build_model", build)
+    monkeypatch.setattr(model_store, "_build_model", build)
+    return names
+
+
+def test_second_load_uses_artifact(builds):
+    first = load_model("dinov2_vits14")
+    second = load_model("dinov2_vits14")
+    assert builds == ["dinov2_vits14"]
+
+    x = torch.randn(2, 3, 224, 224)
+    np.testing.assert_array_equal(
+        _compute_embeddings(x, first[0]), _compute_embeddings(x, second[0])
+    )
+
+
+def test_artifact_from_other_torch_version_is_rebuilt(builds):
+    load_model("dinov2_vits14")
+    meta_path = _artifact_files("dinov2_vits14")[1]
+    meta = json.loads(meta_path.read_text())
+    meta_path.write_text(json.dumps({**meta, "torch": "0.0.1"}))
+
+    load_model("dinov2_vits14")
+    assert builds == ["dinov2_vits14", "dinov2_vits14"]
+    assert json.loads(meta_path.read_text())["torch"] == torch.__version__
+
+
+def test_corrupt_artifact_is_rebuilt(builds):
+    load_model("dinov2_vits14")
+    _artifact_files("dinov2_vits14")[0].write_bytes(b"garbage")
+    assert load_model_artifact("dinov2_vits14") is None
+    load_model("dinov2_vits14")
+    assert len(builds) == 2
+
+
+def test_warm_builds_once_and_clear_removes(builds):
+    path = warm_model("dinov2_vits14")
+    assert path.exists()
+    warm_model("dinov2_vits14")
+    assert builds == ["dinov2_vits14"]
+    warm_model("dinov2_vits14", force=True)
+    assert len(builds) == 2
+
+    assert remove_model_artifacts() == 1
+    assert not path.exists()
+
+
+def test_hub_code_is_copied_for_offline_loads(tmp_path: Path, monkeypatch):
+    hub_dir = tmp_path / "hub"
+    package_dir = hub_dir / "some_repo_main" / "hubnet"
+    package_dir.mkdir(parents=True)
+    (package_dir / "__init__.py").write_text(
+        "import torch\n"
+        "class HubNet(torch.nn.Module):\n"
+        "    def __init__(self):\n"
+        "        super().__init__()\n"
+        "        self.scale = torch.nn.Parameter(torch.tensor(2.0))\n"
+        "    def forward(self, x):\n"
+        "        return x.flatten(1) * self.scale\n"
+    )
+    monkeypatch.setattr(torch.hub, "get_dir", lambda: str(hub_dir))
+    monkeypatch.syspath_prepend(str(package_dir.parent))
+    import hubnet
+
+    save_model_artifact("dinov2_vits14", hubnet.HubNet())
+
+    # the hub cache disappears, e.g. on an offline machine with a copied cache
+    del sys.modules["hubnet"]
+    sys.path.remove(str(package_dir.parent))
+    for path in sorted(hub_dir.rglob("*"), reverse=True):
+        path.unlink() if path.is_file() else path.rmdir()
+
+    loaded = load_model_artifact("dinov2_vits14")
+    assert loaded is not None
+    assert loaded[0](torch.ones(1, 2)).tolist() == [[2.0, 2.0]]
+
+
+def test_clip_artifact_keeps_transform(tmp_path: Path):
+    open_clip = pytest.importorskip("open_clip")
+
+    clip = open_clip.create_model("ViT-B-32", pretrained=None).eval()
+    _, _, expected_preprocess = open_clip.create_model_and_transforms(
+        "ViT-B-32", pretrained=None
+    )
+    save_model_artifact("clip_ViT-B-32_openai", embeddings._ClipWrapper(clip))
+
+    loaded = load_model_artifact("clip_ViT-B-32_openai")
+    assert loaded is not None
+    module, preprocess = loaded
+    img = Image.fromarray(
+        np.random.default_rng(0).integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    )
+    x = preprocess(img).unsqueeze(0)
+    assert torch.equal(x, expected_preprocess(img).unsqueeze(0))
+    np.testing.assert_allclose(
+        _compute_embeddings(x, module),
+        _compute_embeddings(x, embeddings._ClipWrapper(clip)),
+        atol=1e-6,
+    )
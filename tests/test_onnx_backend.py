@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+import torch
+from pathlib import Path
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("onnx")
+
+from vism import embeddings
+from vism.embeddings import _compute_embeddings, get_input_size, load_model
+from vism.onnx_backend import (
+    _OnnxModule,
+    _onnx_files,
+    create_session,
+    export_onnx,
+    quantize_onnx,
+)
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def small_net() -> torch.nn.Module:
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 32, 8, stride=8),
+        torch.nn.GELU(),
+        torch.nn.Flatten(2),
+        torch.nn.AdaptiveAvgPool1d(1),
+        torch.nn.Flatten(),
+        torch.nn.Linear(32, 64),
+        torch.nn.GELU(),
+        torch.nn.Linear(64, 48),
+    ).eval()
+
+
+@pytest.fixture
+def exported(tmp_path: Path):
+    net = small_net()
+    path = tmp_path / "net.onnx"
+    export_onnx(net, 32, path)
+    return net, path
+
+
+def test_onnx_matches_torch(exported):
+    net, path = exported
+    x = torch.randn(5, 3, 32, 32)
+    onnx = _compute_embeddings(x, _OnnxModule(create_session(path), 32))
+    np.testing.assert_allclose(onnx, _compute_embeddings(x, net), atol=1e-5)
+
+
+def test_int8_drift_is_bounded(exported, tmp_path: Path):
+    net, path = exported
+    quantize_onnx(path, tmp_path / "net.int8.onnx")
+    x = torch.randn(16, 3, 32, 32)
+    expected = _compute_embeddings(x, net)
+    quantized = _compute_embeddings(
+        x, _OnnxModule(create_session(tmp_path / "net.int8.onnx", intra_op_threads=1), 32)
+    )
+    assert (expected * quantized).sum(axis=1).min() > 0.98
+
+
+def test_load_model_exports_once(monkeypatch):
+    from vism.embeddings import _dinov2_preprocess
+
+    loads = []
+
+    def fake_torch_model(name: str, **kwargs):
+        loads.append(name)
+        return small_net(), _dinov2_preprocess(), "cpu"
+
+    # export goes through the torch backend
+    monkeypatch.setattr(embeddings, "load_model", fake_torch_model)
+
+    for precision in ("float32", "int8", "int8"):
+        model = load_model("dinov2_vits14", precision=precision, backend="onnx")
+    assert loads == ["dinov2_vits14"]
+    assert all(p.exists() for p in _onnx_files("dinov2_vits14"))
+    assert get_input_size(model) == 224
+    assert _compute_embeddings(torch.randn(2, 3, 224, 224), model[0]).shape == (2, 48)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"backend": "onnx", "precision": "bfloat16"},
+        {"backend": "torch", "precision": "int8"},
+        {"backend": "onnx", "compile": True},
+    ],
+)
+def test_unsupported_option_combinations_are_rejected(kwargs):
+    with pytest.raises(ValueError):
+        load_model("dinov2_vits14", **kwargs)
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import torch
+from pathlib import Path
+from PIL import Image
+
+from vism import batching, model_store
+from vism.core import scan_library
+from vism.embeddings import _dinov2_preprocess, encode_images, load_model
+from vism.images import load_image
+from vism.parallel import (
+    EncodeWorkers,
+    calibrate_worker_batch_size,
+    encode_in_workers,
+    split_cores,
+)
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def test_split_cores_into_even_contiguous_shares():
+    cores = [[0, 8], [1, 9], [2, 10], [3, 11], [4, 12]]
+    assert split_cores(cores, 2) == [cores[:3], cores[3:]]
+    assert split_cores(cores, 5) == [[core] for core in cores]
+    # more workers than cores share them
+    assert split_cores(cores[:2], 3) == [[cores[0]], [cores[1]], [cores[0]]]
+
+
+def test_worker_batch_size_is_calibrated_with_worker_threads(monkeypatch):
+    model_store.save_model_artifact("dinov2_vits14", torch.nn.Flatten())
+    calls = []
+
+    def calibrate(model, processes):
+        calls.append((torch.get_num_threads(), processes))
+        return 96
+
+    monkeypatch.setattr(batching, "calibrate_batch_size", calibrate)
+    threads = torch.get_num_threads()
+    spec = EncodeWorkers("dinov2_vits14", workers=3)
+    assert calibrate_worker_batch_size(spec, 2) == 96
+    # memory is split between the three workers
+    assert calls == [(2, 3)]
+    assert torch.get_num_threads() == threads
+
+
+def test_workers_match_in_process_encoding(tmp_path: Path, monkeypatch):
+    torch.manual_seed(0)
+    net = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, 16, stride=16),
+        torch.nn.AdaptiveAvgPool2d(2),
+        torch.nn.Flatten(),
+        torch.nn.Linear(32, 16),
+    ).eval()
+    builds = []
+    # the parent builds and saves the artifact once; workers only load it
+    monkeypatch.setattr(
+        model_store,
+        "_build_model",
+        lambda name: builds.append(name) or (net, _dinov2_preprocess()),
+    )
+
+    root = tmp_path / "lib"
+    root.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(5):
+        pixels = rng.integers(0, 255, (240, 320, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(root / f"img{i}.png")
+    (root / "broken.png").write_bytes(b"not an image")
+    cache_keys = scan_library(root)
+
+    paths = sorted(cache_keys)
+    workers = EncodeWorkers("dinov2_vits14", workers=2, threads=1)
+    batches = list(encode_in_workers(workers, paths, batch_size=2))
+    assert sum(processed for processed, _, _ in batches) == 6
+    failures = [idx for _, _, failed in batches for idx, _ in failed]
+    assert [paths[i].name for i in failures] == ["broken.png"]
+    assert builds == ["dinov2_vits14"]
+
+    encoded = dict(idx_vector for _, batch, _ in batches for idx_vector in batch)
+    expected = encode_images(
+        [load_image(paths[i]) for i in sorted(encoded)], load_model("dinov2_vits14")
+    )
+    np.testing.assert_allclose(
+        np.stack([encoded[i] for i in sorted(encoded)]),
+        np.stack([e.embedding for e in expected]),
+        atol=1e-5,
+    )
@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from PIL import Image
+
+from vism import phash
+from vism.cache import cache_phashes, clear_cache, load_cached_phashes, prune_cache
+from vism.core import find_library_duplicates, scan_library
+from vism.dupes import _connected_components
+from vism.phash import _BKTree, compute_phash, get_or_compute_phashes, phash_edges
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def smooth_image(seed: int, size: tuple[int, int] = (400, 300)) -> Image.Image:
+    """Blurry random picture, so hashes depend on content rather than noise"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, (6, 8, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize(size, Image.Resampling.BICUBIC)
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def test_resized_recompressed_copy_is_near(tmp_path: Path):
+    smooth_image(0).save(tmp_path / "a.png")
+    smooth_image(0).resize((200, 150)).save(tmp_path / "b.jpg", quality=70)
+    smooth_image(1).save(tmp_path / "c.png")
+
+    a, b, c = (compute_phash(tmp_path / n) for n in ("a.png", "b.jpg", "c.png"))
+    assert hamming(a, b) <= phash.DEFAULT_MAX_DISTANCE
+    assert hamming(a, c) > 16
+
+
+def test_bktree_matches_brute_force():
+    rng = np.random.default_rng(0)
+    base = [int(h) for h in rng.integers(0, 2**63, 50, dtype=np.int64)]
+    # variants of a few bases with up to 2 flipped bits
+    values = base + [
+        b ^ (1 << int(i)) ^ (1 << int(j))
+        for b in base[:10]
+        for i, j in rng.integers(0, 64, (3, 2))
+    ]
+    tree = _BKTree()
+    for i, v in enumerate(values):
+        tree.add(v, i)
+
+    for radius in (0, 2, 6):
+        for i, v in enumerate(values):
+            expected = {
+                (j, hamming(v, w))
+                for j, w in enumerate(values)
+                if hamming(v, w) <= radius
+            }
+            assert set(tree.query(v, radius)) == expected
+
+
+def test_phash_edges_components():
+    a = 0b1111 << 60
+    near_a = a ^ 0b11
+    far = (2**64 - 1) ^ a
+    hashes = [a, far, a, near_a, far]
+    src, dst, sims = phash_edges(hashes, max_distance=2)
+
+    labels = _connected_components(len(hashes), src, dst)
+    assert labels[0] == labels[2] == labels[3]
+    assert labels[1] == labels[4]
+    assert labels[0] != labels[1]
+    assert sims.max() == 1.0
+    assert sims.min() == pytest.approx(1 - 2 / 64)
+
+
+def test_phash_edges_exact_only():
+    src, dst, sims = phash_edges([1, 2, 1, 3], max_distance=0)
+    assert list(zip(src, dst)) == [(0, 2)]
+    assert list(sims) == [1.0]
+
+
+def test_cache_roundtrip_full_width_hashes(tmp_path: Path):
+    f = tmp_path / "a.jpg"
+    f.write_bytes(b"x")
+    cache_phashes({f: 2**64 - 1})
+    assert load_cached_phashes([f]) == {f: 2**64 - 1}
+
+
+def test_changed_file_is_rehashed(tmp_path: Path):
+    f = tmp_path / "a.jpg"
+    f.write_bytes(b"x")
+    cache_phashes({f: 42})
+    f.write_bytes(b"changed")
+    assert load_cached_phashes([f]) == {}
+
+
+def test_get_or_compute_caches_and_skips_broken(tmp_path: Path, monkeypatch):
+    smooth_image(0).save(tmp_path / "a.png")
+    (tmp_path / "broken.jpg").write_bytes(b"nope")
+    paths = [tmp_path / "a.png", tmp_path / "broken.jpg"]
+
+    hashes = get_or_compute_phashes(paths)
+    assert list(hashes) == [tmp_path / "a.png"]
+
+    def fail(path):
+        raise AssertionError("cached hash was recomputed")
+
+    monkeypatch.setattr(phash, "compute_phash", fail)
+    assert get_or_compute_phashes(paths[:1]) == hashes
+
+
+def test_clear_and_prune_all_models_drop_hashes(tmp_path: Path):
+    a, b = tmp_path / "a.jpg", tmp_path / "b.jpg"
+    a.write_bytes(b"a")
+    b.write_bytes(b"b")
+    cache_phashes({a: 1, b: 2})
+
+    b.unlink()
+    prune_cache()
+    assert load_cached_phashes([a]) == {a: 1}
+
+    clear_cache()
+    assert load_cached_phashes([a]) == {}
+
+
+def test_phash_mode_needs_no_model(tmp_path: Path):
+    smooth_image(0).save(tmp_path / "a.png")
+    smooth_image(0).save(tmp_path / "copy.png")
+    smooth_image(0).resize((200, 150)).save(tmp_path / "small.jpg", quality=80)
+    smooth_image(1).save(tmp_path / "other.png")
+
+    def no_model():
+        raise AssertionError("model loaded")
+
+    clusters, recall = find_library_duplicates(
+        scan_library(tmp_path), no_model, "test_model", mode="phash"
+    )
+    assert recall is None
+    assert len(clusters) == 1
+    assert {p.name for p, _ in clusters[0]} == {"a.png", "copy.png", "small.jpg"}
+
+
+def test_both_mode_encodes_one_image_per_hash_group(tmp_path: Path, monkeypatch):
+    from vism import core
+
+    for name, seed in [("a.png", 0), ("a2.png", 0), ("b.png", 1), ("c.png", 2)]:
+        smooth_image(seed).save(tmp_path / name)
+
+    encoded = []
+
+    def fake_matrix(
+        paths, model, model_name, decode_workers=0, cache_keys=None, batch_size=None
+    ):
+        encoded.extend(paths)
+        # b and c are semantic duplicates, a is unrelated
+        vecs = {"a.png": [1, 0], "a2.png": [1, 0], "b.png": [0, 1], "c.png": [0, 1]}
+        return paths, np.array([vecs[p.name] for p in paths], dtype=np.float32)
+
+    monkeypatch.setattr(core, "get_embedding_matrix", fake_matrix)
+    clusters, _ = find_library_duplicates(
+        scan_library(tmp_path), lambda: None, "test_model", mode="both"
+    )
+    assert sorted(p.name for p in encoded) == ["a.png", "b.png", "c.png"]
+    assert sorted(sorted(p.name for p, _ in c) for c in clusters) == [
+        ["a.png", "a2.png"],
+        ["b.png", "c.png"],
+    ]
@@ -0,0 +1,88 @@
+import json
+import threading
+import numpy as np
+import pytest
+from pathlib import Path
+from PIL import Image
+
+from vism import profiling
+from vism.bench import stub_model
+from vism.core import get_embedding_matrix, scan_library
+from vism.profiling import profile, stage
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path: Path, monkeypatch):
+    cache_dir = tmp_path / ".cache" / "vism"
+    cache_dir.mkdir(parents=True)
+    monkeypatch.setenv("VISM_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+def make_library(root: Path, n: int = 6) -> None:
+    root.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        pixels = rng.integers(0, 255, (240, 320, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(root / f"img{i}.png")
+
+
+def test_stages_are_free_when_not_profiling():
+    assert not profiling.enabled()
+    with stage("decode") as s:
+        s.add(items=1, bytes_read=10)
+    assert stage("decode") is stage("inference")
+
+
+def test_pipeline_stages_are_recorded(tmp_path: Path):
+    make_library(tmp_path / "lib")
+    with profile() as prof:
+        cache_keys = scan_library(tmp_path / "lib")
+        get_embedding_matrix(
+            list(cache_keys),
+            stub_model(),
+            "test_model",
+            decode_workers=2,
+            cache_keys=cache_keys,
+        )
+    assert not profiling.enabled()
+
+    stats = {s.name: s for s in prof.stats()}
+    expected = {"scan", "cache_keys", "decode", "preprocess", "inference", "cache_write"}
+    assert expected <= set(stats)
+    assert stats["decode"].calls == 6 and stats["decode"].items == 6
+    total_size = sum(p.stat().st_size for p in (tmp_path / "lib").iterdir())
+    assert 0 < stats["decode"].bytes_read <= total_size
+    assert stats["inference"].items == 6
+    assert all(s.wall >= 0 and s.cpu >= 0 for s in stats.values())
+    assert stats["scan"].peak_rss > 0
+    # decoding ran on the worker threads
+    decode_threads = {e.thread for e in prof.events if e.name == "decode"}
+    assert threading.get_ident() not in decode_threads
+    assert "decode" in prof.summary()
+
+
+def test_profile_files(tmp_path: Path):
+    with profile() as prof:
+        with stage("outer", items=2):
+            with stage("inner") as s:
+                s.add(items=3, bytes_read=100)
+
+    prof.write_json(tmp_path / "profile.json")
+    totals = json.loads((tmp_path / "profile.json").read_text())
+    assert [s["name"] for s in totals["stages"]] == ["outer", "inner"]
+    assert totals["stages"][1]["bytes_read"] == 100
+
+    prof.write_chrome_trace(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    outer, inner = sorted(events, key=lambda e: e["ts"])
+    assert outer["ph"] == inner["ph"] == "X"
+    assert outer["ts"] <= inner["ts"] and inner["dur"] <= outer["dur"]
+    assert inner["args"]["items"] == 3
+
+
+def test_only_one_profiler_at_a_time():
+    with profile():
+        with pytest.raises(RuntimeError):
+            profiling.start()
+    assert profiling.stop() is None
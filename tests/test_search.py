@@ -1,58 +1,98 @@
+import faiss
 import numpy as np
 import pytest
-from pathlib import Path
 
-from vism.search import build_index, search_items
-from vism.types import ImageEmbedding
+from vism.search import (
+    IndexSpec,
+    create_index,
+    estimate_recall,
+    set_search_params,
+)
 
 
-def normalized(v: list[float]) -> np.ndarray:
-    a = np.array(v, dtype=np.float32)
-    return a / np.linalg.norm(a)
+# --- create_index / set_search_params / estimate_recall ---
 
 
-def make_embedding(path: Path, vec: list[float]) -> ImageEmbedding:
-    return ImageEmbedding(path=path, embedding=normalized(vec))
+def clustered_vectors(n: int = 2000, d: int = 32) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(20, d))
+    x = centers[rng.integers(0, 20, n)] + 0.3 * rng.normal(size=(n, d))
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x.astype(np.float32)
 
 
-def test_top_result_is_identical_vector(tmp_path: Path):
-    embs = [
-        make_embedding(tmp_path / "a.jpg", [1.0, 0.0, 0.0]),
-        make_embedding(tmp_path / "b.jpg", [0.0, 1.0, 0.0]),
-        make_embedding(tmp_path / "c.jpg", [0.0, 0.0, 1.0]),
-    ]
-    index = build_index(embs)
-    query = make_embedding(tmp_path / "q.jpg", [1.0, 0.0, 0.0])
-    results = search_items(index, query, embs, k=1)
+@pytest.mark.parametrize(
+    "spec",
+    [
+        IndexSpec(),
+        IndexSpec(index_type="hnsw", hnsw_m=16),
+        IndexSpec(index_type="ivf-flat"),
+        IndexSpec(index_type="ivf-pq", nlist=4, pq_m=4),
+    ],
+)
+def test_create_index_types_find_self(spec: IndexSpec):
+    vectors = clustered_vectors(n=300, d=16)
+    ids = np.arange(len(vectors), dtype=np.int64) + 1000
+    index, built = create_index(vectors, spec)
+    assert built == spec
+    index.add_with_ids(vectors, ids)
+    set_search_params(index, nprobe=16, ef_search=64)
 
-    assert len(results) == 1
-    assert results[0].path == tmp_path / "a.jpg"
-    assert results[0].score == pytest.approx(1.0, abs=1e-5)
+    # PQ codes are lossy, so only require each vector among its own top 10
+    _, found = index.search(vectors[:50], 10)
+    assert np.mean([i in row for i, row in zip(ids[:50], found)]) > 0.9
 
 
-def test_results_sorted_by_score_desc(tmp_path: Path):
-    embs = [
-        make_embedding(tmp_path / "a.jpg", [1.0, 0.0]),
-        make_embedding(tmp_path / "b.jpg", [1.0, 0.5]),
-        make_embedding(tmp_path / "c.jpg", [0.0, 1.0]),
-    ]
-    index = build_index(embs)
-    query = make_embedding(tmp_path / "q.jpg", [1.0, 0.0])
-    results = search_items(index, query, embs, k=3)
+def test_create_index_falls_back_to_flat_when_untrainable():
+    vectors = clustered_vectors(n=100)
+    index, built = create_index(vectors, IndexSpec(index_type="ivf-pq"))
+    assert built == IndexSpec()
+    assert index.is_trained
 
-    scores = [r.score for r in results]
-    assert scores == sorted(scores, reverse=True)
 
+def test_set_search_params_ignores_inapplicable():
+    vectors = clustered_vectors(n=500)
+    ids = np.arange(len(vectors), dtype=np.int64)
 
-def test_k_limits_results(tmp_path: Path):
-    embs = [make_embedding(tmp_path / f"img{i}.jpg", [float(i), 1.0]) for i in range(10)]
-    index = build_index(embs)
-    query = make_embedding(tmp_path / "q.jpg", [1.0, 1.0])
-    results = search_items(index, query, embs, k=3)
-    assert len(results) == 3
+    flat, _ = create_index(vectors, IndexSpec())
+    flat.add_with_ids(vectors, ids)
+    before = flat.search(vectors[:10], 5)
+    set_search_params(flat, nprobe=8, ef_search=32)
+    after = flat.search(vectors[:10], 5)
+    np.testing.assert_array_equal(before[1], after[1])
+    np.testing.assert_array_equal(before[0], after[0])
 
+    index, _ = create_index(vectors, IndexSpec(index_type="hnsw"))
+    hnsw = faiss.downcast_index(index.index).hnsw
+    ef_search = hnsw.efSearch
+    set_search_params(index, nprobe=8)
+    assert hnsw.efSearch == ef_search
+    set_search_params(index, ef_search=ef_search + 1)
+    assert hnsw.efSearch == ef_search + 1
 
-def test_index_total_matches_embeddings(tmp_path: Path):
-    embs = [make_embedding(tmp_path / f"img{i}.jpg", [float(i), 1.0]) for i in range(5)]
-    index = build_index(embs)
-    assert index.ntotal == 5
+    index, _ = create_index(vectors, IndexSpec(index_type="ivf-flat", nlist=4))
+    nprobe = faiss.extract_index_ivf(index).nprobe
+    set_search_params(index, ef_search=32)
+    assert faiss.extract_index_ivf(index).nprobe == nprobe
+
+
+def test_estimate_recall_exact_index_is_perfect():
+    vectors = clustered_vectors(n=500)
+    ids = np.arange(len(vectors), dtype=np.int64)
+    index, _ = create_index(vectors, IndexSpec())
+    index.add_with_ids(vectors, ids)
+    assert estimate_recall(index, vectors, ids, k=10, sample=100) == pytest.approx(1.0)
+
+
+def test_estimate_recall_grows_with_nprobe():
+    vectors = clustered_vectors()
+    ids = np.arange(len(vectors), dtype=np.int64)
+    index, _ = create_index(vectors, IndexSpec(index_type="ivf-flat", nlist=32))
+    index.add_with_ids(vectors, ids)
+
+    set_search_params(index, nprobe=1)
+    low = estimate_recall(index, vectors, ids, k=10, sample=200)
+    set_search_params(index, nprobe=32)
+    high = estimate_recall(index, vectors, ids, k=10, sample=200)
+    assert high == pytest.approx(1.0)
+    assert low <= high
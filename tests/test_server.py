@@ -0,0 +1,127 @@
+import threading
+import time
+import pytest
+from pathlib import Path
+
+from vism import server
+from vism.server import (
+    DaemonError,
+    query_result_from_dict,
+    query_result_to_dict,
+    request,
+)
+from vism.types import QueryResult, SearchResult
+
+
+@pytest.fixture
+def socket_path(tmp_path: Path, monkeypatch) -> Path:
+    path = tmp_path / "vism.sock"
+    monkeypatch.setenv("VISM_SOCKET", str(path))
+    return path
+
+
+@pytest.fixture
+def running_server(socket_path: Path, monkeypatch):
+    def echo(state, req):
+        for i in range(req["n"]):
+            yield {"i": i}
+
+    def fail(state, req):
+        raise ValueError("boom")
+        yield
+
+    def query_errors(state, req):
+        yield {"text": "red bicycle", "error": "no text encoder"}
+        yield {"query": "/q.jpg", "error": "unreadable"}
+
+    monkeypatch.setitem(server._HANDLERS, "echo", echo)
+    monkeypatch.setitem(server._HANDLERS, "query_errors", query_errors)
+    monkeypatch.setitem(server._HANDLERS, "fail", fail)
+
+    srv = server._Server(socket_path, server._State(refresh=0))
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_query_result_roundtrip():
+    result = QueryResult(
+        query=Path("/q.jpg"),
+        results=[SearchResult(path=Path("/a.jpg"), score=0.5)],
+    )
+    assert query_result_from_dict(query_result_to_dict(result)) == result
+
+
+def test_query_error_roundtrip():
+    result = QueryResult(query=Path("/q.jpg"), results=[], error="unreadable")
+    assert query_result_from_dict(query_result_to_dict(result)) == result
+
+
+def test_progressive_query_result_roundtrip():
+    result = QueryResult(query=Path("/q.jpg"), results=[], skipped=7, final=False)
+    record = query_result_to_dict(result)
+    assert record["skipped"] == 7 and record["final"] is False
+    assert query_result_from_dict(record) == result
+
+
+def test_text_query_result_roundtrip():
+    result = QueryResult(query="red bicycle", results=[], skipped=3)
+    record = query_result_to_dict(result)
+    assert record["text"] == "red bicycle" and "query" not in record
+    assert query_result_from_dict(record) == result
+
+
+def test_request_without_daemon_returns_none(socket_path: Path):
+    assert request({"command": "echo", "n": 1}) is None
+
+
+def test_request_with_stale_socket_returns_none(socket_path: Path):
+    socket_path.touch()
+    assert request({"command": "echo", "n": 1}) is None
+
+
+def test_request_streams_responses(running_server):
+    responses = request({"command": "echo", "n": 3})
+    assert responses is not None
+    assert list(responses) == [{"i": 0}, {"i": 1}, {"i": 2}]
+
+
+def test_request_raises_daemon_errors(running_server):
+    responses = request({"command": "fail"})
+    assert responses is not None
+    with pytest.raises(DaemonError, match="boom"):
+        list(responses)
+
+
+def test_query_errors_do_not_end_the_stream(running_server):
+    responses = request({"command": "query_errors"})
+    assert responses is not None
+    assert [r["error"] for r in responses] == ["no text encoder", "unreadable"]
+
+
+def test_unknown_command_is_rejected(running_server):
+    responses = request({"command": "nope"})
+    assert responses is not None
+    with pytest.raises(DaemonError, match="bad request"):
+        list(responses)
+
+
+def test_serve_refuses_second_daemon(running_server, socket_path: Path):
+    with pytest.raises(RuntimeError, match="already listening"):
+        server.serve(socket_path=socket_path)
+
+
+def test_serve_replaces_stale_socket(socket_path: Path):
+    socket_path.touch()
+    thread = threading.Thread(
+        target=server.serve, kwargs={"socket_path": socket_path}, daemon=True
+    )
+    thread.start()
+    for _ in range(50):
+        if request({"command": "nope"}) is not None:
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("daemon did not come up")
@@ -0,0 +1,262 @@
+"""
+Inference batch sizes
+
+The fastest batch size depends on the model (ViT-S vs ViT-g), the device and
+free memory, so unless one is given it is picked by a short calibration run
+on synthetic input: starting from MIN_BATCH_SIZE the size doubles while
+throughput keeps improving and the memory the next size would need stays
+under a share of what is free. Batches that still fail to allocate are split
+in half and retried by BatchEncoder, which keeps the smaller size from then on.
+"""
+
+import gc
+import logging
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, List, Optional
+
+from .profiling import stage
+
+if TYPE_CHECKING:
+    import torch
+
+    from .embeddings import Model
+    from .types import ImageEmbedding
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 64
+MIN_BATCH_SIZE = 8
+MAX_BATCH_SIZE = 512
+# Share of free memory a batch may use
+MEMORY_FRACTION = 0.5
+# Runs encoding fewer images use DEFAULT_BATCH_SIZE instead of calibrating
+CALIBRATION_MIN_IMAGES = 1024
+# Calibration stops growing the batch once it has taken this long
+CALIBRATION_SECONDS = 15.0
+# Doubling the batch has to improve images/s at least this much
+MIN_SPEEDUP = 1.05
+
+# calibrated sizes per model, for the daemon and repeated runs in one process
+_calibrated: "weakref.WeakKeyDictionary[object, int]" = weakref.WeakKeyDictionary()
+
+
+def is_out_of_memory(e: BaseException) -> bool:
+    """Whether e is an allocation failure (torch, CUDA or ONNX Runtime)"""
+    if isinstance(e, MemoryError):
+        return True
+    message = str(e).lower()
+    return any(
+        fragment in message
+        for fragment in ("out of memory", "failed to allocate", "bad_alloc")
+    )
+
+
+def free_memory(device: str) -> Optional[int]:
+    """Bytes free on device (available RAM for the CPU), or None if unknown"""
+    if device.startswith("cuda"):
+        import torch
+
+        return torch.cuda.mem_get_info()[0]
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _rss() -> Optional[int]:
+    """Resident set size of the process in bytes, or None where /proc is missing"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+class _PeakMemory:
+    """
+    Memory the block needs on device at its peak, beyond what was in use before
+
+    CUDA tracks its peak allocation. On the CPU the process's lifetime peak
+    (ru_maxrss) can't be reset, so the resident set size is sampled from a
+    background thread instead; `used` is None where it can't be read.
+    """
+
+    SAMPLE_INTERVAL = 0.002
+
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self.used: Optional[int] = None
+        self._start: Optional[int] = None
+        self._peak = 0
+        self._done = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._done.wait(self.SAMPLE_INTERVAL):
+            self._peak = max(self._peak, _rss() or 0)
+
+    def __enter__(self) -> "_PeakMemory":
+        if self.device.startswith("cuda"):
+            import torch
+
+            torch.cuda.reset_peak_memory_stats()
+            self._start = torch.cuda.memory_allocated()
+            return self
+        self._start = _rss()
+        if self._start is not None:
+            self._peak = self._start
+            self._sampler = threading.Thread(
+                target=self._sample, name="vism-memory", daemon=True
+            )
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        if self.device.startswith("cuda"):
+            import torch
+
+            self._peak = torch.cuda.max_memory_allocated()
+        elif self._sampler is not None:
+            self._peak = max(self._peak, _rss() or 0)
+            self._done.set()
+            self._sampler.join()
+        if self._start is not None:
+            self.used = max(self._peak - self._start, 0)
+
+
+def _release_memory(device: str) -> None:
+    gc.collect()
+    if device.startswith("cuda"):
+        import torch
+
+        torch.cuda.empty_cache()
+
+
+def calibrate_batch_size(
+    model: "Model", max_size: int = MAX_BATCH_SIZE, processes: int = 1
+) -> int:
+    """
+    The batch size with the best images/s for model, found by encoding
+    synthetic batches of doubling size
+
+    processes is the number of processes that will run batches of this size
+    at once, sharing the free memory.
+    """
+    import torch
+
+    from .embeddings import encode_preprocessed, get_input_size
+
+    _, _, device = model
+    input_size = get_input_size(model)
+    sample = torch.rand(3, input_size, input_size)
+    free = free_memory(device)
+    budget = free * MEMORY_FRACTION / processes if free is not None else None
+
+    def run(size: int) -> float:
+        start = time.perf_counter()
+        encode_preprocessed([Path()] * size, [sample] * size, model)
+        return time.perf_counter() - start
+
+    best_size, best_rate = MIN_BATCH_SIZE, 0.0
+    size = MIN_BATCH_SIZE
+    started = time.perf_counter()
+    with stage("batch_calibration"):
+        try:
+            run(size)  # warm-up
+        except Exception as e:
+            if not is_out_of_memory(e):
+                raise
+            _release_memory(device)
+            return 1
+        while size <= max_size:
+            try:
+                with _PeakMemory(device) as memory:
+                    seconds = min(run(size), run(size))
+            except Exception as e:
+                if not is_out_of_memory(e):
+                    raise
+                _release_memory(device)
+                break
+            batch_memory = memory.used
+            rate = size / seconds
+            logger.debug(
+                f"Batch size {size}: {rate:.1f} images/s"
+                + (f", ~{batch_memory / 1e6:.0f} MB" if batch_memory is not None else "")
+            )
+            if rate < best_rate * MIN_SPEEDUP:
+                break
+            best_size, best_rate = size, rate
+            elapsed = time.perf_counter() - started
+            if (
+                (
+                    budget is not None
+                    and batch_memory is not None
+                    and 2 * batch_memory > budget
+                )
+                or elapsed + 4 * seconds > CALIBRATION_SECONDS
+            ):
+                break
+            size *= 2
+    logger.info(f"Using batch size {best_size} ({best_rate:.1f} images/s)")
+    return best_size
+
+
+def choose_batch_size(model: "Model", n_images: int) -> int:
+    """Calibrated batch size for model, or the default for small runs"""
+    if n_images < CALIBRATION_MIN_IMAGES:
+        return DEFAULT_BATCH_SIZE
+    module = model[0]
+    try:
+        return _calibrated[module]
+    except (KeyError, TypeError):
+        pass
+    size = calibrate_batch_size(model)
+    try:
+        _calibrated[module] = size
+    except TypeError:
+        pass
+    return size
+
+
+class BatchEncoder:
+    """Encodes batches in chunks of at most size images, halving size on allocation failures"""
+
+    def __init__(self, model: "Model", size: int) -> None:
+        self.model = model
+        self.size = size
+
+    def encode(
+        self, paths: List[Path], tensors: List["torch.Tensor"]
+    ) -> List["ImageEmbedding"]:
+        from .embeddings import encode_preprocessed
+
+        embeddings: List["ImageEmbedding"] = []
+        start = 0
+        while start < len(tensors):
+            end = start + self.size
+            try:
+                embeddings += encode_preprocessed(
+                    paths[start:end], tensors[start:end], self.model
+                )
+            except Exception as e:
+                if not is_out_of_memory(e) or self.size == 1:
+                    raise
+                self.size //= 2
+                logger.warning(
+                    f"Out of memory encoding a batch, retrying with batch size {self.size}"
+                )
+                _release_memory(self.model[2])
+                continue
+            start = end
+        return embeddings
@@ -0,0 +1,327 @@
+"""
+Throughput benchmarks on synthetic libraries, without downloading a model
+
+run_benchmark times each pipeline stage on a generated image tree, using a
+throwaway cache dir, and returns per-stage results that `vism bench` writes
+as JSON. Comparing that JSON across commits (compare_results) catches
+regressions. The default stub model costs almost nothing to run, so the
+stages around inference dominate; "tiny" is a small conv net, and any real
+model name works too.
+"""
+
+import json
+import os
+import platform
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+if TYPE_CHECKING:
+    from .embeddings import Model
+
+# Stages in the order run_benchmark runs them
+STAGES = (
+    "scan",
+    "cache_keys",
+    "decode",
+    "preprocess",
+    "inference",
+    "cache_write",
+    "cache_lookup",
+    "index_build",
+    "search",
+    "dupes",
+    "index_e2e",
+)
+BENCH_MODELS = ("stub", "tiny")
+BENCH_FORMATS = ("jpg", "png", "webp")
+# Images per generated directory
+IMAGES_PER_DIR = 200
+# Every DUPLICATE_EVERY-th image is a recompressed, resized copy of the previous one
+DUPLICATE_EVERY = 10
+
+
+@dataclass(frozen=True)
+class StageResult:
+    seconds: float
+    items: int
+
+    @property
+    def per_second(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else float("inf")
+
+
+def _synthetic_image(rng: np.random.Generator, size: Tuple[int, int]) -> Image.Image:
+    """Smooth random picture with some noise, so it compresses like a photo"""
+    small = Image.fromarray(rng.integers(0, 255, (12, 16, 3), dtype=np.uint8))
+    pixels = np.asarray(small.resize(size, Image.Resampling.BICUBIC), dtype=np.int16)
+    pixels = pixels + rng.normal(0, 8, pixels.shape).astype(np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_synthetic_library(
+    root: Path,
+    n_images: int,
+    formats: Tuple[str, ...] = ("jpg",),
+    size: Tuple[int, int] = (640, 480),
+    seed: int = 0,
+) -> List[Path]:
+    """
+    Write n_images synthetic images under root, IMAGES_PER_DIR per
+    subdirectory, cycling through formats; returns their paths
+    """
+    rng = np.random.default_rng(seed)
+    paths = []
+    img = None
+    for i in range(n_images):
+        directory = root / f"dir{i // IMAGES_PER_DIR:04d}"
+        directory.mkdir(parents=True, exist_ok=True)
+        path = directory / f"img{i:06d}.{formats[i % len(formats)]}"
+        if img is not None and i % DUPLICATE_EVERY == DUPLICATE_EVERY - 1:
+            img = img.resize((size[0] * 3 // 4, size[1] * 3 // 4))
+        else:
+            img = _synthetic_image(rng, size)
+        if path.suffix == ".jpg":
+            img.save(path, quality=85)
+        else:
+            img.save(path)
+        paths.append(path)
+    return paths
+
+
+def stub_model(kind: str = "stub", dim: int = 384) -> "Model":
+    """
+    A model for benchmarks that needs no weights, with the DINOv2 preprocessing
+
+    "stub" pools the image to 8x8 and projects it, so inference is nearly
+    free; "tiny" is a small strided conv net.
+    """
+    import torch
+    from .embeddings import _dinov2_preprocess
+
+    torch.manual_seed(0)
+    if kind == "stub":
+        net = torch.nn.Sequential(
+            torch.nn.AdaptiveAvgPool2d(8),
+            torch.nn.Flatten(),
+            torch.nn.Linear(3 * 8 * 8, dim),
+        )
+    elif kind == "tiny":
+        net = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 32, 8, stride=8),
+            torch.nn.GELU(),
+            torch.nn.Conv2d(32, 64, 3, stride=2),
+            torch.nn.GELU(),
+            torch.nn.AdaptiveAvgPool2d(1),
+            torch.nn.Flatten(),
+            torch.nn.Linear(64, dim),
+        )
+    else:
+        raise ValueError(f"Unknown benchmark model '{kind}'")
+    return net.eval(), _dinov2_preprocess(), "cpu"
+
+
+@contextmanager
+def _temporary_cache_dir() -> Iterator[Path]:
+    """Point the vism cache at a fresh directory for the duration"""
+    previous = os.environ.get("VISM_CACHE_DIR")
+    with tempfile.TemporaryDirectory(prefix="vism-bench-") as tmp:
+        os.environ["VISM_CACHE_DIR"] = tmp
+        try:
+            yield Path(tmp)
+        finally:
+            if previous is None:
+                del os.environ["VISM_CACHE_DIR"]
+            else:
+                os.environ["VISM_CACHE_DIR"] = previous
+
+
+class _Timer:
+    """Accumulates time and items per stage across batches"""
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = {}
+        self.items: Dict[str, int] = {}
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            self.items[name] = self.items.get(name, 0) + items
+
+    def results(self) -> Dict[str, StageResult]:
+        return {
+            name: StageResult(seconds=self.seconds[name], items=self.items[name])
+            for name in STAGES
+            if name in self.seconds
+        }
+
+
+def run_benchmark(
+    root: Path,
+    model: "Model",
+    batch_size: int = 64,
+    queries: int = 100,
+    threshold: float = 0.95,
+    decode_workers: int = 0,
+) -> Dict[str, StageResult]:
+    """
+    Time every stage of indexing, searching and finding duplicates in root
+
+    decode, preprocess, inference and cache_write run batch by batch as in
+    the pipeline, with decoding inline so each stage is timed on its own;
+    index_e2e then indexes root from scratch through get_library_index with
+    decode_workers. Runs in a temporary cache dir.
+    """
+    from .cache import CacheSession, cache_keys_for_entries
+    from .core import get_library_index
+    from .dupes import clusters_from_edges, duplicate_edges
+    from .embeddings import encode_preprocessed, get_input_size, preprocess_image
+    from .images import load_image, scan_images
+    from .index_store import (
+        add_vectors_to_library_index,
+        cache_key_to_id,
+        empty_library_index,
+        search_library_index_batch,
+    )
+
+    timer = _Timer()
+    with _temporary_cache_dir():
+        with timer.stage("scan"):
+            entries = scan_images(root)
+        timer.items["scan"] = len(entries)
+        with timer.stage("cache_keys", items=len(entries)):
+            cache_keys = cache_keys_for_entries(entries)
+        paths = list(cache_keys)
+
+        min_size = get_input_size(model)
+        with CacheSession("bench") as cache:
+            for start in range(0, len(paths), batch_size):
+                batch = paths[start : start + batch_size]
+                with timer.stage("decode", items=len(batch)):
+                    images = [load_image(p, min_size=min_size) for p in batch]
+                with timer.stage("preprocess", items=len(batch)):
+                    tensors = [preprocess_image(img, model) for img in images]
+                with timer.stage("inference", items=len(batch)):
+                    embeddings = encode_preprocessed(batch, tensors, model)
+                with timer.stage("cache_write", items=len(batch)):
+                    cache.cache_embeddings(embeddings, cache_keys)
+
+        with timer.stage("cache_lookup", items=len(paths)):
+            with CacheSession("bench") as cache:
+                found, matrix = cache.load_embedding_matrix(paths, cache_keys)
+                matrix = np.array(matrix)
+
+        with timer.stage("index_build", items=len(found)):
+            lib = empty_library_index(root)
+            add_vectors_to_library_index(
+                lib, found, matrix, [cache_key_to_id(cache_keys[p]) for p in found]
+            )
+
+        query_vectors = matrix[:queries]
+        with timer.stage("search", items=len(query_vectors)):
+            search_library_index_batch(lib, query_vectors, k=10)
+
+        with timer.stage("dupes", items=len(found)):
+            clusters_from_edges(found, *duplicate_edges(matrix, threshold))
+
+        with timer.stage("index_e2e", items=len(paths)):
+            get_library_index(
+                root,
+                paths,
+                model,
+                "bench-e2e",
+                decode_workers=decode_workers,
+                cache_keys=cache_keys_for_entries(scan_images(root)),
+            )
+    return timer.results()
+
+
+def environment() -> Dict[str, Any]:
+    """Versions and hardware a benchmark ran on, to tell apart incomparable runs"""
+    import faiss
+    import torch
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        vism_version = version("vism")
+    except PackageNotFoundError:
+        vism_version = None
+    return {
+        "vism": vism_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "faiss": faiss.__version__,
+    }
+
+
+def results_to_dict(results: Dict[str, StageResult]) -> Dict[str, Any]:
+    return {
+        name: {
+            "seconds": round(result.seconds, 6),
+            "items": result.items,
+            "per_second": round(result.per_second, 3),
+        }
+        for name, result in results.items()
+    }
+
+
+def best_of(runs: List[Dict[str, StageResult]]) -> Dict[str, StageResult]:
+    """Fastest result per stage over repeated runs"""
+    return {
+        name: min((run[name] for run in runs), key=lambda r: r.seconds)
+        for name in runs[0]
+    }
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.2
+) -> List[Tuple[int, str, float, float, bool]]:
+    """
+    Compare two `vism bench` JSON reports run by run (matched on image count)
+
+    Returns (images, stage, baseline items/s, current items/s, regressed)
+    rows; a stage regressed if its throughput dropped by more than tolerance.
+    """
+    rows = []
+    baseline_runs = {run["images"]: run["stages"] for run in baseline["runs"]}
+    for run in current["runs"]:
+        stages = baseline_runs.get(run["images"])
+        if stages is None:
+            continue
+        for name, result in run["stages"].items():
+            if name not in stages:
+                continue
+            before = stages[name]["per_second"]
+            after = result["per_second"]
+            regressed = after < before * (1 - tolerance)
+            rows.append((run["images"], name, before, after, regressed))
+    return rows
+
+
+def load_report(path: Path) -> Dict[str, Any]:
+    with open(path) as f:
+        report = json.load(f)
+    if "runs" not in report:
+        raise ValueError(f"{path} is not a vism bench report")
+    return report
+
+
+def format_results(images: int, results: Dict[str, StageResult]) -> str:
+    lines = [f"{images} images", f"  {'stage':<14}{'seconds':>10}{'items/s':>12}"]
+    for name, result in results.items():
+        lines.append(f"  {name:<14}{result.seconds:>10.3f}{result.per_second:>12.1f}")
+    return "\n".join(lines)
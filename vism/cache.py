@@ -1,10 +1,13 @@
 import sqlite3
 import hashlib
+import time
 import numpy as np
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional, Tuple
 import logging
-from .types import ImageEmbedding
+from .profiling import stage
+from .types import FileEntry, ImageEmbedding
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +29,42 @@ def _get_cache_db(model_name: str) -> Path:
     return cache_dir / f"{model_name}.db"
 
 
+def _get_vectors_path(db_path: Path, generation: int = 0) -> Path:
+    """
+    Raw row-major matrix holding the embeddings of one model db
+
+    Rewriting the file (compaction, precision changes) writes a new
+    generation that the db's meta switches to when the rewrite commits, so
+    row numbers and the file they index are always committed together.
+    """
+    if generation == 0:
+        return db_path.with_suffix(".vectors")
+    return db_path.with_suffix(f".{generation}.vectors")
+
+
+def inference_cache_name(model_name: str, precision: str = "float32") -> str:
+    """
+    Cache namespace for embeddings of model_name computed at an inference precision
+
+    float32 keeps the plain model name, so existing caches stay valid; other
+    precisions get their own db and indexes instead of mixing their vectors
+    with float32 ones.
+    """
+    return model_name if precision == "float32" else f"{model_name}@{precision}"
+
+
+def _inference_precision(model_name: str) -> str:
+    return model_name.partition("@")[2] or "float32"
+
+
+def _get_files_db() -> Path:
+    """Model-independent per-file cache (perceptual hashes)"""
+    cache_dir = _get_cache_dir()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # not *.db, so it isn't mistaken for a model cache
+    return cache_dir / "files.sqlite"
+
+
 def _get_all_cache_dbs() -> Dict[str, Path]:
     """Return all existing model cache dbs as {model_name: path}"""
     cache_dir = _get_cache_dir()
@@ -36,12 +75,71 @@ def _get_all_cache_dbs() -> Dict[str, Path]:
 
 def _compute_cache_key(path: Path) -> str:
     stat = path.stat()
-    key_string = f"{path.absolute()}:{stat.st_size}:{stat.st_mtime_ns}"
+    return _cache_key_from_stat(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _cache_key_from_stat(path: Path, size: int, mtime_ns: int) -> str:
+    key_string = f"{path.absolute()}:{size}:{mtime_ns}"
     return hashlib.sha256(key_string.encode(errors="surrogateescape")).hexdigest()
 
 
+# Bytes hashed from the start, middle and end of a file for its content key
+CONTENT_SAMPLE_SIZE = 16 * 1024
+
+
+def _compute_content_key(path: Path) -> str:
+    """
+    Fast content fingerprint: file size plus three sampled chunks
+
+    Survives renames, moves and copies (unlike the path key). Files up to three
+    samples long are hashed whole; for larger ones two files of the same size
+    that differ only outside the samples would collide, which is an accepted
+    trade-off for not reading every byte.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with stage("content_key", items=1) as s, open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        h.update(size.to_bytes(8, "little"))
+        if size <= 3 * CONTENT_SAMPLE_SIZE:
+            h.update(f.read())
+            s.add(bytes_read=size)
+        else:
+            for offset in (0, (size - CONTENT_SAMPLE_SIZE) // 2, size - CONTENT_SAMPLE_SIZE):
+                f.seek(offset)
+                h.update(f.read(CONTENT_SAMPLE_SIZE))
+            s.add(bytes_read=3 * CONTENT_SAMPLE_SIZE)
+    return h.hexdigest()
+
+
+def cache_keys_for_entries(entries: List[FileEntry]) -> Dict[Path, str]:
+    """Return {path: cache_key} from stat results a scan already collected"""
+    with stage("cache_keys", items=len(entries)):
+        return {
+            entry.path: _cache_key_from_stat(entry.path, entry.size, entry.mtime_ns)
+            for entry in entries
+        }
+
+
+def compute_cache_keys(paths: List[Path]) -> Dict[Path, str]:
+    """Return {path: cache_key}, skipping files that can't be stat'ed"""
+    keys = {}
+    with stage("cache_keys", items=len(paths)):
+        for path in paths:
+            try:
+                keys[path] = _compute_cache_key(path)
+            except Exception as e:
+                logger.warning(f"Skipping file '{path.name}' due to error: {e}")
+    return keys
+
+
 def _init_db(db_path: Path) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    # wait for concurrent writers (e.g. a running `vism index`) instead of failing
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    # page_size only takes effect on a new db; WAL lets readers run alongside
+    # a writer, and with WAL synchronous=NORMAL is still crash-safe
+    conn.execute("PRAGMA page_size = 8192")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
     conn.execute("""
         CREATE TABLE IF NOT EXISTS embeddings (
             cache_key TEXT PRIMARY KEY,
@@ -58,15 +156,190 @@ def _init_db(db_path: Path) -> sqlite3.Connection:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS text_embeddings (
+            text TEXT PRIMARY KEY,
+            embedding BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(embeddings)")}
+    if "row" not in columns:
+        # embeddings live in the .vectors matrix; rows from older versions
+        # keep theirs in the embedding blob and have no row
+        conn.execute("ALTER TABLE embeddings ADD COLUMN row INTEGER")
+    if "content_key" not in columns:
+        conn.execute("ALTER TABLE embeddings ADD COLUMN content_key TEXT")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_content_key ON embeddings(content_key)"
+    )
     conn.commit()
     return conn
 
 
+def _get_meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_meta(conn: sqlite3.Connection, key: str, value: str) -> None:
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+# Storage precisions for the vectors file, recorded per db in meta
+PRECISIONS = ("float32", "float16", "int8")
+
+
+def _row_dtype(dim: int, precision: str) -> np.dtype:
+    """Layout of one row of the vectors file"""
+    if precision == "float32":
+        return np.dtype((np.float32, (dim,)))
+    if precision == "float16":
+        return np.dtype((np.float16, (dim,)))
+    if precision == "int8":
+        # symmetric per-row quantization: value = q * scale
+        return np.dtype([("q", np.int8, (dim,)), ("scale", np.float32)])
+    raise ValueError(f"unknown cache precision '{precision}'")
+
+
+def _encode_rows(vectors: np.ndarray, precision: str) -> np.ndarray:
+    rows = np.empty(len(vectors), dtype=_row_dtype(vectors.shape[1], precision))
+    if precision == "int8":
+        scale = np.abs(vectors).max(axis=1) / 127.0
+        scale[scale == 0] = 1.0
+        rows["q"] = np.rint(vectors / scale[:, None]).clip(-127, 127)
+        rows["scale"] = scale
+        return rows
+    return np.ascontiguousarray(vectors, dtype=rows.dtype.base).reshape(len(vectors), -1)
+
+
+def _decode_rows(rows: np.ndarray, precision: str) -> np.ndarray:
+    """float32 (n, dim) matrix; a view when stored as float32, a copy otherwise"""
+    if precision == "int8":
+        return rows["q"].astype(np.float32) * rows["scale"][:, None]
+    if precision == "float16":
+        return rows.astype(np.float32)
+    return rows
+
+
+def _open_matrix(vectors_path: Path, dim: int, precision: str = "float32") -> np.ndarray:
+    """Memory-map the vectors file read-only as n rows of _row_dtype"""
+    row_dtype = _row_dtype(dim, precision)
+    n_rows = (
+        vectors_path.stat().st_size // row_dtype.itemsize if vectors_path.exists() else 0
+    )
+    if n_rows == 0:
+        return np.empty(0, dtype=row_dtype)
+    return np.memmap(vectors_path, dtype=row_dtype, mode="r", shape=(n_rows,))
+
+
+def _append_vectors(
+    vectors_path: Path, vectors: np.ndarray, precision: str = "float32"
+) -> int:
+    """
+    Append rows to the vectors file and return the index of the first one
+
+    Callers must hold a write transaction on the db so appends don't interleave.
+    A torn row left by an interrupted write is truncated away first.
+    """
+    rows = _encode_rows(vectors, precision)
+    row_bytes = _row_dtype(vectors.shape[1], precision).itemsize
+    with open(vectors_path, "ab") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size % row_bytes:
+            size -= size % row_bytes
+            f.truncate(size)
+        f.write(rows.tobytes())
+    return size // row_bytes
+
+
+def _get_precision(conn: sqlite3.Connection) -> str:
+    return _get_meta(conn, "precision") or "float32"
+
+
+def _current_vectors_path(conn: sqlite3.Connection, db_path: Path) -> Path:
+    """The vectors file the db's committed (or in-progress) rows refer to"""
+    return _get_vectors_path(db_path, int(_get_meta(conn, "generation") or 0))
+
+
+def _next_vectors_path(conn: sqlite3.Connection, db_path: Path) -> Tuple[Path, Path]:
+    """
+    Switch the db to a new vectors file; returns (new file, old file)
+
+    Runs inside the caller's write transaction. The old file must stay until
+    the caller has committed, since until then readers still get the old
+    rows; remove it afterwards with _remove_vectors.
+    """
+    generation = int(_get_meta(conn, "generation") or 0)
+    new_path = _get_vectors_path(db_path, generation + 1)
+    # left behind by a rewrite that never committed
+    new_path.unlink(missing_ok=True)
+    _set_meta(conn, "generation", str(generation + 1))
+    return new_path, _get_vectors_path(db_path, generation)
+
+
+def _remove_vectors(vectors_path: Optional[Path]) -> None:
+    """Delete a vectors file a committed rewrite replaced"""
+    if vectors_path is not None:
+        vectors_path.unlink(missing_ok=True)
+
+
+def _compact_vectors(conn: sqlite3.Connection, db_path: Path) -> Optional[Path]:
+    """
+    Rewrite the vectors file without rows no longer referenced by the db
+
+    Runs inside the caller's write transaction and writes a new generation
+    of the file (see _next_vectors_path). Returns the replaced file, which
+    the caller removes once it has committed, or None if nothing changed.
+    """
+    vectors_path = _current_vectors_path(conn, db_path)
+    dim = _get_meta(conn, "dim")
+    if dim is None or not vectors_path.exists():
+        return None
+    rows = conn.execute(
+        "SELECT cache_key, row FROM embeddings WHERE row IS NOT NULL ORDER BY row"
+    ).fetchall()
+    matrix = _open_matrix(vectors_path, int(dim), _get_precision(conn))
+    torn = [key for key, r in rows if r >= len(matrix)]
+    if torn:
+        conn.executemany("DELETE FROM embeddings WHERE cache_key = ?", [(k,) for k in torn])
+        rows = [(key, r) for key, r in rows if r < len(matrix)]
+    # byte-identical files share a row, so renumber distinct rows
+    row_ids = np.unique(np.array([r for _, r in rows], dtype=np.int64))
+    if len(row_ids) == len(matrix):
+        return None
+
+    new_path, old_path = _next_vectors_path(conn, db_path)
+    with open(new_path, "wb") as f:
+        for start in range(0, len(row_ids), 65536):
+            f.write(np.ascontiguousarray(matrix[row_ids[start : start + 65536]]).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    del matrix
+    new_rows = np.searchsorted(row_ids, [r for _, r in rows])
+    conn.executemany(
+        "UPDATE embeddings SET row = ? WHERE cache_key = ?",
+        [(int(new), key) for new, (key, _) in zip(new_rows, rows)],
+    )
+    return old_path
+
+
 def _iter_dbs(model_name: Optional[str]) -> Dict[str, Path]:
     """Return {model_name: db_path} for the given model or all models"""
     if model_name is not None:
-        db_path = _get_cache_db(model_name)
-        return {model_name: db_path} if db_path.exists() else {}
+        # including the caches of the model's other inference precisions
+        stem = _get_cache_db(model_name).stem
+        return {
+            name: db_path
+            for name, db_path in _get_all_cache_dbs().items()
+            if name.partition("@")[0] == stem
+        }
     return _get_all_cache_dbs()
 
 
@@ -74,138 +347,763 @@ def _decode_path(path_blob: bytes) -> Path:
     return Path(path_blob.decode(errors="surrogateescape"))
 
 
-def cache_embeddings(embeddings: List[ImageEmbedding], model_name: str) -> None:
-    if not embeddings:
-        return
+def _lookup_rows(
+    conn: sqlite3.Connection, keys: List[str]
+) -> Iterator[Tuple[str, Optional[int], Optional[bytes]]]:
+    """Yield (cache_key, row, legacy_blob) for the cached keys among keys"""
+    for batch_start in range(0, len(keys), 999):
+        batch = keys[batch_start : batch_start + 999]
+        placeholders = ",".join("?" * len(batch))
+        yield from conn.execute(
+            f"SELECT cache_key, row, CASE WHEN row IS NULL THEN embedding END "
+            f"FROM embeddings WHERE cache_key IN ({placeholders})",
+            batch,
+        )
 
-    db_path = _get_cache_db(model_name)
 
-    valid_data_rows = []
+def _lookup_cache_key(path: Path, cache_keys: Optional[Dict[Path, str]]) -> str:
+    """Key from a scan's precomputed keys, falling back to stat'ing the file"""
+    if cache_keys is not None:
+        key = cache_keys.get(path)
+        if key is not None:
+            return key
+    return _compute_cache_key(path)
+
+
+def _keys_for_paths(
+    paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+) -> Dict[str, Path]:
+    key_to_path = {}
+    for path in paths:
+        try:
+            key_to_path[_lookup_cache_key(path, cache_keys)] = path
+        except Exception as e:
+            logger.warning(
+                f"Skipping file '{path.name}' during cache lookup due to error: {e}"
+            )
+            continue
+    return key_to_path
+
+
+def _text_key(text: str) -> str:
+    """Texts CLIP tokenizes the same (case and whitespace differ) share a key"""
+    return " ".join(text.split()).lower()
+
+
+class CacheSession:
+    """
+    One open connection to a model's cache db for the length of a run
+
+    Writes are grouped into transactions that are committed every
+    COMMIT_ROWS rows or COMMIT_INTERVAL seconds, and on commit()/close().
+    Each batch runs in its own savepoint, so a failing batch is dropped
+    without losing the uncommitted ones before it. The db is in WAL mode,
+    so other processes keep reading the last committed state meanwhile.
+
+    With content keys on (off unless enabled for the cache, see
+    set_cache_content_keys), a lookup that misses on the path key falls back
+    to a sampled content hash, so moved or copied files reuse their
+    embedding. Lookups stay read-only: the hit is recorded under the new path
+    key with the session's next write. Byte-identical files share one row of
+    the vectors file.
+    """
+
+    COMMIT_ROWS = 4096
+    COMMIT_INTERVAL = 2.0
+
+    def __init__(self, model_name: str, content_keys: Optional[bool] = None) -> None:
+        self.model_name = model_name
+        self.db_path = _get_cache_db(model_name)
+        # inference precision the stored embeddings were computed at
+        self.inference = _inference_precision(model_name)
+        self.conn = _init_db(self.db_path)
+        self.content_keys = (
+            _get_meta(self.conn, "content_keys") == "1"
+            if content_keys is None
+            else content_keys
+        )
+        self._content_key_memo: Dict[Path, Optional[str]] = {}
+        # (cache_key, path, content_key) of moved files found by content
+        self._aliases: List[Tuple[str, bytes, str]] = []
+        self._pending_rows = 0
+        self._transaction_start = 0.0
+
+    def __enter__(self) -> "CacheSession":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _write(self, write, rows: int) -> None:
+        """Run write(conn) inside the current batched transaction"""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self._transaction_start = time.monotonic()
+        self.conn.execute("SAVEPOINT batch")
+        try:
+            if self._aliases:
+                self._write_aliases(self.conn)
+            write(self.conn)
+        except BaseException:
+            self.conn.execute("ROLLBACK TO batch")
+            self.conn.execute("RELEASE batch")
+            raise
+        self.conn.execute("RELEASE batch")
+        self._pending_rows += rows
+        if (
+            self._pending_rows >= self.COMMIT_ROWS
+            or time.monotonic() - self._transaction_start >= self.COMMIT_INTERVAL
+        ):
+            self.commit()
+
+    @contextmanager
+    def _read_snapshot(self) -> Iterator[None]:
+        """Run the reads in the block against a single committed state of the db"""
+        if self.conn.in_transaction:
+            # the open write transaction already is one
+            yield
+            return
+        self.conn.execute("BEGIN")
+        try:
+            yield
+        finally:
+            if self.conn.in_transaction:
+                self.conn.commit()
+
+    def commit(self) -> None:
+        if self.conn.in_transaction:
+            self.conn.commit()
+        self._pending_rows = 0
 
-    for emb in embeddings:
+    def close(self) -> None:
         try:
-            cache_key = _compute_cache_key(emb.path)
+            self.commit()
+        finally:
+            self.conn.close()
+
+    def _content_key(self, path: Path) -> Optional[str]:
+        """Content key of path, read at most once per session; None if unreadable"""
+        if path not in self._content_key_memo:
+            try:
+                self._content_key_memo[path] = _compute_content_key(path)
+            except OSError as e:
+                logger.debug(f"Can't compute content key for '{path}': {e}")
+                self._content_key_memo[path] = None
+        return self._content_key_memo[path]
+
+    def _lookup(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]]
+    ) -> Tuple[Dict[str, Path], List[Tuple[str, Optional[int], Optional[bytes]]]]:
+        """Resolve paths to (key -> path, cached (key, row, legacy_blob) rows)"""
+        path_to_key = _keys_for_paths(paths, cache_keys)
+        with stage("cache_lookup", items=len(path_to_key)):
+            rows = list(_lookup_rows(self.conn, list(path_to_key)))
+        if self.content_keys and len(rows) < len(path_to_key):
+            found = {key for key, _, _ in rows}
+            rows += self._content_fallback(
+                {key: path for key, path in path_to_key.items() if key not in found}
+            )
+        return path_to_key, rows
+
+    def _content_fallback(
+        self, missing: Dict[str, Path]
+    ) -> List[Tuple[str, Optional[int], Optional[bytes]]]:
+        """Find rows for path-key misses by content; aliases are written later"""
+        by_content: Dict[str, List[str]] = {}
+        for key, path in missing.items():
+            content_key = self._content_key(path)
+            if content_key is not None:
+                by_content.setdefault(content_key, []).append(key)
+        if not by_content:
+            return []
+
+        hits: Dict[str, Tuple[Optional[int], Optional[bytes]]] = {}
+        content_keys = list(by_content)
+        for batch_start in range(0, len(content_keys), 999):
+            batch = content_keys[batch_start : batch_start + 999]
+            placeholders = ",".join("?" * len(batch))
+            for content_key, row, blob in self.conn.execute(
+                f"SELECT content_key, row, CASE WHEN row IS NULL THEN embedding END "
+                f"FROM embeddings WHERE content_key IN ({placeholders})",
+                batch,
+            ):
+                hits.setdefault(content_key, (row, blob))
+        if not hits:
+            return []
+
+        aliases = [
+            (key, content_key, row, blob)
+            for content_key, (row, blob) in hits.items()
+            for key in by_content[content_key]
+        ]
+        logger.info(f"Reusing {len(aliases)} embeddings of moved or copied files")
+        self._aliases += [
+            (key, str(missing[key].absolute()).encode(errors="surrogateescape"), c)
+            for key, c, _, _ in aliases
+        ]
+        return [(key, row, blob) for key, _, row, blob in aliases]
+
+    def _write_aliases(self, conn: sqlite3.Connection) -> None:
+        """Record the moved files found by content under their new path keys"""
+        aliases, self._aliases = self._aliases, []
+        # the row is looked up again here, in case it moved since the lookup
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings "
+            "(cache_key, path, embedding, row, content_key) "
+            "SELECT ?, ?, embedding, row, content_key FROM embeddings "
+            "WHERE content_key = ? LIMIT 1",
+            aliases,
+        )
+
+    def _rows_by_content(
+        self, content_keys: List[str], replacing: set[str]
+    ) -> Dict[str, int]:
+        """
+        Vector rows already stored for any of content_keys by other files
+
+        Rows of the cache keys being replaced don't count, so re-caching a
+        file writes a fresh vector instead of pointing back at the old one.
+        """
+        rows: Dict[str, int] = {}
+        for batch_start in range(0, len(content_keys), 999):
+            batch = content_keys[batch_start : batch_start + 999]
+            placeholders = ",".join("?" * len(batch))
+            for content_key, row, cache_key in self.conn.execute(
+                f"SELECT content_key, row, cache_key FROM embeddings "
+                f"WHERE content_key IN ({placeholders}) AND row IS NOT NULL",
+                batch,
+            ):
+                if cache_key not in replacing:
+                    rows[content_key] = row
+        return rows
+
+    def cache_embeddings(
+        self,
+        embeddings: List[ImageEmbedding],
+        cache_keys: Optional[Dict[Path, str]] = None,
+    ) -> None:
+        valid_data_rows = []
+        valid_vectors = []
+
+        for emb in embeddings:
+            try:
+                cache_key = _lookup_cache_key(emb.path, cache_keys)
+                content_key = (
+                    self._content_key(emb.path) if self.content_keys else None
+                )
 
-            path_bytes = str(emb.path.absolute()).encode(errors="surrogateescape")
+                path_bytes = str(emb.path.absolute()).encode(errors="surrogateescape")
+
+                valid_data_rows.append((cache_key, path_bytes, content_key))
+                valid_vectors.append(emb.embedding)
+
+            except Exception as e:
+                logger.warning(
+                    f"Skipping cache for file '{emb.path.name}' due to preparation error: {e}"
+                )
+                continue
 
-            embedding_blob = emb.embedding.tobytes()
+        if not valid_data_rows:
+            return
 
-            valid_data_rows.append((cache_key, path_bytes, embedding_blob))
+        vectors = np.stack(valid_vectors).astype(np.float32, copy=False)
 
+        def write(conn: sqlite3.Connection) -> None:
+            dim = _get_meta(conn, "dim")
+            if dim is None:
+                _set_meta(conn, "dim", str(vectors.shape[1]))
+            elif int(dim) != vectors.shape[1]:
+                raise ValueError(
+                    f"embedding dimension {vectors.shape[1]} doesn't match cache ({dim})"
+                )
+            inference = _get_meta(conn, "inference")
+            if inference is None:
+                _set_meta(conn, "inference", self.inference)
+            elif inference != self.inference:
+                raise ValueError(
+                    f"{self.inference} embeddings don't match cache ({inference})"
+                )
+            # identical files, already cached or within this batch, share a row
+            shared = self._rows_by_content(
+                [c for _, _, c in valid_data_rows if c is not None],
+                replacing={k for k, _, _ in valid_data_rows},
+            )
+            first_new: Dict[str, int] = {}
+            new_vectors: List[np.ndarray] = []
+            # (existing row, or index into new_vectors)
+            slots: List[Tuple[Optional[int], int]] = []
+            for (_, _, content_key), vector in zip(valid_data_rows, vectors):
+                if content_key in shared:
+                    slots.append((shared[content_key], 0))
+                elif content_key is not None and content_key in first_new:
+                    slots.append((None, first_new[content_key]))
+                else:
+                    if content_key is not None:
+                        first_new[content_key] = len(new_vectors)
+                    slots.append((None, len(new_vectors)))
+                    new_vectors.append(vector)
+
+            start = (
+                _append_vectors(
+                    _current_vectors_path(conn, self.db_path),
+                    np.stack(new_vectors),
+                    _get_precision(conn),
+                )
+                if new_vectors
+                else 0
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings "
+                "(cache_key, path, embedding, row, content_key) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        cache_key,
+                        path_bytes,
+                        b"",
+                        row if row is not None else start + i,
+                        content_key,
+                    )
+                    for (cache_key, path_bytes, content_key), (row, i) in zip(
+                        valid_data_rows, slots
+                    )
+                ],
+            )
+
+        try:
+            with stage("cache_write", items=len(valid_data_rows)):
+                self._write(write, len(valid_data_rows))
         except Exception as e:
-            logger.warning(
-                f"Skipping cache for file '{emb.path.name}' due to preparation error: {e}"
+            logger.warning(f"Failed to execute cache transaction for batch: {e}")
+
+    def mark_failed(
+        self, path: Path, cache_keys: Optional[Dict[Path, str]] = None
+    ) -> None:
+        """Record a path as permanently failed so it is skipped on future runs"""
+        try:
+            cache_key = _lookup_cache_key(path, cache_keys)
+            path_bytes = str(path.absolute()).encode(errors="surrogateescape")
+            self._write(
+                lambda conn: conn.execute(
+                    "INSERT OR REPLACE INTO failed (cache_key, path) VALUES (?, ?)",
+                    (cache_key, path_bytes),
+                ),
+                1,
             )
-            continue
+        except Exception as e:
+            logger.warning(f"Failed to record failed path '{path.name}': {e}")
 
-    if not valid_data_rows:
-        return
+    def load_cached_paths(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+    ) -> set[Path]:
+        """Return the subset of paths that have a cached embedding"""
+        try:
+            path_to_key, rows = self._lookup(paths, cache_keys)
+            return {path_to_key[key] for key, _, _ in rows}
+        except Exception as e:
+            logger.warning(f"Failed to load cached paths: {e}")
+            return set()
+
+    def load_embedding_matrix(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+    ) -> Tuple[List[Path], np.ndarray]:
+        """See load_embedding_matrix"""
+        with stage("cache_read") as s:
+            found, vectors = self._load_embedding_matrix(paths, cache_keys)
+            s.add(items=len(found), bytes_read=vectors.nbytes)
+        return found, vectors
+
+    def _load_embedding_matrix(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]]
+    ) -> Tuple[List[Path], np.ndarray]:
+        try:
+            # rows, precision and the file they index from one committed state
+            with self._read_snapshot():
+                path_to_key, rows = self._lookup(paths, cache_keys)
+                dim = _get_meta(self.conn, "dim")
+                precision = _get_precision(self.conn)
+                matrix = _open_matrix(
+                    _current_vectors_path(self.conn, self.db_path),
+                    int(dim or 0),
+                    precision,
+                )
+        except Exception as e:
+            logger.warning(f"Failed to load cached embeddings: {e}")
+            return [], np.empty((0, 0), dtype=np.float32)
 
-    try:
-        conn = _init_db(db_path)
-        conn.executemany(
-            "INSERT OR REPLACE INTO embeddings (cache_key, path, embedding) VALUES (?, ?, ?)",
-            valid_data_rows,
+        if not rows:
+            return [], np.empty((0, int(dim or 0)), dtype=np.float32)
+        stored = sorted(
+            (row, path_to_key[key]) for key, row, _ in rows if row is not None
         )
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.warning(f"Failed to execute cache transaction for batch: {e}")
+        legacy = [(path_to_key[key], blob) for key, row, blob in rows if row is None]
 
+        if stored:
+            row_ids = np.fromiter(
+                (r for r, _ in stored), dtype=np.int64, count=len(stored)
+            )
+            if row_ids[-1] >= len(matrix):
+                logger.warning("Cached vectors file is truncated, ignoring missing rows")
+                keep = row_ids < len(matrix)
+                stored = [s for s, k in zip(stored, keep) if k]
+                row_ids = row_ids[keep]
+            if len(row_ids) and np.all(np.diff(row_ids) == 1):
+                vectors = _decode_rows(matrix[row_ids[0] : row_ids[-1] + 1], precision)
+            else:
+                vectors = _decode_rows(matrix[row_ids], precision)
+        else:
+            vectors = np.empty((0, int(dim or 0)), dtype=np.float32)
+
+        found = [path for _, path in stored]
+        if legacy:
+            found += [path for path, _ in legacy]
+            legacy_vectors = np.stack(
+                [np.frombuffer(blob, dtype=np.float32) for _, blob in legacy]
+            )
+            vectors = (
+                np.concatenate([vectors, legacy_vectors])
+                if len(vectors)
+                else legacy_vectors
+            )
+        return found, vectors
+
+    def load_cached_embeddings(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+    ) -> Dict[Path, ImageEmbedding]:
+        found, matrix = self.load_embedding_matrix(paths, cache_keys)
+        return {
+            path: ImageEmbedding(path=path, embedding=vector)
+            for path, vector in zip(found, matrix)
+        }
+
+    def load_failed_paths(
+        self, paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+    ) -> set[Path]:
+        """Return the subset of paths that are recorded as failed"""
+        path_to_key: dict[str, Path] = {}
+        for path in paths:
+            try:
+                path_to_key[_lookup_cache_key(path, cache_keys)] = path
+            except Exception:
+                continue
 
-def load_cached_embeddings(
-    paths: List[Path], model_name: str
-) -> Dict[Path, ImageEmbedding]:
-    db_path = _get_cache_db(model_name)
+        if not path_to_key:
+            return set()
 
-    path_to_key = {}
-    for path in paths:
         try:
-            path_to_key[_compute_cache_key(path)] = path
+            keys = list(path_to_key.keys())
+            result = set()
+            with stage("cache_lookup", items=len(keys)):
+                for batch_start in range(0, len(keys), 999):
+                    batch = keys[batch_start : batch_start + 999]
+                    placeholders = ",".join("?" * len(batch))
+                    cursor = self.conn.execute(
+                        f"SELECT cache_key FROM failed WHERE cache_key IN ({placeholders})",
+                        batch,
+                    )
+                    result.update(path_to_key[row[0]] for row in cursor)
+            return result
         except Exception as e:
-            logger.warning(
-                f"Skipping file '{path.name}' during cache lookup due to error: {e}"
+            logger.warning(f"Failed to load failed paths: {e}")
+            return set()
+
+    def load_text_embeddings(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """Return {text: query embedding} for the cached subset of texts"""
+        keys = list({_text_key(text) for text in texts})
+        found: Dict[str, np.ndarray] = {}
+        try:
+            with stage("cache_lookup", items=len(keys)):
+                for batch_start in range(0, len(keys), 999):
+                    batch = keys[batch_start : batch_start + 999]
+                    placeholders = ",".join("?" * len(batch))
+                    for key, blob in self.conn.execute(
+                        f"SELECT text, embedding FROM text_embeddings "
+                        f"WHERE text IN ({placeholders})",
+                        batch,
+                    ):
+                        found[key] = np.frombuffer(blob, dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Failed to load cached text embeddings: {e}")
+            return {}
+        return {
+            text: found[_text_key(text)] for text in texts if _text_key(text) in found
+        }
+
+    def cache_text_embeddings(self, embeddings: Dict[str, np.ndarray]) -> None:
+        rows = [
+            (_text_key(text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in embeddings.items()
+        ]
+        try:
+            self._write(
+                lambda conn: conn.executemany(
+                    "INSERT OR REPLACE INTO text_embeddings (text, embedding) "
+                    "VALUES (?, ?)",
+                    rows,
+                ),
+                len(rows),
             )
-            continue
+        except Exception as e:
+            logger.warning(f"Failed to cache text embeddings: {e}")
+
 
-    if not path_to_key:
+def cache_embeddings(
+    embeddings: List[ImageEmbedding],
+    model_name: str,
+    cache_keys: Optional[Dict[Path, str]] = None,
+) -> None:
+    if not embeddings:
+        return
+    with CacheSession(model_name) as session:
+        session.cache_embeddings(embeddings, cache_keys)
+
+
+def load_cached_embeddings(
+    paths: List[Path],
+    model_name: str,
+    cache_keys: Optional[Dict[Path, str]] = None,
+) -> Dict[Path, ImageEmbedding]:
+    with CacheSession(model_name) as session:
+        return session.load_cached_embeddings(paths, cache_keys)
+
+
+def load_cached_paths(
+    paths: List[Path],
+    model_name: str,
+    cache_keys: Optional[Dict[Path, str]] = None,
+) -> set[Path]:
+    """Return the subset of paths that have a cached embedding"""
+    with CacheSession(model_name) as session:
+        return session.load_cached_paths(paths, cache_keys)
+
+
+def load_embedding_matrix(
+    paths: List[Path],
+    model_name: str,
+    cache_keys: Optional[Dict[Path, str]] = None,
+) -> Tuple[List[Path], np.ndarray]:
+    """
+    Return (cached_paths, matrix) with matrix[i] the embedding of cached_paths[i]
+
+    Paths are returned in storage order, so when the requested files were cached
+    together (e.g. a library indexed in one run) the matrix is a zero-copy slice
+    of the memory-mapped vectors file. Otherwise rows are gathered in one copy.
+    """
+    with CacheSession(model_name) as session:
+        return session.load_embedding_matrix(paths, cache_keys)
+
+
+def mark_failed(
+    path: Path, model_name: str, cache_keys: Optional[Dict[Path, str]] = None
+) -> None:
+    """Record a path as permanently failed so it is skipped on future runs"""
+    with CacheSession(model_name) as session:
+        session.mark_failed(path, cache_keys)
+
+
+def load_failed_paths(
+    paths: List[Path],
+    model_name: str,
+    cache_keys: Optional[Dict[Path, str]] = None,
+) -> set[Path]:
+    """Return the subset of paths that are recorded as failed"""
+    if not _get_cache_db(model_name).exists():
+        return set()
+    with CacheSession(model_name) as session:
+        return session.load_failed_paths(paths, cache_keys)
+
+
+def load_text_embeddings(
+    model_name: str, texts: List[str]
+) -> Dict[str, np.ndarray]:
+    """Return {text: query embedding} for the cached subset of texts"""
+    if not texts or not _get_cache_db(model_name).exists():
         return {}
+    with CacheSession(model_name) as session:
+        return session.load_text_embeddings(texts)
+
+
+def cache_text_embeddings(
+    model_name: str, embeddings: Dict[str, np.ndarray]
+) -> None:
+    if not embeddings:
+        return
+    with CacheSession(model_name) as session:
+        session.cache_text_embeddings(embeddings)
+
+
+def _init_files_db(db_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS phashes (
+            cache_key TEXT PRIMARY KEY,
+            path BLOB NOT NULL,
+            phash INTEGER NOT NULL
+        )
+    """)
+    conn.commit()
+    return conn
+
+
+def _to_signed64(value: int) -> int:
+    """SQLite integers are signed 64-bit"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
 
+def load_cached_phashes(
+    paths: List[Path], cache_keys: Optional[Dict[Path, str]] = None
+) -> Dict[Path, int]:
+    """Return {path: 64-bit perceptual hash} for the cached subset of paths"""
+    db_path = _get_files_db()
+    if not db_path.exists():
+        return {}
+    key_to_path = _keys_for_paths(paths, cache_keys)
+    keys = list(key_to_path)
+    result: Dict[Path, int] = {}
+    conn = _init_files_db(db_path)
     try:
-        conn = sqlite3.connect(db_path)
-        results = {}
-        keys = list(path_to_key.keys())
-        for batch_start in range(0, len(keys), 999):
-            batch = keys[batch_start : batch_start + 999]
-            placeholders = ",".join("?" * len(batch))
+        for i in range(0, len(keys), 999):
+            batch = keys[i : i + 999]
             cursor = conn.execute(
-                f"SELECT cache_key, embedding FROM embeddings WHERE cache_key IN ({placeholders})",
+                f"SELECT cache_key, phash FROM phashes WHERE cache_key IN ({','.join('?' * len(batch))})",
                 batch,
             )
-            for cache_key, embedding_blob in cursor:
-                path = path_to_key[cache_key]
-                embedding_array = np.frombuffer(embedding_blob, dtype=np.float32)
-                results[path] = ImageEmbedding(path=path, embedding=embedding_array)
+            for key, phash in cursor:
+                result[key_to_path[key]] = phash & ((1 << 64) - 1)
+    finally:
         conn.close()
-        return results
-    except Exception as e:
-        logger.warning(f"Failed to load cached embeddings: {e}")
-        return {}
+    return result
 
 
-def mark_failed(path: Path, model_name: str) -> None:
-    """Record a path as permanently failed so it is skipped on future runs"""
-    db_path = _get_cache_db(model_name)
+def cache_phashes(
+    phashes: Dict[Path, int], cache_keys: Optional[Dict[Path, str]] = None
+) -> None:
+    if not phashes:
+        return
+    conn = _init_files_db(_get_files_db())
     try:
-        cache_key = _compute_cache_key(path)
-        path_bytes = str(path.absolute()).encode(errors="surrogateescape")
-        conn = _init_db(db_path)
-        conn.execute(
-            "INSERT OR REPLACE INTO failed (cache_key, path) VALUES (?, ?)",
-            (cache_key, path_bytes),
+        conn.executemany(
+            "INSERT OR REPLACE INTO phashes (cache_key, path, phash) VALUES (?, ?, ?)",
+            [
+                (
+                    _lookup_cache_key(path, cache_keys),
+                    str(path.absolute()).encode(errors="surrogateescape"),
+                    _to_signed64(phash),
+                )
+                for path, phash in phashes.items()
+            ],
         )
         conn.commit()
+    finally:
+        conn.close()
+
+
+def _delete_phashes(prefix: Optional[Path], missing_only: bool) -> None:
+    """Drop cached hashes under prefix (all if None), optionally only of deleted files"""
+    db_path = _get_files_db()
+    if not db_path.exists():
+        return
+    prefix_str = str(prefix.absolute()) if prefix is not None else None
+    try:
+        conn = _init_files_db(db_path)
+        if prefix_str is None and not missing_only:
+            conn.execute("DELETE FROM phashes")
+        else:
+            keys_to_delete = []
+            for cache_key, path_blob in conn.execute(
+                "SELECT cache_key, path FROM phashes"
+            ).fetchall():
+                path = _decode_path(path_blob)
+                if prefix_str is not None and not str(path).startswith(prefix_str):
+                    continue
+                if not missing_only or not path.exists():
+                    keys_to_delete.append(cache_key)
+            conn.executemany(
+                "DELETE FROM phashes WHERE cache_key = ?", [(k,) for k in keys_to_delete]
+            )
+        conn.commit()
         conn.close()
     except Exception as e:
-        logger.warning(f"Failed to record failed path '{path.name}': {e}")
+        logger.warning(f"Failed to clean perceptual hash cache: {e}")
 
 
-def load_failed_paths(paths: List[Path], model_name: str) -> set[Path]:
-    """Return the subset of paths that are recorded as failed"""
+def set_cache_precision(model_name: str, precision: str) -> int:
+    """
+    Set the storage precision of a model's cache, converting stored vectors
+
+    Creates the db if needed, so the precision can be chosen before the first
+    run. Returns the number of vector rows converted.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"unknown cache precision '{precision}'")
     db_path = _get_cache_db(model_name)
-    if not db_path.exists():
-        return set()
+    conn = _init_db(db_path)
+    replaced = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        current = _get_precision(conn)
+        dim = _get_meta(conn, "dim")
+        vectors_path = _current_vectors_path(conn, db_path)
+        converted = 0
+        if current != precision and dim is not None and vectors_path.exists():
+            matrix = _open_matrix(vectors_path, int(dim), current)
+            # the new precision and its file commit together
+            new_path, replaced = _next_vectors_path(conn, db_path)
+            with open(new_path, "wb") as f:
+                for start in range(0, len(matrix), 65536):
+                    chunk = _decode_rows(matrix[start : start + 65536], current)
+                    f.write(_encode_rows(chunk, precision).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            converted = len(matrix)
+            del matrix
+        _set_meta(conn, "precision", precision)
+        conn.commit()
+    finally:
+        conn.close()
+    _remove_vectors(replaced)
+    return converted
 
-    path_to_key: dict[str, Path] = {}
-    for path in paths:
-        try:
-            path_to_key[_compute_cache_key(path)] = path
-        except Exception:
-            continue
 
-    if not path_to_key:
-        return set()
+def set_cache_content_keys(model_name: str, enabled: bool) -> int:
+    """
+    Turn content keys (see CacheSession) on or off for a model's cache
 
+    Enabling also computes content keys for cached files that are still
+    unchanged on disk, so they can be found after being moved. Returns the
+    number of entries that got one.
+    """
+    db_path = _get_cache_db(model_name)
+    conn = _init_db(db_path)
     try:
-        conn = sqlite3.connect(db_path)
-        keys = list(path_to_key.keys())
-        result = set()
-        for batch_start in range(0, len(keys), 999):
-            batch = keys[batch_start : batch_start + 999]
-            placeholders = ",".join("?" * len(batch))
-            cursor = conn.execute(
-                f"SELECT cache_key FROM failed WHERE cache_key IN ({placeholders})",
-                batch,
+        conn.execute("BEGIN IMMEDIATE")
+        _set_meta(conn, "content_keys", "1" if enabled else "0")
+        updates = []
+        if enabled:
+            rows = conn.execute(
+                "SELECT cache_key, path FROM embeddings WHERE content_key IS NULL"
+            ).fetchall()
+            for cache_key, path_blob in rows:
+                path = _decode_path(path_blob)
+                try:
+                    # a file changed since it was cached has another content
+                    if _compute_cache_key(path) == cache_key:
+                        updates.append((_compute_content_key(path), cache_key))
+                except OSError:
+                    continue
+            conn.executemany(
+                "UPDATE embeddings SET content_key = ? WHERE cache_key = ?", updates
             )
-            result.update(path_to_key[row[0]] for row in cursor)
+        conn.commit()
+        return len(updates)
+    finally:
         conn.close()
-        return result
-    except Exception as e:
-        logger.warning(f"Failed to load failed paths: {e}")
-        return set()
 
 
 def clear_cache(model_name: Optional[str] = None, prefix: Optional[Path] = None) -> int:
+    from .index_store import drop_library_indexes
+
     dbs = _iter_dbs(model_name)
     total_deleted = 0
 
@@ -214,9 +1112,13 @@ def clear_cache(model_name: Optional[str] = None, prefix: Optional[Path] = None)
             continue
         try:
             conn = _init_db(db_path)
+            conn.execute("BEGIN IMMEDIATE")
+            replaced = None
             if prefix is None:
                 cursor = conn.execute("DELETE FROM embeddings")
                 total_deleted += cursor.rowcount
+                conn.execute("DELETE FROM text_embeddings")
+                _, replaced = _next_vectors_path(conn, db_path)
             else:
                 prefix_str = str(prefix.absolute())
                 cursor = conn.execute("SELECT cache_key, path FROM embeddings")
@@ -231,11 +1133,17 @@ def clear_cache(model_name: Optional[str] = None, prefix: Optional[Path] = None)
                         keys_to_delete,
                     )
                     total_deleted += len(keys_to_delete)
+                    replaced = _compact_vectors(conn, db_path)
             conn.commit()
             conn.close()
+            _remove_vectors(replaced)
+            # persisted indexes would otherwise keep serving the cleared entries
+            drop_library_indexes(name)
         except Exception as e:
             logger.warning(f"Failed to clear cache for model '{name}': {e}")
 
+    if model_name is None:
+        _delete_phashes(prefix, missing_only=False)
     return total_deleted
 
 
@@ -248,6 +1156,8 @@ def prune_cache(model_name: Optional[str] = None, prefix: Optional[Path] = None)
             continue
         try:
             conn = _init_db(db_path)
+            # compaction must see every row appended before it
+            conn.execute("BEGIN IMMEDIATE")
             cursor = conn.execute("SELECT cache_key, path FROM embeddings")
             rows = cursor.fetchall()
 
@@ -267,12 +1177,17 @@ def prune_cache(model_name: Optional[str] = None, prefix: Optional[Path] = None)
                     keys_to_delete,
                 )
                 total_pruned += len(keys_to_delete)
+            # also reclaims rows orphaned by re-cached files
+            replaced = _compact_vectors(conn, db_path)
 
             conn.commit()
             conn.close()
+            _remove_vectors(replaced)
         except Exception as e:
             logger.warning(f"Failed to prune cache for model '{name}': {e}")
 
+    if model_name is None:
+        _delete_phashes(prefix, missing_only=True)
     return total_pruned
 
 
@@ -1,61 +1,757 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass
 from pathlib import Path
 import sys
-from typing import List
-from .types import ImageEmbedding, SearchResult
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from .types import ImageEmbedding, QueryResult, SearchResult
 from .cache import (
-    load_cached_embeddings,
-    cache_embeddings,
-    load_failed_paths,
-    mark_failed,
+    CacheSession,
+    _decode_path,
+    cache_keys_for_entries,
+    cache_text_embeddings,
+    compute_cache_keys,
+    load_embedding_matrix,
+    load_text_embeddings,
 )
-from .images import load_image, find_images_recursive
-from .embeddings import Model, encode_image, encode_images
-from .search import build_index, search_items
+from .images import load_image, scan_images
+from .index_store import (
+    LibraryIndex,
+    add_vectors_to_library_index,
+    cache_key_to_id,
+    empty_library_index,
+    load_library_ids,
+    load_library_vectors,
+    remove_from_library_index,
+    save_library_index,
+    search_library_index_batch,
+    train_library_index,
+    training_sample_size,
+)
+from .dupes import (
+    _connected_components,
+    clusters_from_edges,
+    duplicate_edges,
+    estimate_dupes_recall,
+)
+from .phash import DEFAULT_MAX_DISTANCE, get_or_compute_phashes, phash_edges
+from .batching import BatchEncoder, choose_batch_size
+from .parallel import EncodeWorkers, encode_in_workers
+from .profiling import stage
+from .search import IndexSpec, can_train, estimate_recall, set_search_params
 from tqdm import tqdm
 import logging
 
+if TYPE_CHECKING:
+    import torch
+    from .embeddings import Model, TextModel
+
 logger = logging.getLogger(__name__)
 
+# How many batches the decode workers may prepare ahead of inference
+PREFETCH_BATCHES = 2
+# Newly encoded images between the updates of a budgeted index update
+REFINE_CHUNK = 256
+# Vectors read from the cache or buffered from encoding per index add
+INDEX_ADD_CHUNK = 16384
+
+
+class ModelLoader:
+    """
+    Loads a model on a background thread, only once something needs it
+
+    The pipeline calls prefetch() as soon as it knows there are images to
+    encode and carries on scanning and loading caches and indexes while the
+    model (and torch) load; get() waits for it. A model nobody asks for is
+    never loaded.
+    """
+
+    def __init__(self, load: Callable[[], "Model"]) -> None:
+        self._load = load
+        self._lock = threading.Lock()
+        self._future: Optional["Future[Model]"] = None
+
+    def prefetch(self) -> None:
+        """Start loading in the background unless already started"""
+        with self._lock:
+            if self._future is not None:
+                return
+            self._future = Future()
+        threading.Thread(
+            target=self._run, name="vism-model-load", daemon=True
+        ).start()
+
+    def _run(self) -> None:
+        assert self._future is not None
+        try:
+            with stage("model_load"):
+                model = self._load()
+        except BaseException as e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(model)
+
+    @property
+    def started(self) -> bool:
+        return self._future is not None
+
+    def get(self) -> "Model":
+        """The loaded model; re-raises the load error if loading failed"""
+        self.prefetch()
+        assert self._future is not None
+        return self._future.result()
+
+
+# A loaded model, or a loader for one
+# EncodeWorkers only encodes library images, each worker loading its own model
+ModelSource = Union["Model", ModelLoader, EncodeWorkers]
+
+
+def _resolve_model(model: ModelSource) -> "Model":
+    if not isinstance(model, ModelLoader):
+        return model
+    # time the pipeline spends blocked on the background load
+    with stage("model_wait"):
+        return model.get()
+
 
 def run_search_pipeline(
-    source_dir: Path, query: Path, model: Model, model_name: str, k: int = 10
+    source_dir: Path,
+    query: Path,
+    model: ModelSource,
+    model_name: str,
+    k: int = 10,
+    decode_workers: int = 0,
+    index_spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    batch_size: Optional[int] = None,
 ) -> List[SearchResult]:
-    image_paths = list(find_images_recursive(source_dir))
-    logger.info(f"Found {len(image_paths)} images")
+    (result,) = run_batch_search_pipeline(
+        source_dir,
+        [query],
+        model,
+        model_name,
+        k=k,
+        decode_workers=decode_workers,
+        index_spec=index_spec,
+        nprobe=nprobe,
+        ef_search=ef_search,
+        batch_size=batch_size,
+    )
+    if result.error is not None:
+        logger.error(f"Failed to load query image: {result.error}")
+        sys.exit(1)
+    return result.results
 
-    embeddings = get_or_compute_embeddings(
-        image_paths,
+
+def run_batch_search_pipeline(
+    source_dir: Path,
+    queries: List[Path],
+    model: ModelSource,
+    model_name: str,
+    k: int = 10,
+    decode_workers: int = 0,
+    index_spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    max_encode: Optional[int] = None,
+    max_encode_time: Optional[float] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator[QueryResult]:
+    """
+    Search for many query images against one library scan and index load
+
+    Queries are encoded in batches and searched with a single matrix search;
+    results are yielded per query, in query order. Queries that fail to load
+    are yielded with an error instead of results.
+
+    With max_encode or max_encode_time (see update_library_index; 0 searches
+    only what is already cached) results are yielded progressively: one
+    round for what needs no encoding, then one per REFINE_CHUNK newly encoded
+    images. Results of the last round have final=True; skipped counts the
+    images that weren't searched because they aren't encoded yet.
+    """
+    cache_keys = scan_library(source_dir)
+    logger.info(f"Found {len(cache_keys)} images")
+
+    progressive = max_encode is not None or max_encode_time is not None
+    encoded_queries = None
+    for update in update_library_index(
+        source_dir,
+        list(cache_keys),
+        model,
+        model_name,
+        decode_workers=decode_workers,
+        index_spec=index_spec,
+        cache_keys=cache_keys,
+        max_encode=max_encode,
+        max_encode_time=max_encode_time,
+        batch_size=batch_size,
+    ):
+        if not (update.final or progressive):
+            continue
+        if encoded_queries is None:
+            logger.debug(f"Encoding {len(queries)} query images...")
+            query_embeddings, errors = encode_query_images(
+                queries, model, decode_workers
+            )
+            encoded_queries = {i: e.embedding for i, e in query_embeddings.items()}
+        if update.lib.index is not None:
+            set_search_params(update.lib.index, nprobe=nprobe, ef_search=ef_search)
+        yield from _search_encoded(
+            update.lib,
+            queries,
+            encoded_queries,
+            errors,
+            k=k,
+            skipped=update.pending,
+            final=update.final,
+        )
+
+
+def get_text_embeddings(
+    texts: List[str],
+    load_text_model: Callable[[], "TextModel"],
+    model_name: str,
+) -> np.ndarray:
+    """
+    Embeddings of text queries, one row per text
+
+    Text embeddings are cached in the model's cache, so the text encoder is
+    only loaded (through load_text_model) for texts not searched before.
+    """
+    from .embeddings import encode_texts
+
+    embeddings = load_text_embeddings(model_name, texts)
+    missing = list(dict.fromkeys(t for t in texts if t not in embeddings))
+    if missing:
+        logger.debug(f"Encoding {len(missing)} text queries...")
+        new = dict(zip(missing, encode_texts(missing, load_text_model())))
+        cache_text_embeddings(model_name, new)
+        embeddings.update(new)
+    return np.stack([embeddings[t] for t in texts])
+
+
+def run_text_search_pipeline(
+    source_dir: Path,
+    texts: List[str],
+    load_text_model: Callable[[], "TextModel"],
+    model: ModelSource,
+    model_name: str,
+    k: int = 10,
+    decode_workers: int = 0,
+    index_spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+    ef_search: Optional[int] = None,
+    max_encode: Optional[int] = 0,
+    max_encode_time: Optional[float] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator[QueryResult]:
+    """
+    Search text queries against the image embeddings of a CLIP model
+
+    Nothing is encoded on the image side by default (max_encode=0): the
+    library index is updated with what the cache already holds and images
+    that aren't encoded yet are counted in skipped. Pass other limits (see
+    update_library_index) to encode some of them, with results yielded
+    progressively as in run_batch_search_pipeline; model is only loaded
+    then.
+    """
+    vectors = get_text_embeddings(texts, load_text_model, model_name)
+    cache_keys = scan_library(source_dir)
+    logger.info(f"Found {len(cache_keys)} images")
+
+    progressive = max_encode is not None or max_encode_time is not None
+    for update in update_library_index(
+        source_dir,
+        list(cache_keys),
         model,
         model_name,
+        decode_workers=decode_workers,
+        index_spec=index_spec,
+        cache_keys=cache_keys,
+        max_encode=max_encode,
+        max_encode_time=max_encode_time,
+        batch_size=batch_size,
+    ):
+        if not (update.final or progressive):
+            continue
+        if update.lib.index is not None:
+            set_search_params(update.lib.index, nprobe=nprobe, ef_search=ef_search)
+        yield from _search_encoded(
+            update.lib,
+            texts,
+            dict(enumerate(vectors)),
+            {},
+            k=k,
+            skipped=update.pending,
+            final=update.final,
+        )
+
+
+def scan_library(source_dir: Path) -> Dict[Path, str]:
+    """
+    Scan source_dir once and return {image_path: cache_key} in path order
+
+    Keys come from the scan's own stat results; pass the mapping on as
+    cache_keys so later cache lookups don't stat every file again.
+    """
+    with stage("scan") as s:
+        entries = scan_images(source_dir)
+        s.add(items=len(entries))
+    return cache_keys_for_entries(entries)
+
+
+def search_queries(
+    lib: LibraryIndex,
+    queries: List[Path],
+    model: ModelSource,
+    k: int = 10,
+    decode_workers: int = 0,
+) -> Iterator[QueryResult]:
+    """Encode query images and search them against lib with one matrix search"""
+    logger.debug(f"Encoding {len(queries)} query images...")
+    query_embeddings, errors = encode_query_images(queries, model, decode_workers)
+    query_vectors = {i: e.embedding for i, e in query_embeddings.items()}
+    yield from _search_encoded(lib, queries, query_vectors, errors, k=k)
+
+
+def _search_encoded(
+    lib: LibraryIndex,
+    queries: Sequence[Union[Path, str]],
+    query_vectors: Dict[int, np.ndarray],
+    errors: Dict[int, str],
+    k: int = 10,
+    skipped: int = 0,
+    final: bool = True,
+) -> Iterator[QueryResult]:
+    encoded = sorted(query_vectors)
+    with stage("search", items=len(encoded)):
+        matches = (
+            search_library_index_batch(
+                lib, np.stack([query_vectors[i] for i in encoded]), k=k
+            )
+            if encoded
+            else []
+        )
+    results_by_query = dict(zip(encoded, matches))
+
+    for i, query in enumerate(queries):
+        if i in errors:
+            yield QueryResult(
+                query=query, results=[], error=errors[i], skipped=skipped, final=final
+            )
+        else:
+            yield QueryResult(
+                query=query, results=results_by_query[i], skipped=skipped, final=final
+            )
+
+
+def encode_query_images(
+    queries: List[Path],
+    model: ModelSource,
+    decode_workers: int = 0,
+    batch_size: int = 64,
+) -> Tuple[Dict[int, ImageEmbedding], Dict[int, str]]:
+    """Encode query images in batches; returns ({i: embedding}, {i: load error})"""
+    from .embeddings import encode_preprocessed
+
+    model = _resolve_model(model)
+    embeddings: Dict[int, ImageEmbedding] = {}
+    errors: Dict[int, str] = {}
+    batches = _iter_prepared_batches(
+        list(range(len(queries))), queries, model, batch_size, decode_workers
     )
+    for batch in batches:
+        valid_indices = []
+        tensors = []
+        for idx, item in batch:
+            if isinstance(item, Exception):
+                errors[idx] = str(item)
+            else:
+                valid_indices.append(idx)
+                tensors.append(item)
+        if tensors:
+            batch_embeddings = encode_preprocessed(
+                [queries[i] for i in valid_indices], tensors, model
+            )
+            embeddings.update(zip(valid_indices, batch_embeddings))
+    return embeddings, errors
 
-    logger.debug("Building search index...")
-    index = build_index(embeddings)
 
-    logger.debug("Encoding query image...")
-    try:
-        query_img = load_image(query)
-    except Exception as e:
-        logger.error(f"Failed to load query image: {e}")
-        sys.exit(1)
-    query_embedding = encode_image(query_img, model)
-    return search_items(index, query_embedding, embeddings, k=k)
+def get_library_index(
+    source_dir: Path,
+    image_paths: List[Path],
+    model: ModelSource,
+    model_name: str,
+    decode_workers: int = 0,
+    index_spec: Optional[IndexSpec] = None,
+    cache_keys: Optional[Dict[Path, str]] = None,
+    batch_size: Optional[int] = None,
+) -> LibraryIndex:
+    """
+    Load the persisted index for source_dir and bring it up to date
+
+    Vectors of deleted or changed files are removed, new and changed files are
+    encoded (or taken from the embedding cache) and added. An unchanged index is
+    memory-mapped instead of read into RAM. Passing an index_spec that differs
+    from the stored one rebuilds (and retrains) the index from the cache;
+    None keeps whatever index type is stored. With batch_size None, one is
+    calibrated for the model (see batching).
+    """
+    for update in update_library_index(
+        source_dir,
+        image_paths,
+        model,
+        model_name,
+        decode_workers=decode_workers,
+        index_spec=index_spec,
+        cache_keys=cache_keys,
+        batch_size=batch_size,
+    ):
+        pass
+    return update.lib
+
+
+@dataclass(frozen=True)
+class LibraryUpdate:
+    """A library index on its way to being up to date"""
+
+    lib: LibraryIndex
+    # images that need encoding and aren't in the index yet
+    pending: int
+    # no more updates follow
+    final: bool
+
+
+def update_library_index(
+    source_dir: Path,
+    image_paths: List[Path],
+    model: ModelSource,
+    model_name: str,
+    decode_workers: int = 0,
+    index_spec: Optional[IndexSpec] = None,
+    cache_keys: Optional[Dict[Path, str]] = None,
+    max_encode: Optional[int] = None,
+    max_encode_time: Optional[float] = None,
+    batch_size: Optional[int] = None,
+) -> Iterator[LibraryUpdate]:
+    """
+    get_library_index that yields the index as it fills up
+
+    Encoding stops after max_encode images or max_encode_time seconds
+    (checked between batches); 0 only adds what is already cached and never
+    encodes. Images it doesn't get to stay pending for a later run. With
+    either limit set, an update is yielded once everything that needs no
+    encoding is added, and again after every REFINE_CHUNK newly encoded
+    images; the last update (final=True) comes after the index is saved.
+    Without limits only the final update is meaningful.
+
+    Memory doesn't grow with the library beyond the index itself: vectors
+    are added INDEX_ADD_CHUNK at a time, read from the memory-mapped cache
+    or as they come out of encoding. A new IVF index is trained on a sample
+    of everything it will hold, so without limits its new vectors are only
+    written to the cache while encoding and read back afterwards.
+    """
+    if cache_keys is None:
+        cache_keys = compute_cache_keys(image_paths)
+    path_ids = {
+        path: cache_key_to_id(cache_keys[path])
+        for path in image_paths
+        if path in cache_keys
+    }
+    current_ids = np.fromiter(path_ids.values(), dtype=np.int64, count=len(path_ids))
+    budgeted = max_encode is not None or max_encode_time is not None
+    may_encode = max_encode != 0 and max_encode_time != 0
+
+    with stage("index_load"):
+        lib = load_library_ids(model_name, source_dir)
+    if lib is not None:
+        if index_spec is not None and lib.requested_spec != index_spec:
+            logger.info("Index parameters changed, rebuilding index")
+            lib = None
+        elif lib.spec != lib.requested_spec and can_train(
+            lib.requested_spec, len(path_ids)
+        ):
+            logger.info(
+                f"Library is large enough for a {lib.requested_spec.index_type} "
+                "index now, rebuilding index"
+            )
+            index_spec = lib.requested_spec
+            lib = None
+    if lib is None:
+        lib = empty_library_index(source_dir, index_spec or IndexSpec())
+
+    with ExitStack() as stack:
+        sessions: List[CacheSession] = []
+
+        def session() -> CacheSession:
+            # opened only once the index turns out to need changes
+            if not sessions:
+                sessions.append(stack.enter_context(CacheSession(model_name)))
+            return sessions[0]
+
+        def split(paths: List[Path]) -> Tuple[List[Path], List[Path]]:
+            """(cached, uncached) paths, without ones that previously failed"""
+            if not paths:
+                return [], []
+            failed = session().load_failed_paths(paths, cache_keys)
+            cached = session().load_cached_paths(paths, cache_keys)
+            return (
+                [p for p in paths if p in cached],
+                [p for p in paths if p not in cached and p not in failed],
+            )
+
+        stale_ids = lib.ids[~np.isin(lib.ids, current_ids)]
+        known = np.isin(current_ids, lib.ids)
+        cached, uncached = split([path for path, k in zip(path_ids, known) if not k])
+        if uncached and may_encode and isinstance(model, ModelLoader):
+            # load the model while the stored vectors are read
+            model.prefetch()
+
+        unchanged = not len(stale_ids) and not cached and not uncached
+        with stage("index_load"):
+            loaded = load_library_vectors(model_name, lib, mmap=unchanged)
+        if not loaded:
+            lib = empty_library_index(source_dir, lib.requested_spec)
+            stale_ids = lib.ids
+            cached, uncached = split(list(path_ids))
+        elif unchanged:
+            logger.debug(f"Index for '{source_dir}' is up to date ({lib.ntotal} vectors)")
+            yield LibraryUpdate(lib, pending=0, final=True)
+            return
+
+        logger.info(
+            f"Updating index: {len(cached) + len(uncached)} to add, "
+            f"{len(stale_ids)} to remove"
+        )
+        if not remove_from_library_index(lib, stale_ids):
+            logger.info(f"{lib.spec.index_type} index can't delete vectors, rebuilding")
+            lib = empty_library_index(source_dir, lib.requested_spec)
+            cached, uncached = split(list(path_ids))
+
+        def add(embeddings: List[ImageEmbedding]) -> None:
+            paths = [e.path for e in embeddings]
+            with stage("index_add", items=len(paths)):
+                add_vectors_to_library_index(
+                    lib,
+                    paths,
+                    np.stack([e.embedding for e in embeddings]),
+                    [path_ids[p] for p in paths],
+                )
+
+        def add_stored(paths: List[Path]) -> List[Path]:
+            """Add the cached vectors of paths; returns those that couldn't be read"""
+            sample_size = training_sample_size(lib, len(paths))
+            if sample_size:
+                rng = np.random.default_rng(0)
+                picked = np.sort(rng.choice(len(paths), sample_size, replace=False))
+                _, sample = session().load_embedding_matrix(
+                    [paths[i] for i in picked], cache_keys
+                )
+                if len(sample):
+                    train_library_index(lib, sample, len(paths))
+            unread = []
+            for start in range(0, len(paths), INDEX_ADD_CHUNK):
+                chunk = paths[start : start + INDEX_ADD_CHUNK]
+                found, vectors = session().load_embedding_matrix(chunk, cache_keys)
+                if found:
+                    with stage("index_add", items=len(found)):
+                        add_vectors_to_library_index(
+                            lib, found, vectors, [path_ids[p] for p in found]
+                        )
+                if len(found) < len(chunk):
+                    stored = set(found)
+                    unread += [p for p in chunk if p not in stored]
+            return unread
+
+        # a new IVF index is trained once everything it will hold is cached
+        deferred = (
+            not budgeted and training_sample_size(lib, len(cached) + len(uncached)) > 0
+        )
+        if not deferred:
+            # cached rows that couldn't be read are encoded again
+            uncached += add_stored(cached)
+
+        to_encode = uncached[:max_encode] if may_encode else []
+        done = 0
+        encoded: List[Path] = []
+        if to_encode:
+            if budgeted:
+                session().commit()
+                yield LibraryUpdate(lib, pending=len(uncached), final=False)
+            logger.info(f"Processing {len(to_encode)} uncached images...")
+            deadline = (
+                time.monotonic() + max_encode_time
+                if max_encode_time is not None
+                else None
+            )
+            chunk_size = REFINE_CHUNK if budgeted else INDEX_ADD_CHUNK
+            new: List[ImageEmbedding] = []
+            batches = _encode_batches(
+                session(), to_encode, model, decode_workers, cache_keys, batch_size
+            )
+            try:
+                for processed, embeddings in batches:
+                    done += processed
+                    if deferred:
+                        encoded.extend(emb.path for _, emb in embeddings)
+                    else:
+                        new.extend(emb for _, emb in embeddings)
+                    if deadline is not None and time.monotonic() >= deadline:
+                        logger.info("Encoding time budget used up")
+                        break
+                    if len(new) >= chunk_size:
+                        add(new)
+                        new = []
+                        if budgeted and done < len(to_encode):
+                            session().commit()
+                            yield LibraryUpdate(
+                                lib, pending=len(uncached) - done, final=False
+                            )
+            finally:
+                batches.close()
+            if new:
+                add(new)
+
+        unread: List[Path] = []
+        if deferred:
+            session().commit()
+            unread = add_stored(cached + encoded)
+            if unread:
+                logger.warning(
+                    f"{len(unread)} embeddings couldn't be read back from the cache"
+                )
+
+        with stage("index_save", items=lib.ntotal):
+            save_library_index(model_name, lib)
+    pending = len(uncached) - done + len(unread)
+    if pending:
+        logger.info(f"{pending} images are not encoded yet and were left out")
+    yield LibraryUpdate(lib, pending=pending, final=True)
+
+
+def estimate_library_recall(
+    lib: LibraryIndex, model_name: str, k: int = 10, sample: int = 1000
+) -> float:
+    """recall@k of the library index against exact search over cached embeddings"""
+    if lib.index is None:
+        return 1.0
+    paths = [_decode_path(p) for p in lib.paths]
+    positions = {p: i for i, p in enumerate(paths)}
+    found, vectors = load_embedding_matrix(paths, model_name)
+    ids = lib.ids[[positions[p] for p in found]]
+    return estimate_recall(lib.index, vectors, ids, k=k, sample=sample)
+
+
+def _prepare_image(path: Path, model: "Model", min_size: int) -> "torch.Tensor":
+    from .embeddings import preprocess_image
+
+    return preprocess_image(load_image(path, min_size=min_size), model)
+
+
+def _iter_prepared_batches(
+    indices: List[int],
+    image_paths: List[Path],
+    model: "Model",
+    batch_size: int,
+    decode_workers: int,
+) -> Iterator[List[Tuple[int, Union["torch.Tensor", Exception]]]]:
+    """
+    Yield batches of (image_index, preprocessed tensor or load error)
+
+    With decode_workers > 0 images are decoded and preprocessed on a thread pool
+    that stays up to PREFETCH_BATCHES batches ahead of the consumer, so decoding
+    overlaps with inference. PIL and torchvision release the GIL for the heavy
+    parts, so threads scale without pickling tensors across processes.
+    """
+    from .embeddings import get_input_size
+
+    min_size = get_input_size(model)
+    batches = [
+        indices[start : start + batch_size]
+        for start in range(0, len(indices), batch_size)
+    ]
+
+    if decode_workers <= 0:
+        for batch in batches:
+            prepared: List[Tuple[int, Union["torch.Tensor", Exception]]] = []
+            for idx in batch:
+                try:
+                    prepared.append(
+                        (idx, _prepare_image(image_paths[idx], model, min_size))
+                    )
+                except Exception as e:
+                    prepared.append((idx, e))
+            yield prepared
+        return
+
+    with ThreadPoolExecutor(
+        max_workers=decode_workers, thread_name_prefix="vism-decode"
+    ) as pool:
+        pending: Deque[List[Tuple[int, Future]]] = deque()
+        batch_iter = iter(batches)
+
+        def submit_next() -> None:
+            batch = next(batch_iter, None)
+            if batch is not None:
+                pending.append(
+                    [
+                        (
+                            idx,
+                            pool.submit(
+                                _prepare_image, image_paths[idx], model, min_size
+                            ),
+                        )
+                        for idx in batch
+                    ]
+                )
+
+        for _ in range(PREFETCH_BATCHES):
+            submit_next()
+
+        while pending:
+            futures = pending.popleft()
+            submit_next()
+            prepared = []
+            for idx, future in futures:
+                try:
+                    prepared.append((idx, future.result()))
+                except Exception as e:
+                    prepared.append((idx, e))
+            yield prepared
 
 
 def get_or_compute_embeddings(
     image_paths: List[Path],
-    model: Model,
+    model: ModelSource,
     model_name: str,
+    decode_workers: int = 0,
+    cache_keys: Optional[Dict[Path, str]] = None,
+    batch_size: Optional[int] = None,
 ) -> List[ImageEmbedding]:
-    embeddings = []
-    batch_size = 64
+    with CacheSession(model_name) as cache:
+        return _get_or_compute_embeddings(
+            cache, image_paths, model, decode_workers, cache_keys, batch_size
+        )
+
 
+def _get_or_compute_embeddings(
+    cache: CacheSession,
+    image_paths: List[Path],
+    model: ModelSource,
+    decode_workers: int,
+    cache_keys: Optional[Dict[Path, str]],
+    batch_size: Optional[int] = None,
+) -> List[ImageEmbedding]:
     logger.debug("Loading cached embeddings...")
-    cached = load_cached_embeddings(
-        image_paths,
-        model_name,
-    )
-    failed = load_failed_paths(image_paths, model_name)
+    cached = cache.load_cached_embeddings(image_paths, cache_keys)
+    failed = cache.load_failed_paths(image_paths, cache_keys)
     if failed:
         logger.info(f"Skipping {len(failed)} previously failed images")
     embeddings = [cached.get(p) for p in image_paths]
@@ -69,25 +765,210 @@ def get_or_compute_embeddings(
 
     if uncached_indices:
         logger.info(f"Processing {len(uncached_indices)} uncached images...")
-        for batch_start in tqdm(
-            range(0, len(uncached_indices), batch_size), desc="Encoding"
+        uncached_paths = [image_paths[i] for i in uncached_indices]
+        for _, batch in _encode_batches(
+            cache, uncached_paths, model, decode_workers, cache_keys, batch_size
         ):
-            batch_indices = uncached_indices[batch_start : batch_start + batch_size]
-            batch_paths = [image_paths[i] for i in batch_indices]
-            imgs = []
-            valid_indices = []
-            for idx, path in zip(batch_indices, batch_paths):
-                try:
-                    img = load_image(path)
-                    imgs.append(img)
-                    valid_indices.append(idx)
-                except Exception as e:
-                    logger.error(f"Failed to load image {path}: {e}")
-                    mark_failed(path, model_name)
-            if imgs:
-                batch_embeddings = encode_images(imgs, model)
-                for idx, emb in zip(valid_indices, batch_embeddings):
-                    embeddings[idx] = emb
-                cache_embeddings(batch_embeddings, model_name)
+            for i, emb in batch:
+                embeddings[uncached_indices[i]] = emb
 
     return [emb for emb in embeddings if emb is not None]
+
+
+def _encode_batches(
+    cache: CacheSession,
+    image_paths: List[Path],
+    model: ModelSource,
+    decode_workers: int,
+    cache_keys: Optional[Dict[Path, str]],
+    batch_size: Optional[int] = None,
+) -> Iterator[Tuple[int, List[Tuple[int, ImageEmbedding]]]]:
+    """
+    Encode image_paths batch by batch, caching each batch and recording the
+    images that fail to load
+
+    Yields (images processed, [(index into image_paths, embedding)]) per
+    batch; stop iterating to stop encoding. With EncodeWorkers, batches are
+    encoded on worker processes and come back in the order they finish.
+    batch_size None calibrates one for the model (for workers, with their
+    thread count).
+    """
+    if isinstance(model, EncodeWorkers):
+        batches = encode_in_workers(model, image_paths, batch_size)
+        progress = tqdm(total=len(image_paths), desc="Encoding", unit="img")
+        try:
+            for processed, encoded, failures in batches:
+                progress.update(processed)
+                for idx, error in failures:
+                    logger.error(f"Failed to load image {image_paths[idx]}: {error}")
+                    cache.mark_failed(image_paths[idx], cache_keys)
+                embeddings = [
+                    (idx, ImageEmbedding(path=image_paths[idx], embedding=vector))
+                    for idx, vector in encoded
+                ]
+                if embeddings:
+                    cache.cache_embeddings([emb for _, emb in embeddings], cache_keys)
+                yield processed, embeddings
+        finally:
+            batches.close()
+            progress.close()
+        return
+
+    model = _resolve_model(model)
+    if batch_size is None:
+        batch_size = choose_batch_size(model, len(image_paths))
+    encoder = BatchEncoder(model, batch_size)
+    batches = _iter_prepared_batches(
+        list(range(len(image_paths))), image_paths, model, batch_size, decode_workers
+    )
+    for batch in tqdm(
+        batches,
+        total=(len(image_paths) + batch_size - 1) // batch_size,
+        desc="Encoding",
+    ):
+        valid_indices = []
+        tensors = []
+        for idx, item in batch:
+            if isinstance(item, Exception):
+                logger.error(f"Failed to load image {image_paths[idx]}: {item}")
+                cache.mark_failed(image_paths[idx], cache_keys)
+            else:
+                valid_indices.append(idx)
+                tensors.append(item)
+        batch_embeddings = (
+            encoder.encode([image_paths[i] for i in valid_indices], tensors)
+            if tensors
+            else []
+        )
+        if batch_embeddings:
+            cache.cache_embeddings(batch_embeddings, cache_keys)
+        yield len(batch), list(zip(valid_indices, batch_embeddings))
+
+
+def get_embedding_matrix(
+    image_paths: List[Path],
+    model: ModelSource,
+    model_name: str,
+    decode_workers: int = 0,
+    cache_keys: Optional[Dict[Path, str]] = None,
+    batch_size: Optional[int] = None,
+) -> Tuple[List[Path], np.ndarray]:
+    """
+    Like get_or_compute_embeddings, but return (paths, matrix) read straight
+    from the memory-mapped vector store instead of one array per image
+
+    Only uncached images are decoded and encoded, and only then is a
+    ModelLoader asked for the model. Paths are in storage order, which for a
+    library cached in one pass lets the matrix be a zero-copy view.
+    """
+    with CacheSession(model_name) as cache:
+        cached = cache.load_cached_paths(image_paths, cache_keys)
+        missing = [p for p in image_paths if p not in cached]
+        if missing and isinstance(model, ModelLoader):
+            failed = cache.load_failed_paths(missing, cache_keys)
+            if len(failed) < len(missing):
+                model.prefetch()
+        computed = (
+            _get_or_compute_embeddings(
+                cache, missing, model, decode_workers, cache_keys, batch_size
+            )
+            if missing
+            else []
+        )
+        paths, matrix = cache.load_embedding_matrix(image_paths, cache_keys)
+
+    stored = set(paths)
+    # embeddings whose cache write failed are only available in memory
+    unstored = [e for e in computed if e.path not in stored]
+    if unstored:
+        paths = paths + [e.path for e in unstored]
+        extra = np.stack([e.embedding for e in unstored]).astype(np.float32)
+        matrix = np.concatenate([matrix, extra]) if len(matrix) else extra
+    return paths, matrix
+
+
+# Duplicate finding stages for find_library_duplicates
+DUPES_MODES = ("phash", "embed", "both")
+
+
+def find_library_duplicates(
+    cache_keys: Dict[Path, str],
+    get_model: Callable[[], "Model"],
+    model_name: str,
+    threshold: float = 0.95,
+    mode: str = "embed",
+    max_distance: int = DEFAULT_MAX_DISTANCE,
+    spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+    decode_workers: int = 0,
+    eval_recall: int = 0,
+    batch_size: Optional[int] = None,
+) -> Tuple[List[List[Tuple[Path, float]]], Optional[float]]:
+    """
+    Cluster near-duplicates among scanned images; returns (clusters, recall)
+
+    mode "phash" groups by perceptual hash only and never loads the model.
+    "embed" compares model embeddings. "both" groups by hash first and sends
+    only one image per hash group (plus the unhashable ones) through the
+    model, then merges both sets of edges. get_model is only called when
+    images need encoding, so a fully cached library never loads the model.
+    recall is None unless eval_recall > 0.
+    """
+    if mode not in DUPES_MODES:
+        raise ValueError(f"Unknown dupes mode '{mode}'")
+
+    paths = list(cache_keys)
+    position = {p: i for i, p in enumerate(paths)}
+    srcs: List[np.ndarray] = []
+    dsts: List[np.ndarray] = []
+    sims: List[np.ndarray] = []
+    embed_paths = paths
+
+    if mode in ("phash", "both"):
+        hashes = get_or_compute_phashes(paths, cache_keys, workers=decode_workers)
+        hashed = [p for p in paths if p in hashes]
+        hashed_pos = np.array([position[p] for p in hashed], dtype=np.int64)
+        src, dst, sim = phash_edges([hashes[p] for p in hashed], max_distance)
+        srcs.append(hashed_pos[src])
+        dsts.append(hashed_pos[dst])
+        sims.append(sim)
+        if mode == "both":
+            labels = _connected_components(len(hashed), src, dst)
+            covered = {
+                hashed[i] for i in np.flatnonzero(labels != np.arange(len(hashed)))
+            }
+            embed_paths = [p for p in paths if p not in covered]
+            logger.info(
+                f"{len(covered)} images matched by perceptual hash, "
+                f"encoding {len(embed_paths)}"
+            )
+
+    recall = None
+    if mode in ("embed", "both") and len(embed_paths) >= 2:
+        found, vectors = get_embedding_matrix(
+            embed_paths,
+            ModelLoader(get_model),
+            model_name,
+            decode_workers=decode_workers,
+            cache_keys=cache_keys,
+            batch_size=batch_size,
+        )
+        if len(found) >= 2:
+            src, dst, sim = duplicate_edges(
+                vectors, threshold, spec=spec, nprobe=nprobe
+            )
+            found_pos = np.array([position[p] for p in found], dtype=np.int64)
+            srcs.append(found_pos[src])
+            dsts.append(found_pos[dst])
+            sims.append(sim)
+            if eval_recall:
+                recall = estimate_dupes_recall(
+                    vectors, src, dst, threshold, sample=eval_recall
+                )
+
+    if not srcs:
+        return [], recall
+    clusters = clusters_from_edges(
+        paths, np.concatenate(srcs), np.concatenate(dsts), np.concatenate(sims)
+    )
+    return clusters, recall
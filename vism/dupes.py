@@ -1,8 +1,10 @@
 import numpy as np
 import faiss
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import logging
+from .search import IndexSpec, create_index, set_search_params
+from .profiling import stage
 from .types import ImageEmbedding
 
 logger = logging.getLogger(__name__)
@@ -12,35 +14,20 @@ ClusterMember = Tuple[int, float]
 Cluster = List[ClusterMember]
 
 
-class _UnionFind:
-    def __init__(self, n: int) -> None:
-        self.parent = list(range(n))
+# Query rows per range search call; bounds the size of one result batch
+RANGE_SEARCH_CHUNK = 4096
 
-    def find(self, x: int) -> int:
-        while self.parent[x] != x:
-            self.parent[x] = self.parent[self.parent[x]]  # path compression
-            x = self.parent[x]
-        return x
-
-    def union(self, x: int, y: int) -> None:
-        self.parent[self.find(x)] = self.find(y)
-
-    def groups(self) -> List[List[int]]:
-        from collections import defaultdict
-
-        buckets: dict[int, List[int]] = defaultdict(list)
-        for i in range(len(self.parent)):
-            buckets[self.find(i)].append(i)
-        return [g for g in buckets.values() if len(g) > 1]
+# How far below the threshold PQ-compressed similarities are still treated as
+# candidates; PQ distance error is typically a few hundredths on unit vectors
+PQ_CANDIDATE_MARGIN = 0.05
 
 
 def find_duplicates(
     embeddings: List[ImageEmbedding],
     threshold: float = 0.95,
-    k: int = 64,
 ) -> List[List[Tuple[Path, float]]]:
     """
-    Find clusters of near-duplicate images using FAISS + union-find
+    Find clusters of near-duplicate images using a FAISS range search
 
     Returns a list of clusters, each cluster being a list of
     (path, max_similarity_to_any_other_cluster_member) sorted by score desc
@@ -48,40 +35,242 @@ def find_duplicates(
     """
     if len(embeddings) < 2:
         return []
+    return find_duplicate_clusters(
+        [e.path for e in embeddings],
+        np.stack([e.embedding for e in embeddings]),
+        threshold=threshold,
+    )
+
+
+def find_duplicate_clusters(
+    paths: List[Path],
+    vectors: np.ndarray,
+    threshold: float = 0.95,
+    spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+) -> List[List[Tuple[Path, float]]]:
+    """
+    Same as find_duplicates, over an (n, dim) matrix whose row i belongs to paths[i]
+
+    spec selects the engine: None or flat is an exact all-pairs search, ivf-flat
+    and ivf-pq trade recall (tuned by nprobe) for speed and memory, see
+    duplicate_edges.
+    """
+    if len(paths) < 2:
+        return []
+    src, dst, sims = duplicate_edges(vectors, threshold, spec=spec, nprobe=nprobe)
+    return clusters_from_edges(paths, src, dst, sims)
 
-    vectors = np.stack([e.embedding for e in embeddings]).astype("float32")
+
+def duplicate_edges(
+    vectors: np.ndarray,
+    threshold: float = 0.95,
+    spec: Optional[IndexSpec] = None,
+    nprobe: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Pairs of rows with similarity >= threshold as (src, dst, similarity) arrays
+
+    The exact engine holds a float32 copy of vectors in a flat index and
+    compares every pair. The IVF engines only compare vectors that fall in the
+    same nprobe inverted lists; ivf-pq also stores vectors as PQ codes of a few
+    bytes each, so index memory no longer grows with n * dim. Vectors are added
+    and queried in chunks, which lets vectors be a memory-mapped matrix.
+    Approximate candidates are re-scored exactly, so reported similarities are
+    exact and only recall is traded.
+    """
+    with stage("dupes_edges", items=len(vectors)):
+        return _duplicate_edges(vectors, threshold, spec, nprobe)
+
+
+def _duplicate_edges(
+    vectors: np.ndarray,
+    threshold: float,
+    spec: Optional[IndexSpec],
+    nprobe: Optional[int],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    n, d = vectors.shape
+    if spec is None or spec.index_type == "flat":
+        index = faiss.IndexFlatIP(d)
+        _add_in_chunks(index, vectors)
+        return _range_search_edges(index, vectors, threshold)
+
+    if spec.index_type not in ("ivf-flat", "ivf-pq"):
+        raise ValueError(f"{spec.index_type} index can't be used to find duplicates")
+    index, built = create_index(vectors, spec)
+    if built.index_type == "flat":
+        # too few vectors to train, create_index fell back to an exact index
+        index = faiss.IndexFlatIP(d)
+    _add_in_chunks(index, vectors)
+    set_search_params(index, nprobe=nprobe)
+
+    margin = PQ_CANDIDATE_MARGIN if built.index_type == "ivf-pq" else 0.0
+    src, dst, _ = _range_search_edges(index, vectors, threshold - margin)
+    sims = _exact_similarities(vectors, src, dst)
+    keep = sims >= threshold
+    return src[keep], dst[keep], sims[keep]
+
+
+def _add_in_chunks(index: faiss.Index, vectors: np.ndarray) -> None:
+    for start in range(0, len(vectors), RANGE_SEARCH_CHUNK * 16):
+        chunk = vectors[start : start + RANGE_SEARCH_CHUNK * 16]
+        index.add(np.ascontiguousarray(chunk, dtype="float32"))  # type: ignore
+
+
+def _exact_similarities(
+    vectors: np.ndarray, src: np.ndarray, dst: np.ndarray
+) -> np.ndarray:
+    sims = np.empty(len(src), dtype=np.float32)
+    step = RANGE_SEARCH_CHUNK * 16
+    for start in range(0, len(src), step):
+        a = np.asarray(vectors[src[start : start + step]], dtype=np.float32)
+        b = np.asarray(vectors[dst[start : start + step]], dtype=np.float32)
+        sims[start : start + step] = np.einsum("ij,ij->i", a, b)
+    return sims
+
+
+def estimate_dupes_recall(
+    vectors: np.ndarray,
+    src: np.ndarray,
+    dst: np.ndarray,
+    threshold: float = 0.95,
+    sample: int = 1000,
+) -> float:
+    """
+    Fraction of the true duplicate pairs of a random sample of rows that the
+    (src, dst) edges contain, measured against exact search over vectors
+    """
+    with stage("dupes_recall", items=min(sample, len(vectors))):
+        return _estimate_dupes_recall(vectors, src, dst, threshold, sample)
+
+
+def _estimate_dupes_recall(
+    vectors: np.ndarray,
+    src: np.ndarray,
+    dst: np.ndarray,
+    threshold: float,
+    sample: int,
+) -> float:
     n = len(vectors)
-    k = min(k, n)
+    if n < 2:
+        return 1.0
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(n, min(sample, n), replace=False))
+    queries = np.ascontiguousarray(vectors[rows], dtype="float32")
 
-    index = faiss.IndexFlatIP(vectors.shape[1])
-    index.add(vectors)  # type: ignore
+    # brute force against one block of vectors at a time, so memory stays
+    # bounded by the block rather than the library
+    exact_pairs = set()
+    step = RANGE_SEARCH_CHUNK * 16
+    for start in range(0, n, step):
+        block = np.asarray(vectors[start : start + step], dtype=np.float32)
+        q, b = np.nonzero(queries @ block.T >= threshold)
+        exact_pairs.update(zip(rows[q].tolist(), (b + start).tolist()))
+    exact_pairs = {(a, b) for a, b in exact_pairs if a != b}
+    if not exact_pairs:
+        return 1.0
 
-    scores, indices = index.search(vectors, k)  # type: ignore
+    sampled = np.isin(src, rows)
+    found = set(zip(src[sampled].tolist(), dst[sampled].tolist()))
+    sampled = np.isin(dst, rows)
+    # edges are found from either end, count them in both directions
+    found |= set(zip(dst[sampled].tolist(), src[sampled].tolist()))
+    return len(exact_pairs & found) / len(exact_pairs)
 
-    uf = _UnionFind(n)
-    # max similarity each node has to any neighbor above threshold
-    max_sim: List[float] = [0.0] * n
 
-    for i in range(n):
-        for j_pos in range(1, k):  # skip self at position 0
-            j = int(indices[i, j_pos])
-            if j == -1:
-                break
-            sim = float(scores[i, j_pos])
-            if sim < threshold:
-                break  # scores are descending, no point continuing
-            uf.union(i, j)
-            if sim > max_sim[i]:
-                max_sim[i] = sim
-            if sim > max_sim[j]:
-                max_sim[j] = sim
-
-    clusters: List[List[Tuple[Path, float]]] = []
-    for group in uf.groups():
-        members = sorted(
-            [(embeddings[i].path, max_sim[i]) for i in group],
-            key=lambda x: -x[1],
+def _range_search_edges(
+    index: faiss.Index,
+    queries: np.ndarray,
+    threshold: float,
+    query_ids: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    All pairs with similarity >= threshold as (src, dst, similarity) arrays
+
+    queries[i] has id query_ids[i] (default i, i.e. the queries are the indexed
+    vectors). Unlike a top-k search there is no cap on neighbours per image, so
+    large clusters of identical images are found in full. Self matches are
+    dropped.
+    """
+    if query_ids is None:
+        query_ids = np.arange(len(queries), dtype=np.int64)
+    # range_search keeps results strictly above the radius
+    radius = float(np.nextafter(np.float32(threshold), np.float32(-np.inf)))
+    srcs, dsts, scores = [], [], []
+    for start in range(0, len(queries), RANGE_SEARCH_CHUNK):
+        chunk = np.ascontiguousarray(
+            queries[start : start + RANGE_SEARCH_CHUNK], dtype="float32"
+        )
+        lims, chunk_scores, chunk_ids = index.range_search(chunk, radius)  # type: ignore
+        chunk_src = np.repeat(
+            query_ids[start : start + len(chunk)], np.diff(lims).astype(np.int64)
         )
-        clusters.append(members)
+        keep = chunk_ids != chunk_src
+        srcs.append(chunk_src[keep])
+        dsts.append(chunk_ids[keep])
+        scores.append(chunk_scores[keep])
+    if not srcs:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float32)
+    return np.concatenate(srcs), np.concatenate(dsts), np.concatenate(scores)
+
+
+def _connected_components(n: int, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """
+    Label each of n nodes with the smallest node index in its component
+
+    Min-label propagation over the edge arrays with pointer jumping, so the
+    number of rounds grows with the log of the component diameter rather
+    than with the number of edges.
+    """
+    labels = np.arange(n, dtype=np.int64)
+    while True:
+        edge_min = np.minimum(labels[src], labels[dst])
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, src, edge_min)
+        np.minimum.at(new_labels, dst, edge_min)
+        # also lower each label's own root, then jump to it
+        np.minimum.at(new_labels, labels, new_labels)
+        while True:
+            jumped = new_labels[new_labels]
+            if np.array_equal(jumped, new_labels):
+                break
+            new_labels = jumped
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def clusters_from_edges(
+    paths: List[Path], src: np.ndarray, dst: np.ndarray, sims: np.ndarray
+) -> List[List[Tuple[Path, float]]]:
+    """Group paths connected by (src, dst, similarity) edges into sorted clusters"""
+    n = len(paths)
+    if not len(src):
+        return []
+
+    with stage("dupes_cluster", items=n):
+        return _clusters_from_edges(paths, src, dst, sims)
+
+
+def _clusters_from_edges(
+    paths: List[Path], src: np.ndarray, dst: np.ndarray, sims: np.ndarray
+) -> List[List[Tuple[Path, float]]]:
+    n = len(paths)
+    # max similarity each node has to any neighbor above threshold
+    max_sim = np.zeros(n, dtype=np.float32)
+    np.maximum.at(max_sim, src, sims)
+    np.maximum.at(max_sim, dst, sims)
+
+    labels = _connected_components(n, src, dst)
+    members = np.flatnonzero(np.bincount(labels, minlength=n)[labels] > 1)
+    # group by label, and by descending score within a group
+    order = np.lexsort((-max_sim[members], labels[members]))
+    members = members[order]
+    bounds = np.flatnonzero(np.diff(labels[members])) + 1
 
+    clusters: List[List[Tuple[Path, float]]] = [
+        [(paths[i], float(max_sim[i])) for i in group]
+        for group in np.split(members, bounds)
+    ]
     return sorted(clusters, key=lambda c: -len(c))
@@ -1,19 +1,25 @@
 import torch
 import numpy as np
-from typing import List, Tuple, cast
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, cast
 from torchvision import transforms
 import logging
+from .profiling import stage
 from .types import ImageData, ImageEmbedding
 
 logger = logging.getLogger(__name__)
 
 Model = Tuple[torch.nn.Module, transforms.Compose, str]
+# (text encoder, tokenizer, device)
+TextModel = Tuple[torch.nn.Module, Callable[[List[str]], torch.Tensor], str]
+
+DINOV2_INPUT_SIZE = 224
 
 
 def _dinov2_preprocess() -> transforms.Compose:
     return transforms.Compose(
         [
-            transforms.Resize((224, 224)),
+            transforms.Resize((DINOV2_INPUT_SIZE, DINOV2_INPUT_SIZE)),
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ]
@@ -31,6 +37,74 @@ class _ClipWrapper(torch.nn.Module):
         return self._clip.encode_image(x)
 
 
+class _ClipTextEncoder(torch.nn.Module):
+    """CLIP's text tower alone; forward() maps token ids to text embeddings."""
+
+    def __init__(self, clip_model: torch.nn.Module) -> None:
+        super().__init__()
+        # the image tower is most of the weights and never used for text queries
+        clip_model.visual = torch.nn.Identity()
+        self._clip = clip_model
+
+    def forward(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self._clip.encode_text(tokens)
+
+
+INFERENCE_BACKENDS = ("torch", "onnx")
+# Inference precisions; bfloat16 autocasts the torch forward pass, int8 runs
+# a quantized ONNX graph
+INFERENCE_PRECISIONS = ("float32", "bfloat16", "int8")
+_BACKEND_PRECISIONS = {"torch": ("float32", "bfloat16"), "onnx": ("float32", "int8")}
+
+
+def bf16_supported(device: str) -> bool:
+    """Whether device runs bfloat16 natively rather than through slow emulation"""
+    if device == "cuda":
+        return torch.cuda.is_bf16_supported()
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+class _InferenceWrapper(torch.nn.Module):
+    """
+    Runs a model under bfloat16 autocast and/or torch.compile
+
+    Inputs and conv weights are switched to channels-last, the layout the
+    oneDNN CPU kernels are fastest with. Compilation happens on the first
+    batch; if it fails (e.g. no C++ compiler), the model runs eagerly.
+    """
+
+    def __init__(
+        self, module: torch.nn.Module, device: str, precision: str, compile: bool
+    ) -> None:
+        super().__init__()
+        self.module = module.to(memory_format=torch.channels_last)  # type: ignore
+        self.device = device
+        self.precision = precision
+        self._compiled = torch.compile(self.module) if compile else None
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(
+            device_type=self.device,
+            dtype=torch.bfloat16,
+            enabled=self.precision == "bfloat16",
+        ):
+            if self._compiled is not None:
+                try:
+                    return self._compiled(x).float()
+                except Exception as e:
+                    logger.warning(f"torch.compile failed, running eagerly: {e}")
+                    self._compiled = None
+            return self.module(x).float()
+
+
+def _unwrap(module: torch.nn.Module) -> torch.nn.Module:
+    return module.module if isinstance(module, _InferenceWrapper) else module
+
+
 def _parse_clip_name(name: str) -> Tuple[str, str]:
     """'clip_ViT-B-32_openai' → ('ViT-B-32', 'openai')"""
     parts = name.split("_", 2)
@@ -39,37 +113,167 @@ def _parse_clip_name(name: str) -> Tuple[str, str]:
     return parts[1], parts[2]
 
 
-def load_model(name: str) -> Model:
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-
+def _build_model(name: str) -> Tuple[torch.nn.Module, transforms.Compose]:
+    """Construct a model from torch.hub / open_clip, downloading code and weights if needed"""
     if name.startswith("clip_"):
         import open_clip
 
         arch, pretrained = _parse_clip_name(name)
-        logger.debug(f"Loading CLIP {arch}/{pretrained} → {device}")
-        clip_model, _, preprocess_pil = open_clip.create_model_and_transforms(
-            arch, pretrained=pretrained
-        )
-        clip_model.eval()
-        clip_model = clip_model.to(device)
-        model: torch.nn.Module = _ClipWrapper(clip_model)
-        # open_clip returns a torchvision-compatible transform; wrap it so our
-        # pipeline can handle PIL Images the same way as DINOv2.
-        preprocess = transforms.Compose([preprocess_pil])
+        logger.debug(f"Building CLIP {arch}/{pretrained}")
+        clip_model = open_clip.create_model(arch, pretrained=pretrained)
+        module: torch.nn.Module = _ClipWrapper(clip_model)
     else:
-        logger.debug(f"Loading DINOv2 {name} → {device}")
-        model = cast(torch.nn.Module, torch.hub.load("facebookresearch/dinov2", name))
-        model.eval()
-        model = model.to(device)
-        preprocess = _dinov2_preprocess()
+        logger.debug(f"Building DINOv2 {name}")
+        module = cast(torch.nn.Module, torch.hub.load("facebookresearch/dinov2", name))
+    return module, preprocess_from_config(preprocess_config(module))
+
+
+def preprocess_config(module: torch.nn.Module) -> Optional[Dict[str, Any]]:
+    """JSON-able description of a model's transform; None means DINOv2's"""
+    module = _unwrap(module)
+    if isinstance(module, _ClipWrapper):
+        return dict(module._clip.visual.preprocess_cfg)
+    return None
+
+
+def preprocess_from_config(config: Optional[Dict[str, Any]]) -> transforms.Compose:
+    """Rebuild a transform from preprocess_config() without the model"""
+    if config is None:
+        return _dinov2_preprocess()
+
+    from open_clip.transform import PreprocessCfg, image_transform_v2
+
+    if isinstance(config["size"], list):
+        config = {**config, "size": tuple(config["size"])}
+    # same eval transform open_clip.create_model_and_transforms returns; wrapped
+    # so our pipeline handles PIL images the same way as for DINOv2
+    return transforms.Compose(
+        [image_transform_v2(PreprocessCfg(**config), is_train=False)]
+    )
+
+
+def check_inference_options(backend: str, precision: str, compile: bool) -> None:
+    """Raise ValueError for option combinations load_model can't honor"""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', expected one of {INFERENCE_BACKENDS}")
+    if precision not in _BACKEND_PRECISIONS[backend]:
+        raise ValueError(
+            f"The {backend} backend supports precisions {_BACKEND_PRECISIONS[backend]}, "
+            f"not '{precision}'"
+        )
+    if compile and backend != "torch":
+        raise ValueError("compile only applies to the torch backend")
+
+
+def load_model(
+    name: str,
+    precision: str = "float32",
+    compile: bool = False,
+    backend: str = "torch",
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+) -> Model:
+    """
+    Load a model for inference
+
+    With the torch backend, precision "bfloat16" autocasts the forward pass
+    and compile runs it through torch.compile. The onnx backend runs an
+    exported graph through ONNX Runtime (see onnx_backend), in float32 or
+    int8, with the given thread counts (0: runtime default). Embeddings of
+    different precisions belong in separate caches, see
+    cache.inference_cache_name.
+    """
+    check_inference_options(backend, precision, compile)
+    if backend == "onnx":
+        from .onnx_backend import load_onnx_model
+
+        return load_onnx_model(name, precision, intra_op_threads, inter_op_threads)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    from .model_store import load_model_artifact, save_model_artifact
+
+    loaded = load_model_artifact(name)
+    if loaded is None:
+        loaded = _build_model(name)
+        try:
+            save_model_artifact(name, loaded[0])
+        except Exception as e:
+            logger.warning(f"Failed to cache model artifact for {name}: {e}")
+    model, preprocess = loaded
+    model = model.eval().to(device)
+    logger.debug(f"Loaded {name} → {device}")
+
+    if precision == "bfloat16" and not bf16_supported(device):
+        logger.warning(f"No native bfloat16 support on {device}, inference may be slower")
+    if precision != "float32" or compile:
+        model = _InferenceWrapper(model, device, precision, compile)
 
     return model, preprocess, device
 
 
+def get_input_size(model: Model) -> int:
+    """Side length (pixels) of the square input the model's transform produces"""
+    module = _unwrap(model[0])
+    # the ONNX backend records the size it was exported with
+    input_size = getattr(module, "input_size", None)
+    if input_size is not None:
+        return int(input_size)
+    if isinstance(module, _ClipWrapper):
+        size = module._clip.visual.image_size
+        return max(size) if isinstance(size, (tuple, list)) else int(size)
+    return DINOV2_INPUT_SIZE
+
+
+def load_text_model(name: str) -> TextModel:
+    """
+    Load the text tower of a CLIP model, for text-to-image search
+
+    It is saved as its own artifact ("<name>_text"), split off the image
+    model's artifact when there is one, so text queries never page in the
+    image weights.
+    """
+    if not name.startswith("clip_"):
+        raise ValueError(f"Text search needs a CLIP model, not '{name}'")
+    import open_clip
+
+    from .model_store import load_model_artifact, save_model_artifact
+
+    arch, pretrained = _parse_clip_name(name)
+    artifact = f"{name}_text"
+    loaded = load_model_artifact(artifact)
+    if loaded is not None:
+        module = loaded[0]
+    else:
+        image_model = load_model_artifact(name)
+        if image_model is not None and isinstance(image_model[0], _ClipWrapper):
+            clip_model = image_model[0]._clip
+        else:
+            logger.debug(f"Building CLIP {arch}/{pretrained}")
+            clip_model = open_clip.create_model(arch, pretrained=pretrained)
+        module = _ClipTextEncoder(clip_model)
+        try:
+            save_model_artifact(artifact, module)
+        except Exception as e:
+            logger.warning(f"Failed to cache model artifact for {artifact}: {e}")
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    module = module.eval().to(device)
+    logger.debug(f"Loaded {name} text encoder → {device}")
+    return module, open_clip.get_tokenizer(arch), device
+
+
+def encode_texts(texts: List[str], text_model: TextModel) -> np.ndarray:
+    """Normalized embeddings of texts, one row per text"""
+    module, tokenizer, device = text_model
+    with stage("text_inference", items=len(texts)):
+        return _compute_embeddings(tokenizer(texts).to(device), module)
+
+
 def _compute_embeddings(
     batch_tensor: torch.Tensor, model_dino: torch.nn.Module
 ) -> np.ndarray:
-    with torch.no_grad():
+    with torch.inference_mode():
         embeddings = model_dino(batch_tensor)
         embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True)
     return embeddings.cpu().numpy().astype(np.float32)
@@ -82,12 +286,30 @@ def encode_image(img: ImageData, model: Model) -> ImageEmbedding:
     return ImageEmbedding(path=img.path, embedding=embedding)
 
 
-def encode_images(imgs: List[ImageData], model: Model) -> List[ImageEmbedding]:
-    model_dino, preprocess, device = model
-    processed_images = [cast(torch.Tensor, preprocess(img.image)) for img in imgs]
-    batch_tensor = torch.stack(processed_images).to(device)
-    embeddings_array = _compute_embeddings(batch_tensor, model_dino)
+def preprocess_image(img: ImageData, model: Model) -> torch.Tensor:
+    """Apply the model's transform to a single image (safe to call from worker threads)"""
+    _, preprocess, _ = model
+    with stage("preprocess", items=1):
+        return cast(torch.Tensor, preprocess(img.image))
+
+
+def encode_preprocessed(
+    paths: List[Path], tensors: List[torch.Tensor], model: Model
+) -> List[ImageEmbedding]:
+    """Encode a batch of already preprocessed image tensors"""
+    model_dino, _, device = model
+    with stage("inference", items=len(tensors)):
+        batch_tensor = torch.stack(tensors).to(device)
+        embeddings_array = _compute_embeddings(batch_tensor, model_dino)
     return [
-        ImageEmbedding(path=img.path, embedding=embedding)
-        for img, embedding in zip(imgs, embeddings_array)
+        ImageEmbedding(path=path, embedding=embedding)
+        for path, embedding in zip(paths, embeddings_array)
     ]
+
+
+def encode_images(imgs: List[ImageData], model: Model) -> List[ImageEmbedding]:
+    return encode_preprocessed(
+        [img.path for img in imgs],
+        [preprocess_image(img, model) for img in imgs],
+        model,
+    )
@@ -1,26 +1,137 @@
 import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from PIL import Image
-from typing import List
-from .types import ImageData
+from typing import List, Optional, Set, Tuple
+import logging
+from .profiling import stage
+from .types import FileEntry, ImageData
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
+
+# Directories listed concurrently by scan_images; stat latency dominates on
+# network mounts, so this is worth having well above the core count
+SCAN_WORKERS = 16
 
 
 def find_images_recursive(directory: Path) -> List[Path]:
+    return [entry.path for entry in scan_images(directory)]
+
+
+def _scan_dir(directory: str) -> Tuple[List[FileEntry], List[str]]:
+    """List one directory: (image entries with their stat, subdirectories)"""
+    entries = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        # like os.walk, don't descend into symlinked directories
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                        continue
+                    _, ext = os.path.splitext(entry.name)
+                    if ext.lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    stat = entry.stat()
+                except OSError as e:
+                    logger.warning(f"Skipping '{entry.path}': {e}")
+                    continue
+                entries.append(
+                    FileEntry(
+                        path=Path(entry.path), size=stat.st_size, mtime_ns=stat.st_mtime_ns
+                    )
+                )
+    except OSError as e:
+        logger.warning(f"Can't list directory '{directory}': {e}")
+    return entries, subdirs
+
+
+def scan_images(directory: Path, workers: int = SCAN_WORKERS) -> List[FileEntry]:
+    """
+    Find images under directory in a single pass, with their size and mtime
+
+    Each file is stat'ed exactly once (scandir gets the type for free on most
+    filesystems), and with workers > 0 subdirectories are listed concurrently.
+    Entries are sorted by path.
+    """
     if not directory.is_dir():
         raise NotADirectoryError(directory)
 
-    valid_exts = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tiff"}
-    paths = []
+    found: List[FileEntry] = []
+    if workers <= 0:
+        stack = [str(directory)]
+        while stack:
+            entries, subdirs = _scan_dir(stack.pop())
+            found.extend(entries)
+            stack.extend(subdirs)
+    else:
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vism-scan"
+        ) as pool:
+            pending: Set[Future] = {pool.submit(_scan_dir, str(directory))}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entries, subdirs = future.result()
+                    found.extend(entries)
+                    pending.update(pool.submit(_scan_dir, d) for d in subdirs)
+
+    return sorted(found, key=lambda e: e.path)
+
+
+def resolve_queries(query: Path) -> List[Path]:
+    """
+    Expand a query argument into query image paths
+
+    A directory yields all images under it, an image file yields itself, and
+    any other file is read as a list of image paths, one per line (blank lines
+    and lines starting with '#' are skipped). Relative paths in a list are
+    relative to the list file, not the working directory.
+    """
+    if query.is_dir():
+        return find_images_recursive(query)
+    if query.suffix.lower() in IMAGE_EXTENSIONS:
+        return [query]
+    with open(query, encoding="utf-8", errors="surrogateescape") as f:
+        lines = (line.strip() for line in f)
+        return [
+            query.parent / line for line in lines if line and not line.startswith("#")
+        ]
+
+
+def _decode_reduced(img: Image.Image, min_size: int) -> Image.Image:
+    """
+    Decode at the smallest scale whose sides are still >= min_size
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            _, ext = os.path.splitext(file)
-            if ext.lower() in valid_exts:
-                paths.append(Path(root) / file)
+    JPEGs are decoded with DCT scaling (1/2, 1/4, 1/8) via draft mode, so the
+    full-resolution pixels are never materialized. Other formats are decoded
+    fully and shrunk by an integer box reduction before further processing.
+    """
+    if img.format == "JPEG":
+        img.draft("RGB", (min_size, min_size))
+        return img.convert("RGB")
 
-    return sorted(paths)
+    img = img.convert("RGB")
+    factor = min(img.width, img.height) // min_size
+    if factor >= 2:
+        img = img.reduce(factor)
+    return img
 
 
-def load_image(path: Path) -> ImageData:
-    with open(path, "rb") as f:
-        return ImageData(path=path, image=Image.open(f).convert("RGB"))
+def load_image(path: Path, min_size: Optional[int] = None) -> ImageData:
+    """
+    Load an image as RGB. With min_size, decode at reduced resolution while
+    keeping both sides at least min_size pixels (the model's input size)
+    """
+    with stage("decode", items=1) as s, open(path, "rb") as f:
+        img = Image.open(f)
+        if min_size is not None:
+            img = _decode_reduced(img, min_size)
+        else:
+            img = img.convert("RGB")
+        s.add(bytes_read=f.tell())
+        return ImageData(path=path, image=img)
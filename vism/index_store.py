@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Optional
+
+import faiss
+import numpy as np
+import logging
+
+from .cache import _decode_path, _get_cache_db
+from .search import _MAX_TRAIN_POINTS, IndexSpec, create_index, needs_training
+from .types import SearchResult
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class LibraryIndex:
+    """
+    FAISS index over one source directory, persisted next to the model's cache db
+
+    Vectors are added under ids derived from their cache keys, so a changed file
+    gets a new id and its old vector shows up as stale. ids[i] and paths[i]
+    describe the same vector; order is insertion order, not index order.
+    spec is the index that was built, requested_spec the one asked for; they
+    differ while the library is too small to train the requested index.
+    """
+
+    root: Path
+    spec: IndexSpec
+    requested_spec: IndexSpec
+    index: Optional[faiss.Index]
+    ids: np.ndarray
+    paths: List[bytes]
+
+    @property
+    def ntotal(self) -> int:
+        return 0 if self.index is None else int(self.index.ntotal)
+
+
+def cache_key_to_id(cache_key: str) -> int:
+    """Map a sha256 cache key to a non-negative int64 FAISS id"""
+    return int(cache_key[:15], 16)
+
+
+def _get_index_dir(model_name: str) -> Path:
+    db_path = _get_cache_db(model_name)
+    return db_path.with_name(f"{db_path.stem}.indexes")
+
+
+def _get_index_base(model_name: str, root: Path) -> Path:
+    root_hash = hashlib.sha256(
+        str(root.absolute()).encode(errors="surrogateescape")
+    ).hexdigest()[:16]
+    return _get_index_dir(model_name) / root_hash
+
+
+def _index_files(base: Path) -> tuple[Path, Path, Path, Path]:
+    return (
+        base.with_suffix(".faiss"),
+        base.with_suffix(".ids.npy"),
+        base.with_suffix(".paths"),
+        base.with_suffix(".json"),
+    )
+
+
+def empty_library_index(root: Path, spec: IndexSpec = IndexSpec()) -> LibraryIndex:
+    return LibraryIndex(
+        root=root.absolute(),
+        spec=spec,
+        requested_spec=spec,
+        index=None,
+        ids=np.empty(0, dtype=np.int64),
+        paths=[],
+    )
+
+
+def load_library_ids(model_name: str, root: Path) -> Optional[LibraryIndex]:
+    """
+    Load the id/path tables of a persisted index without reading the vectors
+
+    Returns None if no usable index exists for this model and root.
+    """
+    index_path, ids_path, paths_path, meta_path = _index_files(
+        _get_index_base(model_name, root)
+    )
+    if not (index_path.exists() and ids_path.exists() and paths_path.exists()):
+        return None
+
+    try:
+        ids = np.load(ids_path)
+        raw = paths_path.read_bytes()
+        paths = raw.split(b"\0") if raw else []
+        meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+        spec = IndexSpec(**meta.get("spec", {}))
+        requested_spec = IndexSpec(**meta.get("requested_spec", meta.get("spec", {})))
+    except Exception as e:
+        logger.warning(f"Failed to read persisted index for '{root}': {e}")
+        return None
+
+    if len(ids) != len(paths) or meta.get("ntotal", len(ids)) != len(ids):
+        logger.warning(f"Persisted index for '{root}' is inconsistent, rebuilding")
+        return None
+
+    return LibraryIndex(
+        root=root.absolute(),
+        spec=spec,
+        requested_spec=requested_spec,
+        index=None,
+        ids=ids,
+        paths=paths,
+    )
+
+
+def load_library_vectors(model_name: str, lib: LibraryIndex, mmap: bool) -> bool:
+    """
+    Attach the FAISS index to lib. With mmap the vectors stay on disk and are
+    paged in on demand; the index is then read-only.
+    """
+    if not lib.paths:
+        return True
+
+    index_path = _index_files(_get_index_base(model_name, lib.root))[0]
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    try:
+        index = faiss.read_index(str(index_path), flags)
+    except Exception as e:
+        logger.warning(f"Failed to load persisted index for '{lib.root}': {e}")
+        return False
+
+    if index.ntotal != len(lib.ids):
+        logger.warning(f"Persisted index for '{lib.root}' is inconsistent, rebuilding")
+        return False
+
+    lib.index = index
+    return True
+
+
+def save_library_index(model_name: str, lib: LibraryIndex) -> None:
+    base = _get_index_base(model_name, lib.root)
+    base.parent.mkdir(parents=True, exist_ok=True)
+    index_path, ids_path, paths_path, meta_path = _index_files(base)
+
+    if lib.index is None:
+        for path in (index_path, ids_path, paths_path, meta_path):
+            path.unlink(missing_ok=True)
+        return
+
+    # write everything to temp files first so readers never see half a file,
+    # and the meta is swapped in with the data it describes
+    meta = {
+        "root": str(lib.root),
+        "ntotal": lib.ntotal,
+        "dim": lib.index.d,
+        "spec": asdict(lib.spec),
+        "requested_spec": asdict(lib.requested_spec),
+    }
+    files = (meta_path, index_path, ids_path, paths_path)
+    tmp = [p.with_name(p.name + ".tmp") for p in files]
+    tmp[0].write_text(json.dumps(meta))
+    faiss.write_index(lib.index, str(tmp[1]))
+    with open(tmp[2], "wb") as f:
+        np.save(f, lib.ids)
+    tmp[3].write_bytes(b"\0".join(lib.paths))
+    for src, dst in zip(tmp, files):
+        os.replace(src, dst)
+
+    logger.debug(f"Saved index for '{lib.root}' ({lib.ntotal} vectors)")
+
+
+def remove_from_library_index(lib: LibraryIndex, stale_ids: np.ndarray) -> bool:
+    """Remove vectors by id. Returns False if the index type can't delete (HNSW)"""
+    if not len(stale_ids):
+        return True
+    assert lib.index is not None
+    try:
+        lib.index.remove_ids(stale_ids.astype(np.int64))
+    except RuntimeError:
+        return False
+    keep = ~np.isin(lib.ids, stale_ids)
+    lib.ids = lib.ids[keep]
+    lib.paths = [p for p, k in zip(lib.paths, keep) if k]
+    if not lib.paths:
+        lib.index = None
+    return True
+
+
+def training_sample_size(lib: LibraryIndex, n: int) -> int:
+    """
+    How many of the n vectors about to be added to lib should be passed to
+    train_library_index first (0: the first added batch will do)
+    """
+    if lib.index is not None or not needs_training(lib.requested_spec):
+        return 0
+    return min(n, _MAX_TRAIN_POINTS)
+
+
+def train_library_index(lib: LibraryIndex, sample: np.ndarray, n: int) -> None:
+    """Create lib's (empty) index, trained on a sample of the n vectors it will hold"""
+    lib.index, lib.spec = create_index(
+        np.ascontiguousarray(sample, dtype="float32"), lib.requested_spec, n=n
+    )
+
+
+def add_vectors_to_library_index(
+    lib: LibraryIndex, paths: List[Path], vectors: np.ndarray, ids: List[int]
+) -> None:
+    """Add an (n, dim) matrix whose row i belongs to paths[i] under ids[i]"""
+    if not paths:
+        return
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    if lib.index is None:
+        lib.index, lib.spec = create_index(vectors, lib.requested_spec)
+    new_ids = np.asarray(ids, dtype=np.int64)
+    lib.index.add_with_ids(vectors, new_ids)  # type: ignore
+    lib.ids = np.concatenate([lib.ids, new_ids])
+    lib.paths.extend(
+        str(p.absolute()).encode(errors="surrogateescape") for p in paths
+    )
+
+
+def search_library_index_batch(
+    lib: LibraryIndex, queries: np.ndarray, k: int = 10
+) -> List[List[SearchResult]]:
+    """Search a (n_queries, dim) matrix in one call; one result list per row"""
+    if lib.index is None or k <= 0:
+        return [[] for _ in range(len(queries))]
+
+    scores, result_ids = lib.index.search(
+        np.ascontiguousarray(queries, dtype="float32"), k  # type: ignore
+    )
+    order = np.argsort(lib.ids)
+    found = np.searchsorted(lib.ids, result_ids, sorter=order)
+    positions = order[found.clip(max=len(order) - 1)]
+    return [
+        [
+            SearchResult(path=_decode_path(lib.paths[pos]), score=float(score))
+            for score, result_id, pos in zip(row_scores, row_ids, row_positions)
+            if result_id != -1
+        ]
+        for row_scores, row_ids, row_positions in zip(scores, result_ids, positions)
+    ]
+
+
+def drop_library_indexes(model_name: str) -> None:
+    """Delete all persisted indexes of a model (e.g. after its cache was cleared)"""
+    index_dir = _get_index_dir(model_name)
+    if not index_dir.exists():
+        return
+    for path in index_dir.iterdir():
+        path.unlink(missing_ok=True)
+    index_dir.rmdir()
@@ -1,8 +1,15 @@
+from dataclasses import asdict
 from pathlib import Path
 import click
+import json
 import logging
+import os
 import sys
-from typing import Optional
+from typing import TYPE_CHECKING, Any, Callable, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .search import IndexSpec
+    from .types import QueryResult
 
 MODEL_CHOICES = [
     "dinov2_vits14",
@@ -16,6 +23,188 @@ MODEL_CHOICES = [
     "clip_ViT-H-14_laion2b_s32b_b79k",
 ]
 DEFAULT_MODEL = "dinov2_vits14"
+DEFAULT_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+INDEX_TYPES = ["flat", "hnsw", "ivf-flat", "ivf-pq"]
+# index types that support the range search dupes needs
+DUPES_INDEX_TYPES = ["flat", "ivf-flat", "ivf-pq"]
+CACHE_PRECISIONS = ["float32", "float16", "int8"]
+INFERENCE_BACKENDS = ["torch", "onnx"]
+INFERENCE_PRECISIONS = ["float32", "bfloat16", "int8"]
+
+no_daemon_option = click.option(
+    "--no-daemon",
+    is_flag=True,
+    default=False,
+    help="Run in-process even if a vism daemon is running",
+)
+
+decode_workers_option = click.option(
+    "--decode-workers",
+    default=DEFAULT_DECODE_WORKERS,
+    type=click.IntRange(min=0),
+    show_default=True,
+    help="Threads decoding images ahead of inference (0 decodes inline)",
+)
+
+batch_size_option = click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Images per inference batch (default: calibrated for the model and free memory)",
+)
+
+
+def inference_options(f: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorate a command with the model inference options shared by search,
+    index and dupes; they reach it as keyword arguments for make_inference_options
+    """
+    options = [
+        click.option(
+            "--precision",
+            type=click.Choice(INFERENCE_PRECISIONS),
+            default="float32",
+            show_default=True,
+            help="Inference precision: bfloat16 (torch) is much faster on CPUs with AVX512-BF16/AMX, int8 (onnx) runs a quantized graph. Each precision has its own cache",
+        ),
+        click.option(
+            "--compile",
+            "compile_model",
+            is_flag=True,
+            default=False,
+            help="Compile the model with torch.compile (slow first batch, faster after)",
+        ),
+        click.option(
+            "--backend",
+            type=click.Choice(INFERENCE_BACKENDS),
+            default="torch",
+            show_default=True,
+            help="Run the model with torch, or with ONNX Runtime from a graph exported once into the cache dir (needs vism[onnx])",
+        ),
+        click.option(
+            "--intra-op-threads",
+            type=click.IntRange(min=0),
+            default=0,
+            help="onnx: threads used within an operator (default: all cores)",
+        ),
+        click.option(
+            "--inter-op-threads",
+            type=click.IntRange(min=0),
+            default=0,
+            help="onnx: operators run in parallel (default: sequential)",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def index_options(f: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorate a command with the index build/query options shared by search
+    and index; the build options reach it as keyword arguments for make_index_spec
+    """
+    options = [
+        click.option(
+            "--index-type",
+            type=click.Choice(INDEX_TYPES),
+            default=None,
+            help="Index type; changing it rebuilds the index (default: keep the existing index, flat for new ones)",
+        ),
+        click.option(
+            "--nlist",
+            type=click.IntRange(min=1),
+            default=None,
+            help="IVF: number of inverted lists (default: ~4*sqrt(n))",
+        ),
+        click.option(
+            "--pq-m",
+            type=click.IntRange(min=1),
+            default=None,
+            help="IVF-PQ: sub-quantizers per vector, must divide the dimension (default: dim/4)",
+        ),
+        click.option(
+            "--hnsw-m",
+            type=click.IntRange(min=2),
+            default=32,
+            show_default=True,
+            help="HNSW: neighbors per graph node",
+        ),
+        click.option(
+            "--nprobe",
+            type=click.IntRange(min=1),
+            default=16,
+            show_default=True,
+            help="IVF: inverted lists visited per query",
+        ),
+        click.option(
+            "--ef-search",
+            type=click.IntRange(min=1),
+            default=64,
+            show_default=True,
+            help="HNSW: candidate list size per query",
+        ),
+    ]
+    for option in reversed(options):
+        f = option(f)
+    return f
+
+
+def make_inference_options(
+    precision: str,
+    compile_model: bool,
+    backend: str,
+    intra_op_threads: int,
+    inter_op_threads: int,
+) -> dict:
+    """Validate the inference options and return them as load_model keyword arguments"""
+    from .embeddings import check_inference_options
+
+    try:
+        check_inference_options(backend, precision, compile_model)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+    if backend == "onnx":
+        import importlib.util
+
+        if not all(importlib.util.find_spec(m) for m in ("onnx", "onnxruntime")):
+            raise click.UsageError(
+                "The onnx backend needs onnxruntime and onnx: pip install 'vism[onnx]'"
+            )
+    return {
+        "precision": precision,
+        "compile": compile_model,
+        "backend": backend,
+        "intra_op_threads": intra_op_threads,
+        "inter_op_threads": inter_op_threads,
+    }
+
+
+def make_model_loader(model: str, inference: dict):
+    """A core.ModelLoader for model; torch is imported on the loading thread"""
+    from .core import ModelLoader
+
+    def load():
+        from .embeddings import load_model
+
+        return load_model(model, **inference)
+
+    return ModelLoader(load)
+
+
+def make_index_spec(
+    index_type: Optional[str], nlist: Optional[int], pq_m: Optional[int], hnsw_m: int
+) -> Optional["IndexSpec"]:
+    """
+    The IndexSpec the index options ask for, or None when no --index-type was
+    given (keep the existing index, flat for new ones)
+    """
+    from .search import IndexSpec
+
+    if index_type is None:
+        return None
+    return IndexSpec(index_type=index_type, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
 
 
 def setup_logging(verbose: bool, quiet: bool) -> None:
@@ -45,18 +234,72 @@ def setup_logging(verbose: bool, quiet: bool) -> None:
     default=False,
     help="Suppress all output except errors",
 )
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Print wall and CPU time, items, bytes read and peak memory per pipeline stage when done (runs in-process, not through the daemon)",
+)
+@click.option(
+    "--profile-out",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Also write the profile to this file (implies --profile)",
+)
+@click.option(
+    "--profile-format",
+    type=click.Choice(["json", "chrome"]),
+    default="json",
+    show_default=True,
+    help="--profile-out format: stage totals, or every stage run as a Chrome trace (chrome://tracing, ui.perfetto.dev)",
+)
 @click.pass_context
-def vism(ctx: click.Context, verbose: bool, quiet: bool) -> None:
+def vism(
+    ctx: click.Context,
+    verbose: bool,
+    quiet: bool,
+    profile: bool,
+    profile_out: Optional[Path],
+    profile_format: str,
+) -> None:
     """vism: Visual Search CLI"""
     ctx.ensure_object(dict)
     setup_logging(verbose, quiet)
+    if profile or profile_out is not None:
+        from . import profiling
+
+        profiling.start()
+        ctx.call_on_close(lambda: finish_profile(profile_out, profile_format))
+
+
+def finish_profile(profile_out: Optional[Path], profile_format: str) -> None:
+    """Stop profiling, print the stage table and write --profile-out"""
+    from . import profiling
+
+    profiler = profiling.stop()
+    if profiler is None:
+        return
+    click.echo("\nProfile:\n" + profiler.summary(), err=True)
+    if profile_out is not None:
+        if profile_format == "chrome":
+            profiler.write_chrome_trace(profile_out)
+        else:
+            profiler.write_json(profile_out)
+        click.echo(f"Profile written to {profile_out}", err=True)
 
 
 @vism.command(no_args_is_help=True)
 @click.argument(
     "source_dir", type=click.Path(exists=True, file_okay=False, path_type=Path)
 )
-@click.argument("query", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("query", type=click.Path(exists=True, path_type=Path), required=False)
+@click.option(
+    "-t",
+    "--text",
+    "texts",
+    multiple=True,
+    help="Search by a text description instead of QUERY (CLIP models); repeatable",
+)
 @click.option(
     "-m",
     "--model",
@@ -77,32 +320,226 @@ def vism(ctx: click.Context, verbose: bool, quiet: bool) -> None:
     "--open-with",
     type=str,
     default=None,
-    help="Open results with specified application",
+    help="Open results with specified application (single query only)",
 )
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "jsonl"]),
+    default="text",
+    show_default=True,
+    help="Output format; jsonl prints one JSON object per query",
+)
+@click.option(
+    "--cache-only",
+    is_flag=True,
+    help="Search only images that are already encoded, without loading them",
+)
+@click.option(
+    "--max-encode",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Encode at most N new images; print results so far, then refined ones",
+)
+@click.option(
+    "--max-encode-time",
+    type=click.FloatRange(min=0),
+    default=None,
+    metavar="SECONDS",
+    help="Stop encoding new images after SECONDS; results are refined meanwhile",
+)
+@decode_workers_option
+@batch_size_option
+@inference_options
+@index_options
+@no_daemon_option
 def search(
-    source_dir: Path, query: Path, model: str, limit: int, open_with: str
+    source_dir: Path,
+    query: Optional[Path],
+    texts: Tuple[str, ...],
+    model: str,
+    limit: int,
+    open_with: str,
+    output_format: str,
+    cache_only: bool,
+    max_encode: Optional[int],
+    max_encode_time: Optional[float],
+    decode_workers: int,
+    batch_size: Optional[int],
+    precision: str,
+    compile_model: bool,
+    backend: str,
+    intra_op_threads: int,
+    inter_op_threads: int,
+    index_type: Optional[str],
+    nlist: Optional[int],
+    pq_m: Optional[int],
+    hnsw_m: int,
+    nprobe: int,
+    ef_search: int,
+    no_daemon: bool,
 ) -> None:
     """
     Search for images similar to query image in source directory
+
+    QUERY is an image, a directory of images, or a text file listing one
+    image path per line. Multiple queries share one library scan and index.
+
+    With --max-encode or --max-encode-time, results over the already encoded
+    images are printed right away and printed again, refined, as new images
+    get encoded; the last round is final.
+
+    With --text (CLIP models), images are searched by description. Only the
+    model's text encoder is loaded, and only for texts not searched before;
+    images that aren't encoded yet are skipped unless --max-encode or
+    --max-encode-time is given.
     """
-    from .embeddings import load_model
-    from .core import run_search_pipeline
+    if (query is None) == (not texts):
+        raise click.UsageError("Give either a QUERY image or --text")
+    if texts and not model.startswith("clip_"):
+        raise click.UsageError("--text needs a CLIP model (-m clip_...)")
+    if cache_only:
+        if max_encode is not None or max_encode_time is not None:
+            raise click.UsageError(
+                "--cache-only can't be combined with --max-encode or --max-encode-time"
+            )
+        max_encode = 0
+    elif texts and max_encode is None and max_encode_time is None:
+        max_encode = 0
 
-    loaded_model = load_model(model)
+    from .images import resolve_queries
+    from .profiling import enabled as profiling_enabled
+    from .server import DaemonError, query_result_from_dict, request
 
-    results = run_search_pipeline(
-        source_dir=source_dir,
-        query=query,
-        model=loaded_model,
-        model_name=model,
-        k=limit,
+    if texts:
+        single = len(texts) == 1
+    else:
+        queries = resolve_queries(query)
+        if not queries:
+            click.echo("No query images found", err=True)
+            sys.exit(1)
+        single = len(queries) == 1 and not query.is_dir()
+    index_spec = make_index_spec(index_type, nlist, pq_m, hnsw_m)
+    inference = make_inference_options(
+        precision, compile_model, backend, intra_op_threads, inter_op_threads
     )
 
+    responses = None
+    if not no_daemon and not profiling_enabled():
+        responses = request(
+            {
+                "command": "search",
+                "source_dir": str(source_dir.absolute()),
+                **(
+                    {"texts": list(texts)}
+                    if texts
+                    else {"queries": [str(q.absolute()) for q in queries]}
+                ),
+                "model": model,
+                **inference,
+                "k": limit,
+                "decode_workers": decode_workers,
+                "batch_size": batch_size,
+                "index_spec": asdict(index_spec) if index_spec else None,
+                "nprobe": nprobe,
+                "ef_search": ef_search,
+                "max_encode": max_encode,
+                "max_encode_time": max_encode_time,
+            }
+        )
+
+    if responses is not None:
+        logging.getLogger(__name__).debug("Using running vism daemon")
+        query_results = map(query_result_from_dict, responses)
+    elif texts:
+        from .cache import inference_cache_name
+        from .core import run_text_search_pipeline
+        from .embeddings import load_text_model
+
+        query_results = run_text_search_pipeline(
+            source_dir=source_dir,
+            texts=list(texts),
+            load_text_model=lambda: load_text_model(model),
+            model=make_model_loader(model, inference),
+            model_name=inference_cache_name(model, precision),
+            k=limit,
+            decode_workers=decode_workers,
+            index_spec=index_spec,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            max_encode=max_encode,
+            max_encode_time=max_encode_time,
+            batch_size=batch_size,
+        )
+    else:
+        from .cache import inference_cache_name
+        from .core import run_batch_search_pipeline
+
+        # the queries need the model anyway: load it while the library is
+        # scanned and its index loaded
+        loader = make_model_loader(model, inference)
+        loader.prefetch()
+        query_results = run_batch_search_pipeline(
+            source_dir=source_dir,
+            queries=queries,
+            model=loader,
+            model_name=inference_cache_name(model, precision),
+            k=limit,
+            decode_workers=decode_workers,
+            index_spec=index_spec,
+            nprobe=nprobe,
+            ef_search=ef_search,
+            max_encode=max_encode,
+            max_encode_time=max_encode_time,
+            batch_size=batch_size,
+        )
+
+    try:
+        for query_result in query_results:
+            print_query_result(query_result, output_format, single, limit, open_with)
+    except DaemonError as e:
+        click.echo(f"vism daemon failed: {e}", err=True)
+        sys.exit(1)
+
+
+def print_query_result(
+    query_result: "QueryResult",
+    output_format: str,
+    single: bool,
+    limit: int,
+    open_with: str,
+) -> None:
+    """Print one query's matches as text or a JSON line, opening them for single queries"""
+    from .server import query_result_to_dict
+
+    if output_format == "jsonl":
+        click.echo(json.dumps(query_result_to_dict(query_result)))
+        return
+
+    if query_result.error is not None:
+        if not query_result.final:
+            return
+        if single:
+            click.echo(f"Failed to load query image: {query_result.error}", err=True)
+            sys.exit(1)
+        click.echo(f"\n{query_result.query}: failed to load ({query_result.error})")
+        return
+
+    results = query_result.results
+    if not single:
+        click.echo(f"\nQuery: {query_result.query}")
+    if not query_result.final:
+        header = f"Top matches so far ({query_result.skipped} images not encoded yet):"
+    elif query_result.skipped:
+        header = f"Top matches ({query_result.skipped} images not encoded, skipped):"
+    else:
+        header = "Top matches:"
     if results:
-        click.echo("\nTop matches:")
+        click.echo(f"\n{header}" if single else header)
         for result in results:
             click.echo(f"{result.score:.4f} → {result.path}")
-        if limit > 0 and results and open_with:
+        if single and limit > 0 and open_with and query_result.final:
             import subprocess
 
             subprocess.Popen(
@@ -111,6 +548,9 @@ def search(
                 stderr=subprocess.DEVNULL,
                 start_new_session=True,
             )
+    elif not query_result.final:
+        message = f"No matches yet ({query_result.skipped} images not encoded yet)"
+        click.echo(f"\n{message}" if single else message)
     else:
         click.echo("Search failed or returned no results")
 
@@ -127,18 +567,89 @@ def search(
     show_default=True,
     help="Model variant to use for embeddings",
 )
-def index(source_dir: Path, model: str) -> None:
-    """Pre-compute and cache embeddings for all images in a directory"""
-    from .embeddings import load_model
-    from .core import get_or_compute_embeddings
-    from .images import find_images_recursive
+@decode_workers_option
+@batch_size_option
+@inference_options
+@index_options
+@click.option(
+    "--eval-recall",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Report recall@10 against exact search on this many sampled queries",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Processes encoding new images, each with its own model (default: one per 4 physical cores)",
+)
+@click.option(
+    "--threads-per-worker",
+    type=click.IntRange(min=1),
+    default=None,
+    help="With --workers > 1: inference threads per worker (default: its share of physical cores)",
+)
+def index(
+    source_dir: Path,
+    model: str,
+    workers: Optional[int],
+    threads_per_worker: Optional[int],
+    decode_workers: int,
+    batch_size: Optional[int],
+    precision: str,
+    compile_model: bool,
+    backend: str,
+    intra_op_threads: int,
+    inter_op_threads: int,
+    index_type: Optional[str],
+    nlist: Optional[int],
+    pq_m: Optional[int],
+    hnsw_m: int,
+    nprobe: int,
+    ef_search: int,
+    eval_recall: int,
+) -> None:
+    """
+    Pre-compute and cache embeddings and the search index for a directory
+
+    With more than one worker, new images are decoded and encoded on worker
+    processes pinned to separate cores; --decode-workers then doesn't apply.
+    """
+    from .cache import inference_cache_name
+    from .core import estimate_library_recall, get_library_index, scan_library
+    from .parallel import EncodeWorkers, default_worker_count
+    from .search import set_search_params
 
-    image_paths = list(find_images_recursive(source_dir))
-    click.echo(f"Found {len(image_paths)} images")
+    cache_keys = scan_library(source_dir)
+    click.echo(f"Found {len(cache_keys)} images")
 
-    loaded_model = load_model(model)
-    embeddings = get_or_compute_embeddings(image_paths, loaded_model, model)
-    click.echo(f"Done. {len(embeddings)} embeddings ready.")
+    inference = make_inference_options(
+        precision, compile_model, backend, intra_op_threads, inter_op_threads
+    )
+    cache_name = inference_cache_name(model, precision)
+    if workers is None:
+        workers = default_worker_count()
+    if workers > 1:
+        encoder = EncodeWorkers(model, workers, inference, threads_per_worker)
+    else:
+        # loaded only if there is something to encode
+        encoder = make_model_loader(model, inference)
+    lib = get_library_index(
+        source_dir,
+        list(cache_keys),
+        encoder,
+        cache_name,
+        decode_workers=decode_workers,
+        index_spec=make_index_spec(index_type, nlist, pq_m, hnsw_m),
+        cache_keys=cache_keys,
+        batch_size=batch_size,
+    )
+    click.echo(f"Done. {lib.ntotal} embeddings ready ({lib.spec.index_type} index).")
+
+    if eval_recall and lib.index is not None:
+        set_search_params(lib.index, nprobe=nprobe, ef_search=ef_search)
+        recall = estimate_library_recall(lib, cache_name, k=10, sample=eval_recall)
+        click.echo(f"Estimated recall@10: {recall:.4f}")
 
 
 @vism.command(no_args_is_help=True)
@@ -168,27 +679,152 @@ def index(source_dir: Path, model: str) -> None:
     default=None,
     help="Open each cluster with the specified application",
 )
+@click.option(
+    "--mode",
+    type=click.Choice(["phash", "embed", "both"]),
+    default="embed",
+    show_default=True,
+    help="phash groups exact and near-exact copies by perceptual hash without a model; embed compares model embeddings; both hashes first and only encodes what the hashes didn't group",
+)
+@click.option(
+    "--max-distance",
+    type=click.IntRange(min=0, max=64),
+    default=6,
+    show_default=True,
+    help="phash/both: max differing bits (of 64) between hashes of the same picture",
+)
+@click.option(
+    "--index-type",
+    type=click.Choice(DUPES_INDEX_TYPES),
+    default="flat",
+    show_default=True,
+    help="Pair search engine: flat is exact; ivf-flat and ivf-pq are approximate and scale to millions of images (ivf-pq also bounds memory)",
+)
+@click.option(
+    "--nlist",
+    type=click.IntRange(min=1),
+    default=None,
+    help="IVF: number of inverted lists (default: ~4*sqrt(n))",
+)
+@click.option(
+    "--pq-m",
+    type=click.IntRange(min=1),
+    default=None,
+    help="IVF-PQ: sub-quantizers per vector, must divide the dimension (default: dim/4)",
+)
+@click.option(
+    "--nprobe",
+    type=click.IntRange(min=1),
+    default=16,
+    show_default=True,
+    help="IVF: inverted lists searched per image; higher finds more pairs",
+)
+@click.option(
+    "--eval-recall",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Estimate the share of duplicate pairs found, against exact search on N sampled images",
+)
+@decode_workers_option
+@batch_size_option
+@inference_options
+@no_daemon_option
 def dupes(
-    source_dir: Path, model: str, threshold: float, open_with: str | None
+    source_dir: Path,
+    model: str,
+    threshold: float,
+    open_with: str | None,
+    mode: str,
+    max_distance: int,
+    index_type: str,
+    nlist: Optional[int],
+    pq_m: Optional[int],
+    nprobe: int,
+    eval_recall: int,
+    decode_workers: int,
+    batch_size: Optional[int],
+    precision: str,
+    compile_model: bool,
+    backend: str,
+    intra_op_threads: int,
+    inter_op_threads: int,
+    no_daemon: bool,
 ) -> None:
     """Find clusters of near-duplicate images in a directory"""
-    from .embeddings import load_model
-    from .core import get_or_compute_embeddings
-    from .images import find_images_recursive
-    from .dupes import find_duplicates
+    from .profiling import enabled as profiling_enabled
+    from .server import DaemonError, request
 
-    image_paths = list(find_images_recursive(source_dir))
-    click.echo(f"Found {len(image_paths)} images")
+    spec = make_index_spec(index_type, nlist, pq_m, hnsw_m=32)
+    inference = make_inference_options(
+        precision, compile_model, backend, intra_op_threads, inter_op_threads
+    )
+    recall = None
+    responses = None
+    if not no_daemon and not profiling_enabled():
+        responses = request(
+            {
+                "command": "dupes",
+                "source_dir": str(source_dir.absolute()),
+                "model": model,
+                **inference,
+                "threshold": threshold,
+                "mode": mode,
+                "max_distance": max_distance,
+                "decode_workers": decode_workers,
+                "batch_size": batch_size,
+                "index_spec": asdict(spec),
+                "nprobe": nprobe,
+                "eval_recall": eval_recall,
+            }
+        )
 
-    if len(image_paths) < 2:
-        click.echo("Need at least 2 images to find duplicates")
-        return
+    if responses is not None:
+        logging.getLogger(__name__).debug("Using running vism daemon")
+        try:
+            clusters = []
+            for record in responses:
+                if "recall" in record:
+                    recall = record["recall"]
+                else:
+                    clusters.append(
+                        [(Path(path), score) for path, score in record["cluster"]]
+                    )
+        except DaemonError as e:
+            click.echo(f"vism daemon failed: {e}", err=True)
+            sys.exit(1)
+    else:
+        from .cache import inference_cache_name
+        from .core import find_library_duplicates, scan_library
+
+        cache_keys = scan_library(source_dir)
+        click.echo(f"Found {len(cache_keys)} images")
+
+        if len(cache_keys) < 2:
+            click.echo("Need at least 2 images to find duplicates")
+            return
+
+        def get_model():
+            from .embeddings import load_model
 
-    loaded_model = load_model(model)
-    embeddings = get_or_compute_embeddings(image_paths, loaded_model, model)
+            return load_model(model, **inference)
 
-    click.echo("Finding duplicates...")
-    clusters = find_duplicates(embeddings, threshold=threshold)
+        click.echo("Finding duplicates...")
+        clusters, recall = find_library_duplicates(
+            cache_keys,
+            get_model,
+            inference_cache_name(model, precision),
+            threshold=threshold,
+            mode=mode,
+            max_distance=max_distance,
+            spec=spec,
+            nprobe=nprobe,
+            decode_workers=decode_workers,
+            eval_recall=eval_recall,
+            batch_size=batch_size,
+        )
+
+    if recall is not None:
+        click.echo(f"Estimated duplicate pair recall: {recall:.4f}")
 
     if not clusters:
         click.echo("No duplicates found")
@@ -216,6 +852,43 @@ def dupes(
             )
 
 
+@vism.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=None,
+    help="Unix socket to listen on (default: $VISM_SOCKET or <cache dir>/vism.sock)",
+)
+@click.option(
+    "--refresh",
+    default=30.0,
+    type=click.FloatRange(min=0),
+    show_default=True,
+    help="Seconds before a library is rescanned for new, changed or deleted files",
+)
+@click.option(
+    "-m",
+    "--preload",
+    multiple=True,
+    type=click.Choice(MODEL_CHOICES),
+    help="Load this model at startup (repeatable); others load on first use",
+)
+def serve(socket_path: Optional[Path], refresh: float, preload: tuple[str, ...]) -> None:
+    """
+    Run a daemon that keeps models and indexes loaded
+
+    search and dupes use it automatically while it is running.
+    """
+    from .server import serve as run_server
+
+    try:
+        run_server(socket_path=socket_path, refresh=refresh, preload=list(preload))
+    except RuntimeError as e:
+        click.echo(str(e), err=True)
+        sys.exit(1)
+
+
 @vism.group(no_args_is_help=True)
 def cache() -> None:
     """Manage the embeddings cache"""
@@ -256,6 +929,53 @@ def prune(prefix: Optional[Path], model: Optional[str]) -> None:
     click.echo(f"Pruned {pruned} dangling cache entr{'y' if pruned == 1 else 'ies'}")
 
 
+@cache.command()
+@click.argument(
+    "precision_name", metavar="PRECISION", type=click.Choice(CACHE_PRECISIONS)
+)
+@click.option(
+    "-m",
+    "--model",
+    default=None,
+    type=click.Choice(MODEL_CHOICES),
+    help="Target a specific model's cache (default: all existing caches)",
+)
+def precision(precision_name: str, model: Optional[str]) -> None:
+    """Set how cached embeddings are stored: float32, float16 (1/2 size) or int8 (1/4 size)"""
+    from .cache import _get_all_cache_dbs, set_cache_precision
+
+    model_names = [model] if model is not None else sorted(_get_all_cache_dbs())
+    if not model_names:
+        click.echo("No cache entries found")
+        return
+    for model_name in model_names:
+        converted = set_cache_precision(model_name, precision_name)
+        click.echo(f"{model_name}: {precision_name} ({converted} vectors converted)")
+
+
+@cache.command("content-keys")
+@click.argument("state", type=click.Choice(["on", "off"]))
+@click.option(
+    "-m",
+    "--model",
+    default=None,
+    type=click.Choice(MODEL_CHOICES),
+    help="Target a specific model's cache (default: all existing caches)",
+)
+def content_keys(state: str, model: Optional[str]) -> None:
+    """Find moved or copied files by a hash of their content (reads 48 KB per missed file)"""
+    from .cache import _get_all_cache_dbs, set_cache_content_keys
+
+    model_names = [model] if model is not None else sorted(_get_all_cache_dbs())
+    if not model_names:
+        click.echo("No cache entries found")
+        return
+    for model_name in model_names:
+        hashed = set_cache_content_keys(model_name, state == "on")
+        suffix = f" ({hashed} cached files hashed)" if state == "on" else ""
+        click.echo(f"{model_name}: content keys {state}{suffix}")
+
+
 @cache.command()
 @click.argument("prefix", required=False, default=None, type=click.Path(path_type=Path))
 @click.option(
@@ -291,6 +1011,251 @@ def stats(prefix: Optional[Path], model: Optional[str]) -> None:
                 click.echo(f"  {cached:>6}/{total:<6}  {directory}")
 
 
+@vism.command()
+@click.option(
+    "-n",
+    "--images",
+    "sizes",
+    multiple=True,
+    type=click.IntRange(min=2),
+    help="Library size to benchmark (repeatable, default: 1000)",
+)
+@click.option(
+    "--formats",
+    default="jpg",
+    show_default=True,
+    help="Comma-separated image formats of the synthetic library (jpg, png, webp)",
+)
+@click.option(
+    "--size",
+    "image_size",
+    default="640x480",
+    show_default=True,
+    help="Synthetic image size, WIDTHxHEIGHT",
+)
+@click.option(
+    "-m",
+    "--model",
+    default="stub",
+    type=click.Choice(["stub", "tiny"] + MODEL_CHOICES),
+    show_default=True,
+    help="stub is nearly free to run, tiny is a small conv net; real models load their weights",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=64,
+    show_default=True,
+    help="Images per inference batch",
+)
+@click.option(
+    "--queries",
+    type=click.IntRange(min=1),
+    default=100,
+    show_default=True,
+    help="Queries in the search stage",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Run each size this many times and report the fastest run per stage",
+)
+@click.option(
+    "--library",
+    type=click.Path(file_okay=False, path_type=Path),
+    default=None,
+    help="Keep generated libraries here (<dir>/<n>) and reuse them in later runs (default: temporary)",
+)
+@decode_workers_option
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default=None,
+    help="Write the results as JSON to this file (- for stdout)",
+)
+@click.option(
+    "--compare",
+    "baseline_path",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Compare against an earlier --output file; exits with 1 on a regression",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=0.2,
+    show_default=True,
+    help="Throughput drop of a stage that counts as a regression with --compare",
+)
+def bench(
+    sizes: tuple[int, ...],
+    formats: str,
+    image_size: str,
+    model: str,
+    batch_size: int,
+    queries: int,
+    repeat: int,
+    library: Optional[Path],
+    decode_workers: int,
+    output,
+    baseline_path: Optional[Path],
+    tolerance: float,
+) -> None:
+    """
+    Benchmark each pipeline stage on synthetic image libraries
+
+    Times scanning, cache keys, decoding, preprocessing, inference, cache
+    writes and lookups, index build, search and duplicate finding, without
+    touching your cache. Save runs with -o and compare them across versions
+    with --compare.
+    """
+    import tempfile
+    from .bench import (
+        BENCH_FORMATS,
+        BENCH_MODELS,
+        best_of,
+        compare_results,
+        environment,
+        format_results,
+        load_report,
+        make_synthetic_library,
+        results_to_dict,
+        run_benchmark,
+        stub_model,
+    )
+
+    format_list = tuple(f.strip().lower() for f in formats.split(",") if f.strip())
+    unknown = [f for f in format_list if f not in BENCH_FORMATS]
+    if not format_list or unknown:
+        raise click.UsageError(f"--formats must be a list of {', '.join(BENCH_FORMATS)}")
+    try:
+        width, height = (int(v) for v in image_size.lower().split("x"))
+    except ValueError:
+        raise click.UsageError("--size must be WIDTHxHEIGHT, e.g. 640x480")
+
+    baseline = None
+    if baseline_path is not None:
+        try:
+            baseline = load_report(baseline_path)
+        except (OSError, ValueError) as e:
+            raise click.UsageError(f"Can't read --compare file: {e}")
+
+    if model in BENCH_MODELS:
+        loaded_model = stub_model(model)
+    else:
+        from .embeddings import load_model
+
+        loaded_model = load_model(model)
+
+    report = {
+        "environment": environment(),
+        "config": {
+            "formats": list(format_list),
+            "size": [width, height],
+            "model": model,
+            "batch_size": batch_size,
+            "queries": queries,
+            "repeat": repeat,
+            "decode_workers": decode_workers,
+        },
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="vism-bench-lib-") as tmp:
+        for n in sizes or (1000,):
+            root = (library or Path(tmp)) / str(n)
+            if not root.exists():
+                click.echo(f"Generating {n} images in {root}...", err=True)
+                make_synthetic_library(root, n, format_list, (width, height))
+            runs = [
+                run_benchmark(
+                    root,
+                    loaded_model,
+                    batch_size=batch_size,
+                    queries=queries,
+                    decode_workers=decode_workers,
+                )
+                for _ in range(repeat)
+            ]
+            results = best_of(runs)
+            click.echo(format_results(n, results), err=True)
+            report["runs"].append({"images": n, "stages": results_to_dict(results)})
+
+    if output is not None:
+        json.dump(report, output, indent=2)
+        output.write("\n")
+
+    if baseline is not None:
+        regressions = 0
+        click.echo(f"\nCompared to {baseline_path} (items/s):", err=True)
+        for images, stage, before, after, regressed in compare_results(
+            baseline, report, tolerance
+        ):
+            regressions += regressed
+            click.echo(
+                f"  {images:>8} {stage:<14}{before:>12.1f} -> {after:<12.1f}"
+                f"{'REGRESSED' if regressed else ''}",
+                err=True,
+            )
+        if regressions:
+            click.echo(f"{regressions} stage(s) regressed", err=True)
+            sys.exit(1)
+
+
+@vism.group(no_args_is_help=True)
+def models() -> None:
+    """Manage locally prepared model artifacts"""
+    pass
+
+
+@models.command()
+@click.option(
+    "-m",
+    "--model",
+    "model_names",
+    multiple=True,
+    type=click.Choice(MODEL_CHOICES),
+    help="Model to prepare (repeatable, default: dinov2_vits14)",
+)
+@click.option(
+    "--onnx",
+    is_flag=True,
+    default=False,
+    help="Also export the ONNX graphs (float32 and int8) for --backend onnx",
+)
+@click.option(
+    "--force", is_flag=True, default=False, help="Rebuild existing artifacts"
+)
+def warm(model_names: tuple[str, ...], onnx: bool, force: bool) -> None:
+    """
+    Download and prepare models so later runs start fast and work offline
+
+    Runs prepare the model they use on first load anyway; this does it ahead
+    of time, e.g. before going offline.
+    """
+    from .model_store import warm_model
+
+    for model_name in model_names or (DEFAULT_MODEL,):
+        path = warm_model(model_name, force=force)
+        click.echo(f"{model_name}: {path}")
+        if onnx:
+            from .embeddings import load_model
+
+            load_model(model_name, precision="int8", backend="onnx")
+            click.echo(f"{model_name}: ONNX graphs exported")
+
+
+@models.command(name="clear")
+def clear_models() -> None:
+    """Delete all prepared model artifacts"""
+    from .model_store import remove_model_artifacts
+
+    removed = remove_model_artifacts()
+    click.echo(f"Removed {removed} model artifact{'' if removed == 1 else 's'}")
+
+
 def main() -> None:
     vism()
 
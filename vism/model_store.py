@@ -0,0 +1,157 @@
+"""
+Prepared model artifacts, so runs don't rebuild models through torch.hub/open_clip
+
+A built model is saved once per model name under <cache dir>/models/ as a
+pickled module in torch's zip format, which torch.load can memory-map: cold
+start is then bounded by paging in the weights. The DINOv2 hub code the
+pickle refers to is copied alongside, so loading needs neither the network
+nor the torch.hub cache.
+"""
+
+import json
+import os
+import shutil
+import sys
+from pathlib import Path
+from typing import Optional, Tuple
+import logging
+
+import torch
+from torchvision import transforms
+
+from .cache import _get_cache_dir
+from .embeddings import (
+    _build_model,
+    _unwrap,
+    preprocess_config,
+    preprocess_from_config,
+)
+
+logger = logging.getLogger(__name__)
+
+# bump when the artifact layout changes; older artifacts are rebuilt
+ARTIFACT_VERSION = 1
+
+
+def _get_models_dir() -> Path:
+    return _get_cache_dir() / "models"
+
+
+def _artifact_files(model_name: str) -> Tuple[Path, Path]:
+    """(pickled module, metadata) of a model"""
+    base = _get_models_dir() / model_name.replace("/", "_").replace("\\", "_")
+    return base.with_suffix(".pt"), base.with_suffix(".json")
+
+
+def _get_code_dir() -> Path:
+    """Copies of model code that only exists in the torch.hub cache"""
+    return _get_models_dir() / "code"
+
+
+def _copy_hub_code(module: torch.nn.Module) -> Optional[str]:
+    """
+    Copy the top-level package defining module into the code dir if it was
+    loaded from the torch.hub cache; returns the package name, or None if it
+    is an installed package.
+    """
+    package = type(module).__module__.split(".")[0]
+    package_file = getattr(sys.modules.get(package), "__file__", None)
+    if package_file is None:
+        return None
+    package_dir = Path(package_file).parent
+    if not package_dir.is_relative_to(Path(torch.hub.get_dir())):
+        return None
+    shutil.copytree(
+        package_dir,
+        _get_code_dir() / package,
+        dirs_exist_ok=True,
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+    return package
+
+
+def _tmp_path(path: Path) -> Path:
+    """Temporary name for writing path, unique to this process"""
+    return path.with_name(f"{path.name}.{os.getpid()}.tmp")
+
+
+def save_model_artifact(model_name: str, module: torch.nn.Module) -> Path:
+    """
+    Save module as the artifact of model_name
+
+    Both files are written under temporary names and renamed into place, so
+    processes saving the same model at once don't mix their writes.
+    """
+    module = _unwrap(module)
+    weights_path, meta_path = _artifact_files(model_name)
+    weights_path.parent.mkdir(parents=True, exist_ok=True)
+
+    code_package = _copy_hub_code(module)
+    tmp_path = _tmp_path(weights_path)
+    torch.save(module, tmp_path)
+    os.replace(tmp_path, weights_path)
+    tmp_path = _tmp_path(meta_path)
+    tmp_path.write_text(
+        json.dumps(
+            {
+                "version": ARTIFACT_VERSION,
+                # pickled modules are only reliable on the torch they were saved with
+                "torch": torch.__version__,
+                "code": code_package,
+                "preprocess": preprocess_config(module),
+            }
+        )
+    )
+    os.replace(tmp_path, meta_path)
+    logger.debug(f"Saved model artifact for {model_name} to {weights_path}")
+    return weights_path
+
+
+def load_model_artifact(
+    model_name: str,
+) -> Optional[Tuple[torch.nn.Module, transforms.Compose]]:
+    """
+    Load a saved model with memory-mapped weights
+
+    Returns None if there is no usable artifact (missing, stale or unreadable),
+    in which case the caller builds the model and saves a new one.
+    """
+    weights_path, meta_path = _artifact_files(model_name)
+    if not (weights_path.exists() and meta_path.exists()):
+        return None
+
+    try:
+        meta = json.loads(meta_path.read_text())
+        if (
+            meta.get("version") != ARTIFACT_VERSION
+            or meta.get("torch") != torch.__version__
+        ):
+            logger.info(f"Model artifact for {model_name} is outdated, rebuilding")
+            return None
+        if meta.get("code") and str(_get_code_dir()) not in sys.path:
+            sys.path.append(str(_get_code_dir()))
+        module = torch.load(
+            weights_path, map_location="cpu", mmap=True, weights_only=False
+        )
+        return module, preprocess_from_config(meta["preprocess"])
+    except Exception as e:
+        logger.warning(f"Failed to load model artifact for {model_name}: {e}")
+        return None
+
+
+def warm_model(model_name: str, force: bool = False) -> Path:
+    """Build and save the artifact of model_name unless a usable one exists"""
+    if not force and load_model_artifact(model_name) is not None:
+        return _artifact_files(model_name)[0]
+    module, _ = _build_model(model_name)
+    return save_model_artifact(model_name, module)
+
+
+def remove_model_artifacts() -> int:
+    """Delete all saved artifacts and copied code; returns the number of models removed"""
+    models_dir = _get_models_dir()
+    if not models_dir.exists():
+        return 0
+    count = len(list(models_dir.glob("*.pt")))
+    shutil.rmtree(models_dir)
+    return count
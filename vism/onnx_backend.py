@@ -0,0 +1,165 @@
+"""
+ONNX Runtime backend for the image encoders
+
+Each model is exported to ONNX once and cached under <cache dir>/onnx/ along
+with the preprocessing it needs, so later runs build neither the torch.hub
+nor the open_clip model. The int8 variant is derived from the float32 graph
+by dynamic (weight-only) quantization.
+
+Requires the optional onnx dependencies: pip install 'vism[onnx]'
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Tuple
+import logging
+
+import torch
+
+from .cache import _get_cache_dir
+from .embeddings import (
+    Model,
+    _unwrap,
+    get_input_size,
+    preprocess_config,
+    preprocess_from_config,
+)
+
+logger = logging.getLogger(__name__)
+
+ONNX_OPSET = 17
+
+
+def _get_onnx_dir() -> Path:
+    return _get_cache_dir() / "onnx"
+
+
+def _onnx_files(model_name: str) -> Tuple[Path, Path, Path]:
+    """(float32 graph, int8 graph, preprocessing metadata) of a model"""
+    base = _get_onnx_dir() / model_name.replace("/", "_").replace("\\", "_")
+    return (
+        base.with_suffix(".onnx"),
+        base.with_suffix(".int8.onnx"),
+        base.with_suffix(".json"),
+    )
+
+
+class _OnnxModule(torch.nn.Module):
+    """Runs an ONNX Runtime session behind the nn.Module interface the pipeline uses"""
+
+    def __init__(self, session: Any, input_size: int) -> None:
+        super().__init__()
+        self.session = session
+        self.input_size = input_size
+        self._input_name = session.get_inputs()[0].name
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        outputs = self.session.run(
+            None, {self._input_name: x.detach().cpu().contiguous().numpy()}
+        )
+        return torch.from_numpy(outputs[0])
+
+
+def export_onnx(module: torch.nn.Module, input_size: int, path: Path) -> None:
+    """Export an image encoder taking (batch, 3, input_size, input_size) pixels"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    dummy = torch.zeros(1, 3, input_size, input_size)
+    # with grad enabled nn.MultiheadAttention (open_clip) skips its fused
+    # inference kernel, which has no ONNX export
+    with torch.enable_grad():
+        torch.onnx.export(
+            _unwrap(module).cpu().eval(),
+            (dummy,),
+            str(tmp_path),
+            input_names=["pixels"],
+            output_names=["embedding"],
+            dynamic_axes={"pixels": {0: "batch"}, "embedding": {0: "batch"}},
+            opset_version=ONNX_OPSET,
+        )
+    os.replace(tmp_path, path)
+
+
+def quantize_onnx(src: Path, dst: Path) -> None:
+    """Write an int8 copy of src with dynamically quantized weights"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp_path = dst.with_name(f"{dst.name}.{os.getpid()}.tmp")
+    quantize_dynamic(src, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, dst)
+
+
+def create_session(
+    path: Path, intra_op_threads: int = 0, inter_op_threads: int = 0
+) -> Any:
+    """CPU inference session; 0 threads leaves the choice to ONNX Runtime"""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(
+        str(path), options, providers=["CPUExecutionProvider"]
+    )
+
+
+def _export_model(model_name: str, graph_path: Path, meta_path: Path) -> None:
+    from .embeddings import load_model
+
+    logger.info(f"Exporting {model_name} to ONNX (one-time)")
+    model = load_model(model_name)
+    module = _unwrap(model[0])
+    input_size = get_input_size(model)
+    export_onnx(module, input_size, graph_path)
+
+    # the transform, so it can be rebuilt without the model
+    meta = {"input_size": input_size, "preprocess": preprocess_config(module)}
+    tmp_path = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, meta_path)
+
+
+def warm_onnx_model(
+    model_name: str, precision: str = "float32"
+) -> Tuple[Path, Path, Path]:
+    """Export (and quantize) model_name unless already done; returns _onnx_files"""
+    graph_path, int8_path, meta_path = _onnx_files(model_name)
+    if not (graph_path.exists() and meta_path.exists()):
+        _export_model(model_name, graph_path, meta_path)
+    if precision == "int8" and not int8_path.exists():
+        logger.info(f"Quantizing {model_name} to int8 (one-time)")
+        quantize_onnx(graph_path, int8_path)
+    return graph_path, int8_path, meta_path
+
+
+def load_onnx_model(
+    model_name: str,
+    precision: str = "float32",
+    intra_op_threads: int = 0,
+    inter_op_threads: int = 0,
+) -> Model:
+    """Load model_name through ONNX Runtime, exporting (and quantizing) it on first use"""
+    try:
+        import onnxruntime  # noqa: F401
+    except ImportError as e:
+        raise RuntimeError(
+            "The onnx backend needs onnxruntime and onnx: pip install 'vism[onnx]'"
+        ) from e
+
+    graph_path, int8_path, meta_path = warm_onnx_model(model_name, precision)
+    meta = json.loads(meta_path.read_text())
+    session = create_session(
+        int8_path if precision == "int8" else graph_path,
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=inter_op_threads,
+    )
+    logger.debug(f"Loaded ONNX {model_name} ({precision})")
+    return (
+        _OnnxModule(session, meta["input_size"]),
+        preprocess_from_config(meta["preprocess"]),
+        "cpu",
+    )
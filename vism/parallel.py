@@ -0,0 +1,280 @@
+"""
+Encoding on several worker processes, for hosts where one process can't use
+all cores
+
+torch's intra-op threading stops scaling well past a handful of threads for
+ViT-sized batches, so on many-core machines it is faster to run N processes
+with a few threads each. Every worker loads its own model (memory-mapped
+from the model artifact, so the weights are shared through the page cache),
+is pinned to its own set of physical cores, and decodes and encodes the
+batches it takes off a shared queue. Embeddings are sent back to the parent
+process, which stays the only cache writer.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Physical cores per worker when the worker count is derived from the topology
+CORES_PER_WORKER = 4
+
+
+@dataclass(frozen=True)
+class EncodeWorkers:
+    """
+    Encode with `workers` processes, each loading model with load_model(model,
+    **inference) and running `threads` torch/onnx threads (None: one per
+    physical core of its share)
+    """
+
+    model: str
+    workers: int
+    inference: Dict[str, Any] = field(default_factory=dict)
+    threads: Optional[int] = None
+
+
+def available_cpus() -> List[int]:
+    """CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def physical_cores(cpus: List[int]) -> List[List[int]]:
+    """
+    Group cpus by physical core, SMT siblings together; each CPU is its own
+    core where the topology isn't exposed (non-Linux)
+    """
+    cores: Dict[Tuple[str, str], List[int]] = {}
+    for cpu in cpus:
+        topology = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology")
+        try:
+            key = (
+                (topology / "physical_package_id").read_text().strip(),
+                (topology / "core_id").read_text().strip(),
+            )
+        except OSError:
+            key = ("", str(cpu))
+        cores.setdefault(key, []).append(cpu)
+    return list(cores.values())
+
+
+def default_worker_count() -> int:
+    return max(1, len(physical_cores(available_cpus())) // CORES_PER_WORKER)
+
+
+def split_cores(cores: List[List[int]], workers: int) -> List[List[List[int]]]:
+    """
+    Split physical cores into `workers` contiguous shares of nearly equal
+    size; with more workers than cores, cores are shared round-robin
+    """
+    if workers > len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    size, extra = divmod(len(cores), workers)
+    shares = []
+    start = 0
+    for i in range(workers):
+        end = start + size + (i < extra)
+        shares.append(cores[start:end])
+        start = end
+    return shares
+
+
+def warm_worker_model(spec: EncodeWorkers) -> None:
+    """
+    Build and save what the workers load spec.model from, unless done already
+
+    Run in the parent, so that on a cold cache the workers don't all build
+    the model and write its artifact at once.
+    """
+    if spec.inference.get("backend") == "onnx":
+        from .onnx_backend import warm_onnx_model
+
+        warm_onnx_model(spec.model, spec.inference.get("precision", "float32"))
+    else:
+        from .model_store import warm_model
+
+        warm_model(spec.model)
+
+
+def _worker_inference(spec: EncodeWorkers, threads: int) -> Dict[str, Any]:
+    """load_model options of a worker running `threads` threads"""
+    inference = dict(spec.inference)
+    if inference.get("backend") == "onnx":
+        inference["intra_op_threads"] = inference.get("intra_op_threads") or threads
+    return inference
+
+
+def calibrate_worker_batch_size(spec: EncodeWorkers, threads: int) -> int:
+    """
+    Batch size for workers of spec running `threads` threads each
+
+    Calibrated in this process with the worker's thread count, before the
+    workers start, with free memory shared between the workers.
+    """
+    import torch
+
+    from .batching import calibrate_batch_size
+    from .embeddings import load_model
+
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        model = load_model(spec.model, **_worker_inference(spec, threads))
+        return calibrate_batch_size(model, processes=spec.workers)
+    finally:
+        torch.set_num_threads(previous)
+
+
+def _worker_main(
+    spec: EncodeWorkers,
+    cpus: List[int],
+    threads: int,
+    batch_size: int,
+    tasks: "multiprocessing.Queue",
+    results: "multiprocessing.Queue",
+) -> None:
+    """Load the model, then encode batches of (batch number, paths) until None"""
+    # before torch starts its thread pools
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logger.warning(f"Failed to pin encode worker to CPUs {cpus}: {e}")
+
+    try:
+        import torch
+
+        from .batching import BatchEncoder
+        from .core import _prepare_image
+        from .embeddings import get_input_size, load_model
+
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+        model = load_model(spec.model, **_worker_inference(spec, threads))
+        min_size = get_input_size(model)
+        encoder = BatchEncoder(model, batch_size)
+    except Exception as e:
+        results.put(("error", f"{type(e).__name__}: {e}"))
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        batch_no, paths = task
+        indices = []
+        tensors = []
+        failures = []
+        for i, path in enumerate(paths):
+            try:
+                tensors.append(_prepare_image(path, model, min_size))
+                indices.append(i)
+            except Exception as e:
+                failures.append((i, str(e)))
+        try:
+            embeddings = (
+                encoder.encode([paths[i] for i in indices], tensors) if tensors else []
+            )
+        except Exception as e:
+            results.put(("error", f"{type(e).__name__}: {e}"))
+            return
+        vectors = np.stack([e.embedding for e in embeddings]) if embeddings else None
+        results.put(("batch", batch_no, indices, vectors, failures))
+
+
+def encode_in_workers(
+    spec: EncodeWorkers, image_paths: List[Path], batch_size: Optional[int] = None
+) -> Iterator[Tuple[int, List[Tuple[int, np.ndarray]], List[Tuple[int, str]]]]:
+    """
+    Encode image_paths on spec.workers processes
+
+    Yields (images processed, [(index into image_paths, embedding)],
+    [(index, load error)]) per batch, in the order batches finish. Stop
+    iterating to stop the workers. Raises RuntimeError if a worker fails.
+    batch_size None calibrates one for the workers' thread count (see
+    batching), or uses DEFAULT_BATCH_SIZE for small runs.
+    """
+    from .batching import CALIBRATION_MIN_IMAGES, DEFAULT_BATCH_SIZE
+
+    if not image_paths:
+        return
+    warm_worker_model(spec)
+    cores = physical_cores(available_cpus())
+    if batch_size is None:
+        if len(image_paths) < CALIBRATION_MIN_IMAGES:
+            batch_size = DEFAULT_BATCH_SIZE
+        else:
+            threads = spec.threads or len(split_cores(cores, spec.workers)[0])
+            batch_size = calibrate_worker_batch_size(spec, threads)
+    batches = [
+        list(range(start, min(start + batch_size, len(image_paths))))
+        for start in range(0, len(image_paths), batch_size)
+    ]
+    workers = max(1, min(spec.workers, len(batches)))
+    shares = split_cores(cores, workers)
+
+    # spawn: forking a process that already runs torch threads can deadlock
+    context = multiprocessing.get_context("spawn")
+    tasks = context.Queue()
+    results = context.Queue()
+    for batch_no, batch in enumerate(batches):
+        tasks.put((batch_no, [image_paths[i] for i in batch]))
+    processes = []
+    for share in shares:
+        cpus = sorted(cpu for core in share for cpu in core)
+        threads = spec.threads or len(share)
+        process = context.Process(
+            target=_worker_main,
+            args=(spec, cpus, threads, batch_size, tasks, results),
+            name="vism-encode",
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+        tasks.put(None)
+    logger.debug(
+        f"Started {workers} encode workers on "
+        + ", ".join(f"{len(share)} cores" for share in shares)
+    )
+
+    try:
+        remaining = len(batches)
+        while remaining:
+            try:
+                message = results.get(timeout=1.0)
+            except queue.Empty:
+                failed = [p for p in processes if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError(
+                        f"Encode worker exited with code {failed[0].exitcode}"
+                    )
+                continue
+            if message[0] == "error":
+                raise RuntimeError(f"Encode worker failed: {message[1]}")
+            _, batch_no, indices, vectors, failures = message
+            batch = batches[batch_no]
+            embeddings = (
+                list(zip((batch[i] for i in indices), vectors))
+                if vectors is not None
+                else []
+            )
+            remaining -= 1
+            yield len(batch), embeddings, [(batch[i], error) for i, error in failures]
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        tasks.cancel_join_thread()
+        results.cancel_join_thread()
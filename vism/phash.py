@@ -0,0 +1,182 @@
+"""
+Perceptual hashes for finding exact and near-exact duplicates without a model
+
+A 64-bit DCT hash (pHash) is computed from a tiny decode of each image and
+cached per file, independent of any model. Re-saves, resizes and recompressions
+of the same picture land within a few bits of each other.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import logging
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+from .cache import cache_phashes, load_cached_phashes
+from .images import load_image
+from .profiling import stage
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+# side of the grayscale thumbnail the DCT runs on
+PHASH_SIZE = 32
+# side of the low-frequency DCT block the hash bits come from
+_LOW_FREQ = 8
+# default Hamming distance up to which two hashes count as the same picture
+DEFAULT_MAX_DISTANCE = 6
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * x + 1) * k / (2 * n)).astype(np.float32)
+
+
+_DCT = _dct_matrix(PHASH_SIZE)[:_LOW_FREQ]
+
+
+def phash_from_image(img: Image.Image) -> int:
+    """64-bit pHash: signs of the 8x8 lowest DCT frequencies against their median"""
+    gray = img.convert("L").resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BOX)
+    pixels = np.asarray(gray, dtype=np.float32)
+    low = (_DCT @ pixels @ _DCT.T).ravel()
+    # the DC term only encodes overall brightness
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def compute_phash(path: Path) -> int:
+    # DCT-scaled JPEG decode; the full-resolution image is never materialized
+    img = load_image(path, min_size=PHASH_SIZE).image
+    with stage("phash", items=1):
+        return phash_from_image(img)
+
+
+def get_or_compute_phashes(
+    image_paths: List[Path],
+    cache_keys: Optional[Dict[Path, str]] = None,
+    workers: int = 0,
+) -> Dict[Path, int]:
+    """
+    Return {path: pHash}, computing and caching the uncached ones
+
+    Images that can't be decoded are left out. Decoding runs on up to
+    `workers` threads (PIL releases the GIL while decoding).
+    """
+    hashes = load_cached_phashes(image_paths, cache_keys)
+    missing = [p for p in image_paths if p not in hashes]
+    if not missing:
+        return hashes
+
+    def hash_one(path: Path) -> Tuple[Path, Optional[int]]:
+        try:
+            return path, compute_phash(path)
+        except Exception as e:
+            logger.debug(f"Failed to hash {path}: {e}")
+            return path, None
+
+    computed: Dict[Path, int] = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for path, phash in tqdm(
+            executor.map(hash_one, missing),
+            total=len(missing),
+            desc="Hashing images",
+            unit="img",
+        ):
+            if phash is not None:
+                computed[path] = phash
+
+    try:
+        cache_phashes(computed, cache_keys)
+    except Exception as e:
+        logger.warning(f"Failed to cache perceptual hashes: {e}")
+    hashes.update(computed)
+    return hashes
+
+
+class _BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance
+
+    Children are keyed by their distance to the parent, so by the triangle
+    inequality a radius-r query only descends into children whose key is
+    within r of the query's distance to the node.
+    """
+
+    def __init__(self) -> None:
+        # node: (hash, item, {distance: child})
+        self._root: Optional[Tuple[int, int, Dict[int, tuple]]] = None
+
+    def add(self, value: int, item: int) -> None:
+        if self._root is None:
+            self._root = (value, item, {})
+            return
+        node = self._root
+        while True:
+            d = (value ^ node[0]).bit_count()
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = (value, item, {})
+                return
+            node = child
+
+    def query(self, value: int, radius: int) -> List[Tuple[int, int]]:
+        """Return (item, distance) for every stored hash within radius"""
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_value, item, children = stack.pop()
+            d = (value ^ node_value).bit_count()
+            if d <= radius:
+                found.append((item, d))
+            for key, child in children.items():
+                if d - radius <= key <= d + radius:
+                    stack.append(child)
+        return found
+
+
+def phash_edges(
+    hashes: List[int], max_distance: int = DEFAULT_MAX_DISTANCE
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Return (src, dst, similarity) edges between hashes within max_distance
+
+    Similarity is 1 - distance / 64, so identical hashes score 1.0. Identical
+    hashes (byte-identical copies, lossless re-saves) are collapsed before the
+    BK-tree lookup; each copy is linked to its group's first occurrence, which
+    keeps the same connected components with far fewer edges.
+    """
+    values = np.array(hashes, dtype=np.uint64)
+    unique, first, inverse = np.unique(values, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # copies of an already-seen hash
+    copies = np.flatnonzero(first[inverse] != np.arange(len(values)))
+    srcs = [first[inverse[copies]]]
+    dsts = [copies]
+    sims = [np.ones(len(copies), dtype=np.float32)]
+
+    if max_distance > 0:
+        tree = _BKTree()
+        for u, value in enumerate(unique.tolist()):
+            tree.add(value, u)
+        near_src, near_dst, near_dist = [], [], []
+        for u, value in enumerate(unique.tolist()):
+            for v, d in tree.query(value, max_distance):
+                if v > u:
+                    near_src.append(u)
+                    near_dst.append(v)
+                    near_dist.append(d)
+        srcs.append(first[np.array(near_src, dtype=np.int64)])
+        dsts.append(first[np.array(near_dst, dtype=np.int64)])
+        sims.append(1.0 - np.array(near_dist, dtype=np.float32) / HASH_BITS)
+
+    return (
+        np.concatenate(srcs).astype(np.int64),
+        np.concatenate(dsts).astype(np.int64),
+        np.concatenate(sims).astype(np.float32),
+    )
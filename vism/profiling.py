@@ -0,0 +1,263 @@
+"""
+Per-stage profiling of the pipeline
+
+Pipeline stages are wrapped in `with stage("decode") as s: ...`. That is a
+shared no-op unless a Profiler is active, which `vism --profile` or the
+profile() context manager turns on:
+
+    with profile() as prof:
+        get_library_index(...)
+    print(prof.summary())
+    prof.write_chrome_trace("trace.json")  # chrome://tracing or ui.perfetto.dev
+
+Each stage records wall time, CPU time of the thread that ran it, items and
+bytes read (as reported by the stage), and the process peak RSS when it
+ended. Stages nest (an index update contains decode and inference stages),
+so their times overlap rather than add up.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore
+
+
+def _peak_rss() -> int:
+    """Peak resident set size of the process so far, in bytes (0 if unknown)"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+@dataclass(frozen=True)
+class StageEvent:
+    name: str
+    thread: int
+    start: float
+    wall: float
+    cpu: float
+    items: int
+    bytes_read: int
+    peak_rss: int
+
+
+@dataclass
+class StageStats:
+    name: str
+    calls: int = 0
+    wall: float = 0.0
+    cpu: float = 0.0
+    items: int = 0
+    bytes_read: int = 0
+    peak_rss: int = 0
+
+    @property
+    def per_second(self) -> float:
+        return self.items / self.wall if self.wall > 0 else 0.0
+
+
+class _Stage:
+    """One timed run of a stage; add() reports the items and bytes it handled"""
+
+    __slots__ = ("_profiler", "_name", "_items", "_bytes", "_start", "_cpu")
+
+    def __init__(self, profiler: "Profiler", name: str, items: int) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._items = items
+        self._bytes = 0
+
+    def add(self, items: int = 0, bytes_read: int = 0) -> None:
+        self._items += items
+        self._bytes += bytes_read
+
+    def __enter__(self) -> "_Stage":
+        self._start = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        end = time.perf_counter()
+        self._profiler.events.append(
+            StageEvent(
+                name=self._name,
+                thread=threading.get_ident(),
+                start=self._start,
+                wall=end - self._start,
+                cpu=time.thread_time() - self._cpu,
+                items=self._items,
+                bytes_read=self._bytes,
+                peak_rss=_peak_rss(),
+            )
+        )
+
+
+class _NullStage:
+    """Stand-in for _Stage while profiling is off"""
+
+    def add(self, items: int = 0, bytes_read: int = 0) -> None:
+        pass
+
+    def __enter__(self) -> "_NullStage":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Profiler:
+    """Collects stage events from all threads while active"""
+
+    def __init__(self) -> None:
+        self.events: List[StageEvent] = []
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self._cpu_start = time.process_time()
+        self.cpu: Optional[float] = None
+
+    def stage(self, name: str, items: int = 0) -> _Stage:
+        return _Stage(self, name, items)
+
+    def stop(self) -> None:
+        self.end = time.perf_counter()
+        self.cpu = time.process_time() - self._cpu_start
+
+    def stats(self) -> List[StageStats]:
+        """Totals per stage, in order of first use"""
+        by_name: Dict[str, StageStats] = {}
+        for event in sorted(self.events, key=lambda e: e.start):
+            stats = by_name.setdefault(event.name, StageStats(event.name))
+            stats.calls += 1
+            stats.wall += event.wall
+            stats.cpu += event.cpu
+            stats.items += event.items
+            stats.bytes_read += event.bytes_read
+            stats.peak_rss = max(stats.peak_rss, event.peak_rss)
+        return list(by_name.values())
+
+    def summary(self) -> str:
+        """Table of stage totals, plus the whole run's wall and CPU time"""
+        lines = [
+            f"{'stage':<16}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'items':>9}"
+            f"{'items/s':>11}{'MB read':>10}{'peak RSS MB':>13}"
+        ]
+        for s in self.stats():
+            lines.append(
+                f"{s.name:<16}{s.calls:>8}{s.wall:>10.3f}{s.cpu:>10.3f}{s.items:>9}"
+                f"{s.per_second:>11.1f}{s.bytes_read / 1e6:>10.1f}"
+                f"{s.peak_rss / 1e6:>13.1f}"
+            )
+        end = self.end if self.end is not None else time.perf_counter()
+        cpu = self.cpu if self.cpu is not None else time.process_time() - self._cpu_start
+        lines.append(
+            f"total: {end - self.start:.3f} s wall, {cpu:.3f} s cpu, "
+            f"peak RSS {_peak_rss() / 1e6:.1f} MB"
+        )
+        return "\n".join(lines)
+
+    def to_dict(self) -> Dict[str, Any]:
+        end = self.end if self.end is not None else time.perf_counter()
+        return {
+            "wall": end - self.start,
+            "cpu": self.cpu,
+            "peak_rss": _peak_rss(),
+            "stages": [
+                {
+                    "name": s.name,
+                    "calls": s.calls,
+                    "wall": s.wall,
+                    "cpu": s.cpu,
+                    "items": s.items,
+                    "bytes_read": s.bytes_read,
+                    "peak_rss": s.peak_rss,
+                }
+                for s in self.stats()
+            ],
+        }
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def write_chrome_trace(self, path: Union[str, Path]) -> None:
+        """Write every stage run as a Chrome trace event (times in microseconds)"""
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": e.name,
+                "ph": "X",
+                "pid": pid,
+                "tid": e.thread,
+                "ts": (e.start - self.start) * 1e6,
+                "dur": e.wall * 1e6,
+                "args": {
+                    "cpu_ms": e.cpu * 1e3,
+                    "items": e.items,
+                    "bytes_read": e.bytes_read,
+                    "peak_rss": e.peak_rss,
+                },
+            }
+            for e in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+_active: Optional[Profiler] = None
+_active_lock = threading.Lock()
+
+
+def stage(name: str, items: int = 0) -> Union[_Stage, _NullStage]:
+    """Time a pipeline stage if a profiler is active; a no-op otherwise"""
+    profiler = _active
+    if profiler is None:
+        return _NULL_STAGE
+    return profiler.stage(name, items)
+
+
+def enabled() -> bool:
+    return _active is not None
+
+
+def start() -> Profiler:
+    """Start profiling this process; stages in every thread are recorded"""
+    global _active
+    with _active_lock:
+        if _active is not None:
+            raise RuntimeError("A profiler is already active")
+        _active = Profiler()
+        return _active
+
+
+def stop() -> Optional[Profiler]:
+    """Stop profiling and return the profiler, or None if none was active"""
+    global _active
+    with _active_lock:
+        profiler, _active = _active, None
+    if profiler is not None:
+        profiler.stop()
+    return profiler
+
+
+@contextmanager
+def profile() -> Iterator[Profiler]:
+    """Profile the pipeline stages run inside the block"""
+    profiler = start()
+    try:
+        yield profiler
+    finally:
+        stop()
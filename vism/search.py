@@ -1,29 +1,140 @@
 import faiss
+import math
 import numpy as np
-from typing import List
+from dataclasses import dataclass
+from typing import Optional
 import logging
-from .types import ImageEmbedding, SearchResult
+from .profiling import stage
 
 logger = logging.getLogger(__name__)
 
+# cap on vectors used for k-means / PQ training on large libraries
+_MAX_TRAIN_POINTS = 256 * 1024
 
-def build_index(items: List[ImageEmbedding]) -> faiss.IndexFlatIP:
-    vectors = np.stack([it.embedding for it in items])
-    index = faiss.IndexFlatIP(vectors.shape[1])
-    index.add(vectors.astype("float32"))  # type: ignore
-    logger.debug(f"FAISS index built with {index.ntotal} vectors")
-    return index
 
+@dataclass(slots=True, frozen=True)
+class IndexSpec:
+    """Build-time parameters of a search index (None picks a size-based default)"""
 
-def search_items(
-    index: faiss.IndexFlatIP,
-    query_embedding: ImageEmbedding,
-    embeddings: List[ImageEmbedding],
+    index_type: str = "flat"
+    nlist: Optional[int] = None
+    pq_m: Optional[int] = None
+    hnsw_m: int = 32
+
+
+def _default_nlist(n: int) -> int:
+    # ~4*sqrt(n) lists, but keep >= 39 training points per centroid
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def _default_pq_m(d: int) -> int:
+    """Largest sub-quantizer count <= d/4 that divides d (4+ dims per code byte)"""
+    for m in range(max(1, d // 4), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+
+def _factory_string(spec: IndexSpec, n: int, d: int) -> tuple[str, int]:
+    """Return (faiss factory string, minimum number of training vectors)"""
+    if spec.index_type == "flat":
+        return "IDMap2,Flat", 0
+    if spec.index_type == "hnsw":
+        return f"IDMap2,HNSW{spec.hnsw_m}", 0
+    nlist = spec.nlist or _default_nlist(n)
+    if spec.index_type == "ivf-flat":
+        return f"IVF{nlist},Flat", nlist
+    if spec.index_type == "ivf-pq":
+        return f"IVF{nlist},PQ{spec.pq_m or _default_pq_m(d)}", max(nlist, 256)
+    raise ValueError(f"Unknown index type '{spec.index_type}'")
+
+
+def needs_training(spec: IndexSpec) -> bool:
+    return spec.index_type in ("ivf-flat", "ivf-pq")
+
+
+def can_train(spec: IndexSpec, n: int) -> bool:
+    """Whether an index of n vectors can be built as spec rather than flat"""
+    # the training minimum doesn't depend on the dimension
+    return n >= _factory_string(spec, n, d=1)[1]
+
+
+def create_index(
+    vectors: np.ndarray, spec: IndexSpec, n: Optional[int] = None
+) -> tuple[faiss.Index, IndexSpec]:
+    """
+    Create an empty inner-product index that accepts add_with_ids, training it
+    on vectors if the index type needs it. Falls back to flat when there are
+    too few vectors to train; the returned spec is the one actually built.
+    vectors may be a sample of the n vectors the index will hold, which then
+    size its defaults.
+    """
+    d = vectors.shape[1]
+    if n is None:
+        n = len(vectors)
+    factory, min_train = _factory_string(spec, n, d)
+    if n < min_train:
+        logger.warning(
+            f"{n} vectors are too few to train a {spec.index_type} index, using flat"
+        )
+        spec = IndexSpec()
+        factory, _ = _factory_string(spec, n, d)
+
+    index = faiss.index_factory(d, factory, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        train = vectors
+        if len(vectors) > _MAX_TRAIN_POINTS:
+            rng = np.random.default_rng(0)
+            train = vectors[rng.choice(len(vectors), _MAX_TRAIN_POINTS, replace=False)]
+        logger.debug(f"Training {factory} index on {len(train)} vectors")
+        with stage("index_train", items=len(train)):
+            index.train(np.ascontiguousarray(train, dtype="float32"))  # type: ignore
+    return index, spec
+
+
+def set_search_params(
+    index: faiss.Index, nprobe: Optional[int] = None, ef_search: Optional[int] = None
+) -> None:
+    """Apply query-time parameters; ones that don't apply to the index are ignored"""
+    params = faiss.ParameterSpace()
+    for name, value in (("nprobe", nprobe), ("efSearch", ef_search)):
+        if value is None:
+            continue
+        try:
+            params.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+
+def estimate_recall(
+    index: faiss.Index,
+    vectors: np.ndarray,
+    ids: np.ndarray,
     k: int = 10,
-) -> List[SearchResult]:
-    scores, indices = index.search(query_embedding.embedding.reshape(1, -1).astype("float32"), k)  # type: ignore
-    return [
-        SearchResult(path=embeddings[i].path, score=float(scores[0][j]))
-        for j, i in enumerate(indices[0])
-        if i != -1
-    ]
+    sample: int = 1000,
+) -> float:
+    """
+    recall@k of index against exact search over vectors (which must be the
+    vectors the index holds, under the same ids), on a random query sample
+    """
+    if not len(vectors):
+        return 1.0
+    k = min(k, len(vectors))
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(sample, len(vectors)), replace=False)]
+    queries = np.ascontiguousarray(queries, dtype="float32")
+
+    _, exact = faiss.knn(
+        queries,
+        np.ascontiguousarray(vectors, dtype="float32"),
+        k,
+        metric=faiss.METRIC_INNER_PRODUCT,
+    )
+    exact_ids = ids[exact]
+    _, approx_ids = index.search(queries, k)  # type: ignore
+
+    hits = sum(
+        len(np.intersect1d(e, a, assume_unique=True))
+        for e, a in zip(exact_ids, approx_ids)
+    )
+    return hits / (len(queries) * k)
@@ -0,0 +1,438 @@
+"""
+Resident daemon that keeps models, embeddings and indexes loaded between runs
+
+Clients talk to it over a Unix socket with newline-delimited JSON: one request
+object, answered by a stream of response objects ending with {"done": true}
+(or a single {"error": ...}).
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .types import QueryResult, SearchResult
+
+logger = logging.getLogger(__name__)
+
+
+def _get_socket_path() -> Path:
+    env_path = os.environ.get("VISM_SOCKET")
+    if env_path:
+        return Path(env_path)
+    from .cache import _get_cache_dir
+
+    return _get_cache_dir() / "vism.sock"
+
+
+def query_result_to_dict(query_result: QueryResult) -> Dict[str, Any]:
+    """The JSON-serializable record sent over the socket and printed by --format jsonl"""
+    # text queries are told apart from image paths by their key
+    query = query_result.query
+    record: Dict[str, Any] = (
+        {"text": query} if isinstance(query, str) else {"query": str(query)}
+    )
+    if query_result.error is not None:
+        record["error"] = query_result.error
+    else:
+        record["results"] = [
+            {"path": str(r.path), "score": round(r.score, 6)}
+            for r in query_result.results
+        ]
+    if query_result.skipped:
+        record["skipped"] = query_result.skipped
+    if not query_result.final:
+        record["final"] = False
+    return record
+
+
+def query_result_from_dict(record: Dict[str, Any]) -> QueryResult:
+    """Inverse of query_result_to_dict"""
+    return QueryResult(
+        query=record["text"] if "text" in record else Path(record["query"]),
+        results=[
+            SearchResult(path=Path(r["path"]), score=r["score"])
+            for r in record.get("results", [])
+        ],
+        error=record.get("error"),
+        skipped=record.get("skipped", 0),
+        final=record.get("final", True),
+    )
+
+
+# --- client ---
+
+
+class DaemonError(Exception):
+    """The daemon failed to serve a request"""
+
+
+def request(payload: Dict[str, Any]) -> Optional[Iterator[Dict[str, Any]]]:
+    """
+    Send a request to a running daemon and stream its responses
+
+    Returns None when no daemon is listening, so callers can fall back to
+    running in-process.
+    """
+    socket_path = _get_socket_path()
+    if not socket_path.exists():
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(socket_path))
+    except OSError:
+        sock.close()
+        return None
+
+    sock.sendall(json.dumps(payload).encode() + b"\n")
+    return _iter_responses(sock)
+
+
+def _iter_responses(sock: socket.socket) -> Iterator[Dict[str, Any]]:
+    with sock, sock.makefile("rb") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("done"):
+                return
+            # per-query errors are ordinary records; fatal ones end the request
+            if record.get("fatal"):
+                raise DaemonError(record["error"])
+            yield record
+    raise DaemonError("connection closed unexpectedly")
+
+
+# --- server ---
+
+
+# load_model options a client may send along with the model name
+_INFERENCE_DEFAULTS: Dict[str, Any] = {
+    "precision": "float32",
+    "compile": False,
+    "backend": "torch",
+    "intra_op_threads": 0,
+    "inter_op_threads": 0,
+}
+
+
+class _State:
+    """Everything the daemon keeps warm; requests are served one at a time"""
+
+    def __init__(self, refresh: float) -> None:
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        # (model_name, inference options) -> model
+        self.models: Dict[Tuple[str, Tuple[Tuple[str, Any], ...]], Any] = {}
+        self.text_models: Dict[str, Any] = {}
+        self.libraries: Dict[Tuple[str, str], Tuple[float, Any]] = {}
+        self.embeddings: Dict[Tuple[str, str], Tuple[float, Tuple[List[Path], Any]]] = {}
+
+    def model(self, model_name: str, **inference: Any) -> Any:
+        """Load a model once per combination of load_model options"""
+        options = {**_INFERENCE_DEFAULTS, **inference}
+        key = (model_name, tuple(sorted(options.items())))
+        if key not in self.models:
+            from .embeddings import load_model
+
+            logger.info(f"Loading model {model_name}")
+            self.models[key] = load_model(model_name, **options)
+        return self.models[key]
+
+    def text_model(self, model_name: str) -> Any:
+        if model_name not in self.text_models:
+            from .embeddings import load_text_model
+
+            logger.info(f"Loading text encoder of {model_name}")
+            self.text_models[model_name] = load_text_model(model_name)
+        return self.text_models[model_name]
+
+    def request_model(self, request: Dict[str, Any]) -> Any:
+        return self.model(
+            request["model"],
+            **{key: request[key] for key in _INFERENCE_DEFAULTS if key in request},
+        )
+
+    def library(self, request: Dict[str, Any]) -> Any:
+        from .core import ModelLoader, get_library_index, scan_library
+        from .search import IndexSpec
+
+        model_name = _cache_name(request)
+        root = Path(request["source_dir"])
+        spec_fields = request.get("index_spec")
+        spec = IndexSpec(**spec_fields) if spec_fields else None
+        key = (model_name, str(root))
+
+        cached = self.libraries.get(key)
+        if (
+            cached is not None
+            and time.monotonic() - cached[0] < self.refresh
+            and (spec is None or cached[1].requested_spec == spec)
+        ):
+            return cached[1]
+
+        cache_keys = scan_library(root)
+        lib = get_library_index(
+            root,
+            list(cache_keys),
+            ModelLoader(lambda: self.request_model(request)),
+            model_name,
+            decode_workers=request.get("decode_workers", 0),
+            batch_size=request.get("batch_size"),
+            index_spec=spec,
+            cache_keys=cache_keys,
+        )
+        self.libraries[key] = (time.monotonic(), lib)
+        return lib
+
+    def library_embeddings(self, request: Dict[str, Any]) -> Tuple[List[Path], Any]:
+        from .core import ModelLoader, get_embedding_matrix, scan_library
+
+        model_name = _cache_name(request)
+        root = Path(request["source_dir"])
+        key = (model_name, str(root))
+
+        cached = self.embeddings.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.refresh:
+            return cached[1]
+
+        cache_keys = scan_library(root)
+        embeddings = get_embedding_matrix(
+            list(cache_keys),
+            ModelLoader(lambda: self.request_model(request)),
+            model_name,
+            decode_workers=request.get("decode_workers", 0),
+            batch_size=request.get("batch_size"),
+            cache_keys=cache_keys,
+        )
+        self.embeddings[key] = (time.monotonic(), embeddings)
+        return embeddings
+
+
+def _cache_name(request: Dict[str, Any]) -> str:
+    from .cache import inference_cache_name
+
+    return inference_cache_name(request["model"], request.get("precision", "float32"))
+
+
+def _handle_search(state: _State, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    from .core import search_queries
+    from .search import set_search_params
+
+    if request.get("texts"):
+        yield from _handle_text_search(state, request)
+        return
+    budget = (request.get("max_encode"), request.get("max_encode_time"))
+    if budget != (None, None):
+        yield from _handle_budgeted_search(state, request)
+        return
+
+    lib = state.library(request)
+    if lib.index is not None:
+        set_search_params(
+            lib.index, nprobe=request.get("nprobe"), ef_search=request.get("ef_search")
+        )
+    results = search_queries(
+        lib,
+        [Path(q) for q in request["queries"]],
+        state.request_model(request),
+        k=request.get("k", 10),
+        decode_workers=request.get("decode_workers", 0),
+    )
+    for query_result in results:
+        yield query_result_to_dict(query_result)
+
+
+def _handle_budgeted_search(
+    state: _State, request: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Search with an encoding budget, streaming every round of results"""
+    from .core import ModelLoader, run_batch_search_pipeline
+    from .search import IndexSpec
+
+    spec_fields = request.get("index_spec")
+    results = run_batch_search_pipeline(
+        source_dir=Path(request["source_dir"]),
+        queries=[Path(q) for q in request["queries"]],
+        model=ModelLoader(lambda: state.request_model(request)),
+        model_name=_cache_name(request),
+        k=request.get("k", 10),
+        decode_workers=request.get("decode_workers", 0),
+        batch_size=request.get("batch_size"),
+        index_spec=IndexSpec(**spec_fields) if spec_fields else None,
+        nprobe=request.get("nprobe"),
+        ef_search=request.get("ef_search"),
+        max_encode=request.get("max_encode"),
+        max_encode_time=request.get("max_encode_time"),
+    )
+    for query_result in results:
+        yield query_result_to_dict(query_result)
+    # the kept index may now be behind what is on disk
+    state.libraries.pop((_cache_name(request), request["source_dir"]), None)
+
+
+def _handle_text_search(
+    state: _State, request: Dict[str, Any]
+) -> Iterator[Dict[str, Any]]:
+    """Search CLIP image embeddings by text; cache-only unless given a budget"""
+    from .core import ModelLoader, run_text_search_pipeline
+    from .search import IndexSpec
+
+    spec_fields = request.get("index_spec")
+    results = run_text_search_pipeline(
+        source_dir=Path(request["source_dir"]),
+        texts=request["texts"],
+        load_text_model=lambda: state.text_model(request["model"]),
+        model=ModelLoader(lambda: state.request_model(request)),
+        model_name=_cache_name(request),
+        k=request.get("k", 10),
+        decode_workers=request.get("decode_workers", 0),
+        batch_size=request.get("batch_size"),
+        index_spec=IndexSpec(**spec_fields) if spec_fields else None,
+        nprobe=request.get("nprobe"),
+        ef_search=request.get("ef_search"),
+        max_encode=request.get("max_encode", 0),
+        max_encode_time=request.get("max_encode_time"),
+    )
+    for query_result in results:
+        yield query_result_to_dict(query_result)
+    state.libraries.pop((_cache_name(request), request["source_dir"]), None)
+
+
+def _handle_dupes(state: _State, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    from .core import find_library_duplicates, scan_library
+    from .dupes import clusters_from_edges, duplicate_edges, estimate_dupes_recall
+    from .search import IndexSpec
+
+    spec_fields = request.get("index_spec")
+    spec = IndexSpec(**spec_fields) if spec_fields else None
+    threshold = request["threshold"]
+    mode = request.get("mode", "embed")
+
+    if mode != "embed":
+        # hash stages are cached on disk; only the model is worth keeping warm
+        clusters, recall = find_library_duplicates(
+            scan_library(Path(request["source_dir"])),
+            lambda: state.request_model(request),
+            _cache_name(request),
+            threshold=threshold,
+            mode=mode,
+            max_distance=request["max_distance"],
+            spec=spec,
+            nprobe=request.get("nprobe"),
+            decode_workers=request.get("decode_workers", 0),
+            batch_size=request.get("batch_size"),
+            eval_recall=request.get("eval_recall", 0),
+        )
+    else:
+        paths, vectors = state.library_embeddings(request)
+        if len(paths) < 2:
+            return
+        edges = duplicate_edges(vectors, threshold, spec=spec, nprobe=request.get("nprobe"))
+        recall = None
+        if request.get("eval_recall"):
+            recall = estimate_dupes_recall(
+                vectors, edges[0], edges[1], threshold, sample=request["eval_recall"]
+            )
+        clusters = clusters_from_edges(paths, *edges)
+
+    if recall is not None:
+        yield {"recall": recall}
+    for cluster in clusters:
+        yield {"cluster": [[str(path), score] for path, score in cluster]}
+
+
+_HANDLERS = {"search": _handle_search, "dupes": _handle_dupes}
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: "_Server"
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            # liveness probe from another `vism serve`
+            return
+        try:
+            self._serve(line)
+        except BrokenPipeError:
+            logger.debug("Client disconnected")
+
+    def _serve(self, line: bytes) -> None:
+        try:
+            request = json.loads(line)
+            handler = _HANDLERS[request["command"]]
+        except Exception as e:
+            self._send({"fatal": True, "error": f"bad request: {e}"})
+            return
+
+        state = self.server.state
+        with state.lock:
+            try:
+                for record in handler(state, request):
+                    self._send(record)
+            except BrokenPipeError:
+                raise
+            except Exception as e:
+                logger.exception(f"Failed to handle {request['command']} request")
+                self._send({"fatal": True, "error": str(e)})
+                return
+            self._send({"done": True})
+
+    def _send(self, record: Dict[str, Any]) -> None:
+        self.wfile.write(json.dumps(record).encode() + b"\n")
+        self.wfile.flush()
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: Path, state: _State) -> None:
+        self.state = state
+        super().__init__(str(socket_path), _RequestHandler)
+
+
+def serve(
+    socket_path: Optional[Path] = None,
+    refresh: float = 30.0,
+    preload: Optional[List[str]] = None,
+) -> None:
+    """Run the daemon in the foreground until SIGINT/SIGTERM"""
+    socket_path = socket_path or _get_socket_path()
+    socket_path.parent.mkdir(parents=True, exist_ok=True)
+
+    if socket_path.exists():
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(str(socket_path))
+            raise RuntimeError(f"A vism daemon is already listening on {socket_path}")
+        except OSError:
+            # stale socket left behind by a daemon that didn't shut down cleanly
+            socket_path.unlink()
+        finally:
+            probe.close()
+
+    state = _State(refresh=refresh)
+    for model_name in preload or []:
+        state.model(model_name)
+
+    server = _Server(socket_path, state)
+    if threading.current_thread() is threading.main_thread():
+        # shutdown() blocks until serve_forever returns, so it can't run in the handler
+        signal.signal(
+            signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start()
+        )
+    logger.info(f"Listening on {socket_path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        socket_path.unlink(missing_ok=True)
+        logger.info("Daemon stopped")
@@ -1,9 +1,17 @@
 from dataclasses import dataclass
 from pathlib import Path
+from typing import List, Optional, Union
 from PIL import Image
 import numpy as np
 
 
+@dataclass(slots=True, frozen=True)
+class FileEntry:
+    path: Path
+    size: int
+    mtime_ns: int
+
+
 @dataclass(slots=True, frozen=True)
 class ImageData:
     path: Path
@@ -20,3 +28,15 @@ class ImageEmbedding:
 class SearchResult:
     path: Path
     score: float
+
+
+@dataclass(slots=True, frozen=True)
+class QueryResult:
+    # an image path, or the text of a text query
+    query: Union[Path, str]
+    results: List[SearchResult]
+    error: Optional[str] = None
+    # library images not searched because they aren't encoded yet
+    skipped: int = 0
+    # False for progressive results that later ones replace
+    final: bool = True